@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from flask import Flask
+
+from flask_warehouse import Warehouse
+
+KB = 1024
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+# the largest sizes take minutes and gigabytes of disk, so they only run when asked for
+LARGE = bool(os.environ.get('WAREHOUSE_BENCHMARK_LARGE'))
+
+OBJECT_SIZES = [KB, MB, 16 * MB] + ([256 * MB, GB] if LARGE else [])
+LISTING_SIZES = [10000] + ([100000, 1000000] if LARGE else [])
+
+SERVICES = ['file', 's3', 'memory']
+
+
+def size_id(size):
+    for unit, name in [(GB, 'GB'), (MB, 'MB'), (KB, 'KB')]:
+        if size >= unit:
+            return '{}{}'.format(size // unit, name)
+
+    return '{}B'.format(size)
+
+
+@pytest.fixture(params=SERVICES)
+def warehouse(request, tmpdir):
+    """A Warehouse for each backend, inside an app context; S3 is moto's in-process mock, so runs are offline."""
+    app = Flask(__name__, static_folder=str(tmpdir.join('static')))
+    app.config['SERVER_NAME'] = 'localhost'
+    app.config['WAREHOUSE_DEFAULT_SERVICE'] = request.param
+    app.config['WAREHOUSE_DEFAULT_LOCATION'] = 'us-west-1' if request.param == 's3' else None
+
+    if request.param == 's3':
+        moto = pytest.importorskip('moto')
+        mock = moto.mock_s3()
+        mock.start()
+        request.addfinalizer(mock.stop)
+
+    with app.app_context():
+        yield Warehouse(app)
+
+
+@pytest.fixture
+def service(warehouse):
+    return warehouse.service.id
@@ -0,0 +1,65 @@
+"""
+Performance baselines for the file and S3 backends.
+
+Run with 'make bench'; results are written as JSON for comparison between runs
+(pytest-benchmark's --benchmark-compare). Set WAREHOUSE_BENCHMARK_LARGE=1 for the
+256MB/1GB objects and 100k/1M key listings.
+"""
+import io
+
+import pytest
+
+from flask_warehouse.flask_warehouse import parse_uri
+
+from .conftest import LISTING_SIZES, OBJECT_SIZES, size_id
+
+
+pytest.importorskip('pytest_benchmark')
+
+
+def rounds(size):
+    return 3 if size >= 256 * 1024 ** 2 else 10
+
+
+@pytest.mark.parametrize('size', OBJECT_SIZES, ids=size_id)
+def test_store(benchmark, warehouse, service, size):
+    cubby = warehouse('{}:///benchmark/store'.format(service))
+    contents = b'x' * size
+
+    benchmark.extra_info['bytes'] = size
+    benchmark.pedantic(lambda: cubby.store(file=io.BytesIO(contents)), rounds=rounds(size))
+
+
+@pytest.mark.parametrize('size', OBJECT_SIZES, ids=size_id)
+def test_retrieve(benchmark, warehouse, service, size):
+    cubby = warehouse('{}:///benchmark/retrieve'.format(service))
+    cubby.store(bytes=b'x' * size)
+
+    benchmark.extra_info['bytes'] = size
+    benchmark.pedantic(lambda: cubby.retrieve(file=io.BytesIO()), rounds=rounds(size))
+
+
+@pytest.mark.parametrize('keys', LISTING_SIZES)
+def test_list(benchmark, warehouse, service, keys):
+    bucket = warehouse('{}:///benchmark-list-{}'.format(service, keys))
+
+    for i in range(keys):
+        bucket.cubby('keys/{:07d}'.format(i)).store(bytes=b'x')
+
+    benchmark.extra_info['keys'] = keys
+    listed = benchmark.pedantic(lambda: sum(1 for info in bucket.scan('keys/')), rounds=3)
+
+    assert listed == keys
+
+
+def test_url(benchmark, warehouse, service):
+    cubby = warehouse('{}:///benchmark/url'.format(service))
+    benchmark(cubby.url)
+
+
+def test_parse_uri(benchmark):
+    benchmark(parse_uri, 's3://us-west-1/benchmark/some/nested/key.txt')
+
+
+def test_handle_construction(benchmark, warehouse, service):
+    benchmark(warehouse, '{}:///benchmark/some/nested/handle.txt'.format(service))
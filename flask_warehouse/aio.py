@@ -0,0 +1,155 @@
+import asyncio
+import contextvars
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import has_app_context
+
+from .backends import Bucket, Cubby
+from .flask_warehouse import Warehouse
+
+
+class AsyncWarehouse:
+    """
+    Asyncio front end to a Warehouse, for async views and asyncio workers.
+
+    Every blocking backend call runs on a thread pool bounded by
+    'WAREHOUSE_ASYNC_MAX_CONCURRENCY', so awaiting many transfers at once
+    never opens more backend connections than that.
+    """
+
+    def __init__(self, app=None, warehouse: Warehouse = None):
+        self.warehouse = warehouse or Warehouse()
+        self.app = None
+        self.executor = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+
+        app.config.setdefault('WAREHOUSE_ASYNC_MAX_CONCURRENCY', 16)
+
+        if app.extensions.get('warehouse') is not self.warehouse:
+            self.warehouse.init_app(app)
+
+        self.executor = ThreadPoolExecutor(max_workers=app.config['WAREHOUSE_ASYNC_MAX_CONCURRENCY'],
+                                           thread_name_prefix='warehouse-async')
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs a blocking function on the pool, inside the caller's (or this app's) app context."""
+        if self.app is None:
+            raise RuntimeError("AsyncWarehouse.init_app() was not called!")
+
+        def call():
+            if has_app_context():
+                return fn(*args, **kwargs)
+
+            with self.app.app_context():
+                return fn(*args, **kwargs)
+
+        context = contextvars.copy_context()
+        loop = asyncio.get_running_loop()
+
+        result = await loop.run_in_executor(self.executor, functools.partial(context.run, call))
+        return self.wrap(result)
+
+    def wrap(self, result):
+        if isinstance(result, Cubby):
+            return AsyncCubby(self, result)
+        if isinstance(result, Bucket):
+            return AsyncBucket(self, result)
+        if isinstance(result, list):
+            return [self.wrap(item) for item in result]
+
+        return result
+
+    async def bucket(self, name=None, location=None):
+        return await self.run(self.warehouse.bucket, name, location)
+
+    async def __call__(self, bucket_or_key_str):
+        return await self.run(self.warehouse, bucket_or_key_str)
+
+    async def store_many(self, items, **kwargs):
+        """Stores (cubby, bytes) pairs concurrently, returning the stored cubbies in order."""
+        return await asyncio.gather(*[cubby.store(bytes=contents, **kwargs) for cubby, contents in items])
+
+    async def retrieve_many(self, cubbies):
+        return await asyncio.gather(*[cubby.retrieve() for cubby in cubbies])
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def __repr__(self):
+        return "<AsyncWarehouse {}>".format(self.warehouse)
+
+
+def unwrap(value):
+    return value.wrapped if isinstance(value, AsyncProxy) else value
+
+
+class AsyncProxy:
+    """Exposes every method of the wrapped handle as a coroutine function."""
+
+    def __init__(self, warehouse: AsyncWarehouse, wrapped):
+        self.warehouse = warehouse
+        self.wrapped = wrapped
+
+    def __getattr__(self, name):
+        attr = getattr(self.wrapped, name)
+
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            args = [unwrap(arg) for arg in args]
+            kwargs = {name: unwrap(value) for name, value in kwargs.items()}
+
+            return await self.warehouse.run(attr, *args, **kwargs)
+
+        return method
+
+    def __eq__(self, other):
+        if isinstance(other, AsyncProxy):
+            other = other.wrapped
+
+        return self.wrapped == other
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.wrapped)
+
+    def __str__(self):
+        return str(self.wrapped)
+
+
+class AsyncBucket(AsyncProxy):
+    def cubby(self, name, **kwargs):
+        return AsyncCubby(self.warehouse, self.wrapped.cubby(name, **kwargs))
+
+    async def list(self, prefix=None, max_keys=None):
+        """Yields the bucket's cubbies: `async for cubby in bucket.list(prefix)`."""
+        cubbies = await self.warehouse.run(self.wrapped.list, prefix=prefix, max_keys=max_keys)
+
+        for cubby in cubbies:
+            yield cubby
+
+
+class AsyncCubby(AsyncProxy):
+    async def store(self, *args, **kwargs):
+        await self.warehouse.run(self.wrapped.store, *args, **kwargs)
+        return self
+
+    @property
+    def key(self):
+        return self.wrapped.key
+
+    @property
+    def bucket(self):
+        return AsyncBucket(self.warehouse, self.wrapped.bucket)
+
+
+__all__ = ["AsyncWarehouse", "AsyncBucket", "AsyncCubby"]
@@ -0,0 +1,218 @@
+import collections
+import contextvars
+import io
+import posixpath
+import shutil
+import tarfile
+import threading
+import time
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+from .transfer import DEFAULT_CHUNK_SIZE, Pipe, TransferError
+
+
+FORMATS = ('zip', 'tar.gz')
+
+# how many chunks each prefetched object may buffer while it waits its turn
+PREFETCH_CHUNKS = 4
+
+SPOOL_SIZE = 8 * 1024 ** 2
+
+
+class Sink(io.RawIOBase):
+    """An unseekable output that hands everything written to it back to a generator."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def _read_chunks(reader, chunk_size=DEFAULT_CHUNK_SIZE):
+    return iter(lambda: reader.read(chunk_size), b'')
+
+
+def _write_zip_member(archive: zipfile.ZipFile, sink: Sink, info, reader, compression):
+    member = zipfile.ZipInfo(info.key, date_time=time.localtime(info.mtime)[:6])
+    member.compress_type = compression
+    member.file_size = info.size
+
+    with archive.open(member, 'w', force_zip64=info.size >= zipfile.ZIP64_LIMIT) as dst:
+        for chunk in _read_chunks(reader):
+            dst.write(chunk)
+            yield from sink.drain()
+
+
+def _write_tar_member(archive: tarfile.TarFile, sink: Sink, info, reader):
+    # TarFile.addfile() would copy the whole member before we could yield any of it
+    member = tarfile.TarInfo(info.key)
+    member.size = info.size
+    member.mtime = info.mtime
+
+    header = member.tobuf(archive.format, archive.encoding, archive.errors)
+    archive.fileobj.write(header)
+    archive.offset += len(header)
+
+    written = 0
+    for chunk in _read_chunks(reader):
+        written += len(chunk)
+        archive.fileobj.write(chunk)
+        yield from sink.drain()
+
+    if written != info.size:
+        raise TransferError("{} produced {} bytes but was listed at {} - content-encoded objects "
+                            "can only be archived with format='zip'.".format(info.key, written, info.size))
+
+    blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+    if remainder:
+        archive.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+
+    archive.offset += blocks * tarfile.BLOCKSIZE
+    yield from sink.drain()
+
+
+def archive(bucket, prefix=None, format='zip', prefetch=4, compression=zipfile.ZIP_STORED):
+    """
+    Yields a zip or tar.gz archive of every key under prefix, chunk by chunk.
+
+    The next 'prefetch' objects are fetched concurrently while the current one streams,
+    each into a small bounded Pipe, so memory stays bounded whatever the number or
+    size of the objects. Suitable for a Flask streaming Response.
+    """
+    if format not in FORMATS:
+        raise Exception("Unknown archive format '{}', expected one of {}.".format(format, FORMATS))
+
+    sink = Sink()
+    infos = bucket.scan(prefix)
+    pending = collections.deque()
+    context = contextvars.copy_context()
+
+    def fetch(info, pipe):
+        error = None
+
+        try:
+            bucket.cubby(info.key).retrieve_filelike(pipe.writer)
+        except BaseException as e:
+            error = e
+
+        try:
+            pipe.close(error=error)
+        except BrokenPipeError:
+            pass  # the archive was abandoned
+
+    def start(executor):
+        for info in infos:
+            pipe = Pipe(max_chunks=PREFETCH_CHUNKS)
+            executor.submit(context.copy().run, fetch, info, pipe)
+            pending.append((info, pipe))
+            return
+
+    executor = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix='warehouse-archive')
+
+    try:
+        if format == 'zip':
+            output = zipfile.ZipFile(sink, 'w', compression=compression, allowZip64=True)
+        else:
+            output = tarfile.open(fileobj=sink, mode='w|gz')
+
+        for _ in range(prefetch):
+            start(executor)
+
+        while pending:
+            # the member being written stays in pending until it is done, so it is aborted too
+            info, pipe = pending[0]
+            start(executor)
+
+            reader = io.BufferedReader(pipe.reader, DEFAULT_CHUNK_SIZE)
+
+            if format == 'zip':
+                yield from _write_zip_member(output, sink, info, reader, compression)
+            else:
+                yield from _write_tar_member(output, sink, info, reader)
+
+            pending.popleft()
+
+        output.close()
+        yield from sink.drain()
+    finally:
+        # unblock any fetches still waiting on an abandoned archive
+        for info, pipe in pending:
+            pipe.abort()
+
+        executor.shutdown(wait=False)
+
+
+def _member_key(prefix, name):
+    key = posixpath.normpath(name)
+
+    if key.startswith('/') or key == '..' or key.startswith('../'):
+        raise Exception("Refusing to extract '{}' outside of the prefix.".format(name))
+
+    return (prefix or '') + key
+
+
+def _spool(reader):
+    copy = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    shutil.copyfileobj(reader, copy)
+    copy.seek(0)
+    return copy
+
+
+def extract(bucket, stream, prefix=None, format='zip', max_workers=8):
+    """
+    Stores every file in a zip or tar.gz archive stream under prefix, uploading in parallel.
+
+    Members are read in order and handed to up to max_workers uploads; at most twice that
+    many are held (spooled, so large ones go to disk) at once. Zip archives keep their
+    index at the end, so an unseekable zip stream is spooled first.
+    """
+    if format not in FORMATS:
+        raise Exception("Unknown archive format '{}', expected one of {}.".format(format, FORMATS))
+
+    slots = threading.BoundedSemaphore(max_workers * 2)
+    context = contextvars.copy_context()
+    futures = []
+
+    def upload(key, contents):
+        try:
+            with contents:
+                return bucket.cubby(key).store(file=contents)
+        finally:
+            slots.release()
+
+    def members():
+        if format == 'zip':
+            source = stream if stream.seekable() else _spool(stream)
+
+            with zipfile.ZipFile(source) as archive:
+                for member in archive.infolist():
+                    if not member.is_dir():
+                        with archive.open(member) as reader:
+                            yield member.filename, reader
+        else:
+            with tarfile.open(fileobj=stream, mode='r|*') as archive:
+                for member in archive:
+                    if member.isfile():
+                        yield member.name, archive.extractfile(member)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='warehouse-extract') as executor:
+        for name, reader in members():
+            key = _member_key(prefix, name)
+
+            slots.acquire()
+            futures.append(executor.submit(context.copy().run, upload, key, _spool(reader)))
+
+        return [future.result() for future in futures]
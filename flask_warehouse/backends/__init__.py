@@ -1,10 +1,32 @@
-from .s3 import S3Service
-from .file import FileService
-from .service import Service, Bucket, Cubby
+import importlib
+
+from .service import Service, Bucket, Cubby, KeyInfo
 
 
-assert(S3Service)
-assert(FileService)
 assert(Service)
 assert(Bucket)
 assert(Cubby)
+assert(KeyInfo)
+
+
+# backends load on first access, so an app only pays for importing the ones it uses (boto3 for S3)
+_LAZY = {
+    'S3Service': '.s3',
+    'S3Bucket': '.s3',
+    'S3Cubby': '.s3',
+    'FileService': '.file',
+    'FolderBucket': '.file',
+    'FileCubby': '.file',
+    'MemoryService': '.memory',
+    'MemoryBucket': '.memory',
+    'MemoryCubby': '.memory',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+    value = getattr(importlib.import_module(_LAZY[name], __name__), name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,295 @@
+import hashlib
+import os
+import time
+
+from tempfile import SpooledTemporaryFile
+
+from ..index import LocalDatabase, local_database, prefix_range
+from ..transfer import transfer
+from .file import FileCubby, FolderBucket
+from .service import Bucket, Cubby, KeyInfo
+
+
+BLOB_PREFIX = '.blobs/'
+
+
+class ReferenceTable(LocalDatabase):
+    """
+    Maps logical keys to content digests, and counts the references to each digest.
+
+    A blob row is inserted before its upload starts and marked present once it lands,
+    so concurrent stores of new content upload it rather than trusting a half-written blob.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS refs (
+        bucket TEXT NOT NULL,
+        key TEXT NOT NULL,
+        digest TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        PRIMARY KEY (bucket, key)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS blobs (
+        bucket TEXT NOT NULL,
+        digest TEXT NOT NULL,
+        refcount INTEGER NOT NULL,
+        present INTEGER NOT NULL,
+        PRIMARY KEY (bucket, digest)
+    ) WITHOUT ROWID;
+    """
+
+    def acquire(self, bucket, digest):
+        """Takes a reference to a blob, returning whether it is already stored."""
+        with self.transaction() as connection:
+            row = connection.execute('SELECT present FROM blobs WHERE bucket = ? AND digest = ?',
+                                     (str(bucket), digest)).fetchone()
+
+            if row is None:
+                connection.execute('INSERT INTO blobs VALUES (?, ?, 1, 0)', (str(bucket), digest))
+                return False
+
+            connection.execute('UPDATE blobs SET refcount = refcount + 1 WHERE bucket = ? AND digest = ?',
+                               (str(bucket), digest))
+            return bool(row[0])
+
+    def release(self, bucket, digest):
+        self._connection().execute('UPDATE blobs SET refcount = refcount - 1 WHERE bucket = ? AND digest = ?',
+                                   (str(bucket), digest))
+
+    def mark_present(self, bucket, digest):
+        self._connection().execute('UPDATE blobs SET present = 1 WHERE bucket = ? AND digest = ?',
+                                   (str(bucket), digest))
+
+    def point(self, bucket, key, digest, size):
+        """Points key at an acquired digest, releasing the digest it pointed at before."""
+        with self.transaction() as connection:
+            previous = connection.execute('SELECT digest FROM refs WHERE bucket = ? AND key = ?',
+                                          (str(bucket), key)).fetchone()
+
+            connection.execute('INSERT OR REPLACE INTO refs VALUES (?, ?, ?, ?, ?)',
+                               (str(bucket), key, digest, size, time.time()))
+
+            if previous is not None:
+                connection.execute('UPDATE blobs SET refcount = refcount - 1 WHERE bucket = ? AND digest = ?',
+                                   (str(bucket), previous[0]))
+
+    def unpoint(self, bucket, key):
+        with self.transaction() as connection:
+            previous = connection.execute('SELECT digest FROM refs WHERE bucket = ? AND key = ?',
+                                          (str(bucket), key)).fetchone()
+
+            if previous is None:
+                return
+
+            connection.execute('DELETE FROM refs WHERE bucket = ? AND key = ?', (str(bucket), key))
+            connection.execute('UPDATE blobs SET refcount = refcount - 1 WHERE bucket = ? AND digest = ?',
+                               (str(bucket), previous[0]))
+
+    def lookup(self, bucket, key):
+        """Returns a KeyInfo whose etag is the content digest, or None."""
+        row = self._connection().execute('SELECT key, size, digest, mtime FROM refs WHERE bucket = ? AND key = ?',
+                                         (str(bucket), key)).fetchone()
+
+        return KeyInfo(*row, None) if row is not None else None
+
+    def scan(self, bucket, prefix=None, max_keys=None):
+        query = 'SELECT key, size, digest, mtime FROM refs WHERE bucket = ?'
+        params = [str(bucket)]
+
+        low, high = prefix_range(prefix)
+        if low:
+            query += ' AND key >= ?'
+            params.append(low)
+        if high is not None:
+            query += ' AND key < ?'
+            params.append(high)
+
+        query += ' ORDER BY key'
+        if max_keys is not None:
+            query += ' LIMIT ?'
+            params.append(max_keys)
+
+        for row in self._connection().execute(query, params):
+            yield KeyInfo(*row, None)
+
+    def collect(self, bucket, delete):
+        """
+        Forgets every unreferenced blob, calling delete(digest) for each, and returns how many.
+
+        Each is checked again and deleted inside its own transaction, so a store can't take
+        the digest up in between and upload a blob that is then deleted from under it.
+        """
+        digests = [row[0] for row in self._connection().execute(
+            'SELECT digest FROM blobs WHERE bucket = ? AND refcount <= 0', (str(bucket),))]
+        collected = 0
+
+        for digest in digests:
+            with self.transaction() as connection:
+                row = connection.execute('SELECT refcount FROM blobs WHERE bucket = ? AND digest = ?',
+                                         (str(bucket), digest)).fetchone()
+
+                if row is None or row[0] > 0:
+                    continue
+
+                delete(digest)
+                connection.execute('DELETE FROM blobs WHERE bucket = ? AND digest = ?', (str(bucket), digest))
+
+            collected += 1
+
+        return collected
+
+    def digests(self, bucket):
+        rows = self._connection().execute('SELECT digest FROM blobs WHERE bucket = ?', (str(bucket),))
+        return [row[0] for row in rows]
+
+    def clear(self, bucket):
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM refs WHERE bucket = ?', (str(bucket),))
+            connection.execute('DELETE FROM blobs WHERE bucket = ?', (str(bucket),))
+
+
+class ContentAddressedBucket(Bucket):
+    """
+    Stores each distinct content once in an underlying bucket, under its SHA-256.
+
+    Logical keys point at digests through a ReferenceTable, and gc() deletes blobs
+    nothing points at. On a FolderBucket each key is also a hardlink to its blob, so
+    the usual static URLs keep working.
+    """
+
+    def __init__(self, bucket: Bucket, refs_path):
+        super().__init__(bucket.service, bucket.name, bucket.location)
+
+        self.bucket = bucket
+        self.refs = local_database(ReferenceTable, refs_path)
+
+        self.links = isinstance(bucket, FolderBucket)
+
+    def cubby(self, name, **kwargs):
+        return ContentAddressedCubby(self, name)
+
+    def blob(self, digest):
+        return self.bucket.cubby(BLOB_PREFIX + digest[:2] + '/' + digest)
+
+    def delete(self):
+        if not self.links:
+            for digest in self.refs.digests(self):
+                self.blob(digest).delete()
+
+        self.refs.clear(self)
+        self.bucket.delete()
+
+    def list(self, prefix=None, max_keys=None):
+        return [ContentAddressedCubby(self, info.key) for info in self.refs.scan(self, prefix, max_keys)]
+
+    def scan(self, prefix=None):
+        return self.refs.scan(self, prefix)
+
+    def gc(self):
+        """Deletes blobs that no key refers to, returning how many were deleted."""
+        return self.refs.collect(self, lambda digest: self.blob(digest).delete())
+
+
+class ContentAddressedCubby(Cubby):
+    __slots__ = ('uploaded',)
+
+    def __init__(self, bucket: ContentAddressedBucket, name):
+        super().__init__(bucket, name)
+
+        self.uploaded = None
+
+    def _info(self):
+        info = self.bucket.refs.lookup(self.bucket, self.key)
+
+        if info is None:
+            raise FileNotFoundError("{} does not exist.".format(self))
+
+        return info
+
+    def digest(self):
+        return self._info().etag
+
+    def _link(self, digest):
+        """Points a FolderBucket's file for this key at its blob."""
+        if not self.bucket.links:
+            return
+
+        link = FileCubby(self.bucket.bucket, self.key)
+        temporary = os.path.join(link.dirpath(), '.' + os.path.basename(link.filepath()) + '.link')
+        link.makedirs()
+
+        os.link(self.bucket.blob(digest).filepath(), temporary)
+        os.replace(temporary, link.filepath())
+
+    def blob(self):
+        return self.bucket.blob(self.digest())
+
+    def store_filelike(self, filelike, content_type=None, content_encoding=None, metadata=None):
+        sha256 = hashlib.sha256()
+        size = 0
+
+        with SpooledTemporaryFile(max_size=8 * 1024 ** 2) as spool:
+            for chunk in iter(lambda: filelike.read(1024 * 1024), b''):
+                sha256.update(chunk)
+                size += len(chunk)
+                spool.write(chunk)
+
+            digest = sha256.hexdigest()
+            refs = self.bucket.refs
+
+            self.uploaded = not refs.acquire(self.bucket, digest)
+
+            if self.uploaded:
+                try:
+                    spool.seek(0)
+                    self.bucket.blob(digest).store_filelike(spool, content_type=content_type,
+                                                            content_encoding=content_encoding, metadata=metadata)
+                except BaseException:
+                    refs.release(self.bucket, digest)
+                    raise
+
+                refs.mark_present(self.bucket, digest)
+
+        refs.point(self.bucket, self.key, digest, size)
+        self._link(digest)
+
+    def retrieve_filelike(self, filelike):
+        return self.blob().retrieve_filelike(filelike)
+
+    def url(self, expiration=Cubby.DefaultUrlExpiration):
+        if self.bucket.links:
+            return FileCubby(self.bucket.bucket, self.key).url(expiration)
+
+        return self.blob().url(expiration)
+
+    def headers(self):
+        return self.blob().headers()
+
+    def info(self):
+        return self._info()
+
+    def filesize(self):
+        return self._info().size
+
+    def exists(self):
+        return self.bucket.refs.lookup(self.bucket, self.key) is not None
+
+    def delete(self):
+        self.bucket.refs.unpoint(self.bucket, self.key)
+
+        if self.bucket.links:
+            FileCubby(self.bucket.bucket, self.key).delete()
+
+        return not self.exists()
+
+    def copy_to_native_cubby(self, cubby=None):
+        if cubby.bucket.refs is not self.bucket.refs or str(cubby.bucket) != str(self.bucket):
+            return transfer(self, cubby)
+
+        # same store: the copy is just another reference to the same blob
+        info = self._info()
+        self.bucket.refs.acquire(self.bucket, info.etag)
+        self.bucket.refs.point(self.bucket, cubby.key, info.etag, info.size)
+        cubby._link(info.etag)
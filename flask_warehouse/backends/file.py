@@ -1,24 +1,139 @@
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import mimetypes
 import os
+import posixpath
+import re
 import shutil
+import stat
+import tempfile
+import threading
+import uuid
+import zlib
 
 from flask import Flask, url_for
 
-from .service import Bucket, Cubby, Service
+from ..checksums import (THREADED_HASHING_SIZE, HashingReader, HashingWriter, available, hash_file,
+                         source_size, verify)
+from ..index import key_index
+from ..metrics import instrumented, logger
+from ..uploads import sign_upload
+from .service import Bucket, Cubby, KeyInfo, Service
+
+try:
+    import fcntl
+except ImportError:  # Windows; keys are then not locked at all
+    fcntl = None
+
+
+# each bucket's lock files, one per stripe of keys, are kept under this folder - outside of
+# the static folder, so they are never served
+DEFAULT_LOCK_FOLDER = os.path.join(tempfile.gettempdir(), 'flask-warehouse-locks')
+
+# how many times a retrieve reopens a file replaced while it read the file's checksums
+CONSISTENT_READ_ATTEMPTS = 5
+
+# the files kept next to a key while it is written, warmed, linked, or to hold its checksums,
+# and the folders other backends keep inside a bucket - none of them are keys
+_INTERNAL_FILE = re.compile(r'^\..+(\.[0-9a-f]{32}\.tmp|\.checksums|\.warming|\.link)$')
+INTERNAL_FOLDERS = ('.blobs', '.tiered')
+
+
+def internal(name, is_dir):
+    """Whether a file or folder in a bucket's folder is the backend's own, rather than a key."""
+    return name in INTERNAL_FOLDERS if is_dir else bool(_INTERNAL_FILE.match(name))
+
+
+# the lock files this thread holds: [how many times over, whether shared], so a thread can nest locks
+_held = threading.local()
+
+
+@contextlib.contextmanager
+def file_lock(path, shared=False):
+    """
+    Holds an advisory fcntl lock on the file at path, across threads and processes.
+
+    Locks nest within a thread: one already held by this thread is not taken again. A shared
+    lock can't be made exclusive from within, as another process may share it too.
+    """
+    held = _held.__dict__.setdefault('paths', {})
+
+    if path in held:
+        if held[path][1] and not shared:
+            raise Exception("{} is held shared by this thread, so it can't be locked exclusively.".format(path))
+
+        held[path][0] += 1
+
+        try:
+            yield
+        finally:
+            held[path][0] -= 1
+
+        return
+
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+        held[path] = [1, shared]
+
+        try:
+            yield
+        finally:
+            del held[path]
+    finally:
+        os.close(fd)  # which releases the lock
+
+
+def _file_stat(filelike):
+    """Returns the stat of the regular file filelike reads from its start, or None."""
+    try:
+        if filelike.tell() != 0:
+            return None
+
+        result = os.fstat(filelike.fileno())
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+    return result if stat.S_ISREG(result.st_mode) else None
 
 
 class FileService(Service):
     requires_location = False
 
     def __init__(self, app: Flask, default_location=None):
-        super().__init__('file', default_location=default_location)
+        super().__init__('file', default_location=default_location,
+                         index=key_index(app.config.get('WAREHOUSE_INDEX_PATH')),
+                         app=app)
 
         self.root = app.static_folder
 
+        # keys share this many lock files per bucket, however many keys there are
+        self.lock_stripes = app.config.get('WAREHOUSE_FILE_LOCK_STRIPES', 64)
+        self.lock_folder = app.config.get('WAREHOUSE_FILE_LOCK_FOLDER', DEFAULT_LOCK_FOLDER)
+
         self.abspath = os.path.abspath(self.root)
 
         if not os.path.isdir(self.abspath):
             os.makedirs(self.abspath)
 
+        # {bucket name: [rule dicts]}; see flask_warehouse.lifecycle
+        self.lifecycle = app.config.get('WAREHOUSE_FILE_LIFECYCLE') or {}
+        self.lifecycle_batch_size = app.config.get('WAREHOUSE_FILE_LIFECYCLE_BATCH_SIZE', 1000)
+        self.lifecycle_pause = app.config.get('WAREHOUSE_FILE_LIFECYCLE_PAUSE', 0.01)
+
+    def bucket_exists(self, name, location=None):
+        return os.path.isdir(os.path.join(self.abspath, name))
+
 
 class FolderBucket(Bucket):
     def __init__(self, service: FileService, name: str, location: str):
@@ -34,56 +149,324 @@ class FolderBucket(Bucket):
 
     def delete(self):
         shutil.rmtree(self.abspath)
+        self.deleted = True
 
+        if self.service.index is not None:
+            self.service.index.clear(self)
+
+    @instrumented('list', 'LIST')
     def list(self, prefix=None, max_keys=None, **kwargs):
-        return [FileCubby(self, key) for key in os.listdir(self.abspath)]
+        keys = self._indexed_keys(prefix, max_keys)
+
+        if keys is None:
+            keys = itertools.islice(self.keys(prefix), max_keys)
+
+        return [FileCubby(self, key) for key in keys]
+
+    def keys(self, prefix=None):
+        """Yields every key under prefix in sorted order, like S3, skipping the backend's own files."""
+        for key, entry in self._walk(prefix):
+            yield key
+
+    def scan(self, prefix=None):
+        for key, entry in self._walk(prefix):
+            stat = entry.stat()
+            yield KeyInfo(key, stat.st_size, None, stat.st_mtime, None)
+
+    def _walk(self, prefix=None):
+        prefix = prefix or ''
+        top = os.path.dirname(prefix)
+
+        def sort_key(entry):
+            # directories sort as their keys would: 'a.txt' < 'a/b'
+            return entry.name + '/' if entry.is_dir(follow_symlinks=False) else entry.name
+
+        def walk(relpath):
+            try:
+                entries = sorted(os.scandir(os.path.join(self.abspath, relpath)), key=sort_key)
+            except FileNotFoundError:
+                return
+
+            for entry in entries:
+                is_dir = entry.is_dir(follow_symlinks=False)
+
+                if internal(entry.name, is_dir):
+                    continue
+
+                key = posixpath.join(relpath, entry.name)
+
+                if is_dir:
+                    if key.startswith(prefix[:len(key)]):
+                        yield from walk(key)
+                elif key.startswith(prefix):
+                    yield key, entry
+
+        yield from walk(top)
+
+    def lock_path(self, key):
+        """Returns the lock file guarding key, shared with the other keys in its stripe."""
+        stripe = zlib.crc32(key.encode('utf-8')) % self.service.lock_stripes
+        folder = hashlib.sha1(self.abspath.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.service.lock_folder, folder, '{}.lock'.format(stripe))
+
+    def sweep(self, rules=None, dry_run=False):
+        """Applies lifecycle rules (by default, this bucket's WAREHOUSE_FILE_LIFECYCLE) now."""
+        from ..lifecycle import lifecycle_rules, sweep
+
+        if rules is None:
+            rules = lifecycle_rules(self.service.lifecycle).get(self.name, [])
+
+        return sweep(self, rules, batch_size=self.service.lifecycle_batch_size, pause=self.service.lifecycle_pause,
+                     dry_run=dry_run)
+
+    def presigned_post(self, key, expiration=Cubby.DefaultUploadExpiration, content_type=None, max_size=None):
+        return {
+            'url': self.cubby(key).upload_url(expiration, content_type=content_type, max_size=max_size),
+            'fields': {},
+        }
 
 
 class FileCubby(Cubby):
+    __slots__ = ('content_type', 'acl')
+
     def __init__(self, bucket: FolderBucket, name: str, content_type=None, acl='public-read'):
         super().__init__(bucket, name)
 
-        if not os.path.isdir(self.dirpath()):
-            os.makedirs(self.dirpath())
-
         self.content_type = content_type
         self.acl = acl
 
     def dirpath(self):
         return os.path.dirname(self.filepath())
 
+    def makedirs(self):
+        """Creates the folders for this cubby's file, which are only needed once it is written."""
+        os.makedirs(self.dirpath(), exist_ok=True)
+
     def filepath(self):
         return os.path.join(self.bucket.abspath, self.key)
 
+    def temporary_path(self):
+        """A unique hidden path beside the file, to write to before replacing it in one step."""
+        return os.path.join(self.dirpath(), '.{}.{}.tmp'.format(os.path.basename(self.key), uuid.uuid4().hex))
+
+    def lock(self, shared=False):
+        """
+        Returns a context manager holding this key's lock, e.g. for a read-modify-write.
+
+        Stores and deletes take the lock themselves (nesting inside an exclusive lock is
+        fine, but raises inside a shared one); retrieves never wait for it, as files are
+        only ever replaced whole.
+        """
+        return file_lock(self.bucket.lock_path(self.key), shared=shared)
+
+    def _replace(self, contents_path, checksums_path=None):
+        """Moves written contents (and checksums, if any) into place, under the key's lock."""
+        with self.lock():
+            # without checksums a reader skips verifying, so never pair new contents with old ones
+            try:
+                os.remove(self.checksumpath())
+            except FileNotFoundError:
+                pass
+
+            os.replace(contents_path, self.filepath())
+
+            if checksums_path is not None:
+                os.replace(checksums_path, self.checksumpath())
+
     def keypath(self):
         return os.path.join(self.bucket.name, self.key)
 
+    @instrumented('url')
     def url(self, duration=Cubby.DefaultUrlExpiration):
         return url_for('static', filename=self.keypath(), _external=True)
 
-    def store_filelike(self, filelike):
-        shutil.copyfileobj(filelike, open(self.filepath(), 'wb'))
+    def upload_url(self, expiration=Cubby.DefaultUploadExpiration, content_type=None, max_size=None):
+        token = sign_upload(self.bucket.name, self.key, expiration,
+                            content_type=content_type or self.content_type,
+                            max_size=max_size)
+
+        return url_for('warehouse_uploads.upload', token=token, _external=True)
+
+    def checksumpath(self):
+        return os.path.join(self.dirpath(), '.' + os.path.basename(self.key) + '.checksums')
+
+    def stored_checksums(self):
+        try:
+            with open(self.checksumpath()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _open_with_checksums(self):
+        """
+        Opens the file, returning it with the checksums stored for those very contents.
+
+        A store may replace the file after it is opened, and the checksums with it, so
+        they are only trusted if the file in place is still the one opened; otherwise it is
+        opened again, and after a few attempts returned with no checksums to verify.
+        """
+        for _ in range(CONSISTENT_READ_ATTEMPTS):
+            file = open(self.filepath(), 'rb')
+            stored = self.stored_checksums()
+            opened = os.fstat(file.fileno())
+
+            try:
+                current = os.stat(self.filepath())
+            except FileNotFoundError:
+                current = None
+
+            if current is not None and (current.st_ino, current.st_dev) == (opened.st_ino, opened.st_dev):
+                return file, stored
+
+            file.close()
+
+        logger.warning("%s kept being replaced while it was read, so it was not verified", self)
+        return open(self.filepath(), 'rb'), {}
+
+    @instrumented('store', 'PUT')
+    def store_filelike(self, filelike, content_type=None, content_encoding=None, metadata=None):
+        # files carry no headers, so only the contents are kept
+        checksums = self.service.checksums
+        hashing = None
+
+        if checksums:
+            size = source_size(filelike)
+            filelike = hashing = HashingReader(filelike, checksums,
+                                               threaded=size is None or size >= THREADED_HASHING_SIZE)
+
+        self.makedirs()
+
+        # written aside and moved into place, so readers never see a partial file
+        temporary = self.temporary_path()
+        checksums_temporary = self.temporary_path() if checksums else None
+
+        try:
+            try:
+                file = open(temporary, 'xb')
+            except FileNotFoundError:
+                self.makedirs()  # a lifecycle sweep pruned the emptied folder meanwhile
+                file = open(temporary, 'xb')
+
+            with file:
+                shutil.copyfileobj(filelike, file)
+
+            if checksums:
+                with open(checksums_temporary, 'x') as f:
+                    json.dump(filelike.hasher.hexdigests(), f)
+
+            self._replace(temporary, checksums_temporary)
+        finally:
+            if hashing is not None:
+                hashing.close()
+
+            for path in [temporary, checksums_temporary]:
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
 
+        self._indexed_store()
+
+    @instrumented('retrieve', 'GET')
     def retrieve_filelike(self, filelike):
-        shutil.copyfileobj(open(self.filepath(), 'rb'), filelike)
+        file, stored = self._open_with_checksums()
+        algorithms = available(stored)
+
+        with file:
+            if not algorithms:
+                return shutil.copyfileobj(file, filelike)
+
+            size = os.fstat(file.fileno()).st_size
+
+            with HashingWriter(filelike, algorithms, threaded=size >= THREADED_HASHING_SIZE) as target:
+                shutil.copyfileobj(file, target)
+
+        verify(self, stored, target.hasher.hexdigests(), policy=self.service.checksum_mismatch)
+
+    def headers(self):
+        return dict(content_type=self.content_type or mimetypes.guess_type(self.key)[0])
 
+    @instrumented('delete', 'DELETE')
     def delete(self):
-        if self.exists():
-            os.remove(self.filepath())
+        with self.lock():
+            for path in [self.filepath(), self.checksumpath()]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+        self._indexed_delete()
 
         return not self.exists()
 
     def filesize(self):
         return os.path.getsize(self.filepath())
 
+    def stored_size(self):
+        return self.filesize() if self.exists() else None
+
+    def _store_from(self, filelike, background, headers, if_changed=False):
+        source = _file_stat(filelike) if if_changed and not background else None
+        stored = super()._store_from(filelike, background, headers, if_changed)
+
+        # keep the source's modification time, so the next store can skip it unhashed
+        if source is not None and stored is not None:
+            os.utime(self.filepath(), ns=(source.st_atime_ns, source.st_mtime_ns))
+
+        return stored
+
+    def _changed_contents(self, filelike, headers):
+        """Like rsync, takes a file of the same size and modification time as unchanged, else hashes it."""
+        source = _file_stat(filelike)
+
+        if source is not None:
+            try:
+                stored = os.stat(self.filepath())
+            except FileNotFoundError:
+                return filelike
+
+            if (stored.st_size, stored.st_mtime_ns) == (source.st_size, source.st_mtime_ns):
+                return None
+
+        return super()._changed_contents(filelike, headers)
+
+    def same_contents(self, md5):
+        return self.stored_md5() == md5
+
+    def stored_md5(self):
+        return self.stored_checksums().get('md5') or hash_file(self.filepath())
+
     def service_id(self):
         return "file"
 
+    @instrumented('exists', 'HEAD')
     def exists(self):
         return os.path.isfile(self.filepath())
 
+    @instrumented('info', 'HEAD')
+    def info(self):
+        stat = os.stat(self.filepath())
+        return KeyInfo(self.key, stat.st_size, None, stat.st_mtime, self.headers()['content_type'])
+
+    @instrumented('copy', 'COPY')
     def copy_to_native_cubby(self, cubby=None):
-        shutil.copy(self.filepath(), cubby.filepath())
+        cubby.makedirs()
+
+        temporary = cubby.temporary_path()
+        checksums_temporary = None
+
+        try:
+            shutil.copy(self.filepath(), temporary)
+
+            if os.path.exists(self.checksumpath()):
+                checksums_temporary = cubby.temporary_path()
+                shutil.copy(self.checksumpath(), checksums_temporary)
+
+            cubby._replace(temporary, checksums_temporary)
+        finally:
+            for path in [temporary, checksums_temporary]:
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+
+        cubby._indexed_store()
 
 
 FileService.__bucket_class__ = FolderBucket
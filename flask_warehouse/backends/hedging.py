@@ -0,0 +1,284 @@
+import collections
+import contextvars
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def retryable(error):
+    """Whether an error is the backend's fault (so worth retrying), rather than the request's."""
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+
+    if isinstance(error, ClientError):
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        code = error.response.get('Error', {}).get('Code')
+        return status >= 500 or status == 429 or code in ('SlowDown', 'Throttling', 'RequestTimeout')
+
+    return False
+
+
+class LatencyTracker:
+    """Keeps the latest durations of each operation, to tell when a request is unusually slow."""
+
+    def __init__(self, window=1000, min_samples=20):
+        self.min_samples = min_samples
+
+        self._durations = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def record(self, operation, duration):
+        with self._lock:
+            self._durations[operation].append(duration)
+
+    def percentile(self, operation, percentile):
+        """Returns the given percentile of recent durations, or None until there are enough of them."""
+        with self._lock:
+            durations = sorted(self._durations[operation])
+
+        if len(durations) < self.min_samples:
+            return None
+
+        return durations[min(len(durations) - 1, int(len(durations) * percentile / 100))]
+
+
+class RetryBudget:
+    """
+    Limits retries and hedges to a fraction of requests, so a struggling backend isn't swamped.
+
+    Every request earns 'ratio' of a token, and the budget also refills at 'per_second'
+    tokens a second so quiet services can still retry; each extra attempt spends a token.
+    """
+
+    def __init__(self, ratio=0.1, per_second=10):
+        self.ratio = ratio
+        self.per_second = per_second
+        self.capacity = max(per_second, 1)
+
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, tokens=0):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + tokens + (now - self._updated) * self.per_second)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill(self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            self._refill()
+
+            if self._tokens < 1:
+                return False
+
+            self._tokens -= 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    Fails fast after 'failures' consecutive backend errors, until 'reset_timeout' seconds pass.
+
+    After the timeout one trial request is let through; its success closes the circuit.
+    """
+
+    def __init__(self, failures=5, reset_timeout=30):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+
+        self._consecutive = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self._opened is not None
+
+    def allow(self):
+        with self._lock:
+            if self._opened is None:
+                return True
+
+            if not self._trial and time.monotonic() - self._opened >= self.reset_timeout:
+                self._trial = True
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._opened = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive += 1
+            self._trial = False
+
+            if self._consecutive >= self.failures:
+                self._opened = time.monotonic()
+
+
+class HedgingPolicy:
+    """
+    Runs idempotent reads so a slow response doesn't set the latency.
+
+    A read still outstanding after the operation's recent 'percentile' latency gets a
+    duplicate, and whichever answers first wins. Failed reads are retried up to
+    'max_attempts'. Duplicates and retries both spend from a RetryBudget, and each
+    bucket has a CircuitBreaker. The losing duplicate is cancelled if it hasn't started,
+    otherwise its result is passed to 'close' once it arrives.
+    """
+
+    def __init__(self, percentile=95, initial_delay=0.05, max_attempts=3, budget_ratio=0.1,
+                 circuit_failures=5, circuit_reset_timeout=30, max_workers=32):
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.max_attempts = max_attempts
+
+        self.tracker = LatencyTracker()
+        self.budget = RetryBudget(ratio=budget_ratio)
+        self.circuit_failures = circuit_failures
+        self.circuit_reset_timeout = circuit_reset_timeout
+
+        self.hedges = 0
+        self.retries = 0
+
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='warehouse-hedge')
+
+    def breaker(self, bucket):
+        with self._lock:
+            if bucket not in self._breakers:
+                self._breakers[bucket] = CircuitBreaker(self.circuit_failures, self.circuit_reset_timeout)
+
+            return self._breakers[bucket]
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def call(self, bucket, operation, fn, close=None):
+        """
+        Returns fn(), hedged and retried; fn must be safe to run more than once at a time.
+
+        close, if given, releases a result that lost the race (e.g. closes a response body).
+        """
+        breaker = self.breaker(bucket)
+        self.budget.deposit()
+
+        for attempt in range(1, self.max_attempts + 1):
+            if not breaker.allow():
+                raise CircuitOpenError("Too many failures from {} - not trying again yet.".format(bucket))
+
+            try:
+                result = self._hedged(operation, fn, close)
+            except Exception as e:
+                if not retryable(e):
+                    breaker.record_success()  # the backend answered; the request was at fault
+                    raise
+
+                breaker.record_failure()
+
+                if attempt == self.max_attempts or not self.budget.withdraw():
+                    raise
+
+                self._count('retries')
+                continue
+
+            breaker.record_success()
+            return result
+
+    def _submit(self, fn):
+        return self._executor.submit(contextvars.copy_context().run, fn)
+
+    @staticmethod
+    def _abandon(future, close):
+        """Cancels a losing request, or releases its result once it finishes."""
+        if future.cancel() or close is None:
+            return
+
+        def finished(future):
+            if future.exception() is None:
+                close(future.result())
+
+        future.add_done_callback(finished)
+
+    def _hedged(self, operation, fn, close):
+        start = time.perf_counter()
+        first = self._submit(fn)
+
+        delay = self.tracker.percentile(operation, self.percentile)
+
+        try:
+            result = first.result(timeout=self.initial_delay if delay is None else delay)
+        except TimeoutError:
+            pass
+        else:
+            self.tracker.record(operation, time.perf_counter() - start)
+            return result
+
+        if not self.budget.withdraw():
+            result = first.result()
+            self.tracker.record(operation, time.perf_counter() - start)
+            return result
+
+        self._count('hedges')
+        pending = {first, self._submit(fn)}
+        error = None
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    self.tracker.record(operation, time.perf_counter() - start)
+
+                    for loser in pending | (done - {future}):
+                        self._abandon(loser, close)
+
+                    return future.result()
+
+                error = future.exception()
+
+        raise error
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def hedging_policy(config):
+    """Returns the process-wide HedgingPolicy for the app's settings, or None unless WAREHOUSE_S3_HEDGING is set."""
+    if not config.get('WAREHOUSE_S3_HEDGING', False):
+        return None
+
+    settings = dict(percentile=config.get('WAREHOUSE_S3_HEDGE_PERCENTILE', 95),
+                    initial_delay=config.get('WAREHOUSE_S3_HEDGE_INITIAL_DELAY', 0.05),
+                    max_attempts=config.get('WAREHOUSE_S3_HEDGE_MAX_ATTEMPTS', 3),
+                    budget_ratio=config.get('WAREHOUSE_S3_RETRY_BUDGET_RATIO', 0.1),
+                    circuit_failures=config.get('WAREHOUSE_S3_CIRCUIT_FAILURES', 5),
+                    circuit_reset_timeout=config.get('WAREHOUSE_S3_CIRCUIT_RESET_TIMEOUT', 30),
+                    max_workers=config.get('WAREHOUSE_S3_HEDGE_MAX_WORKERS', 32))
+
+    key = tuple(sorted(settings.items()))
+
+    with _policies_lock:
+        if key not in _policies:
+            _policies[key] = HedgingPolicy(**settings)
+
+        return _policies[key]
@@ -0,0 +1,259 @@
+import gzip
+import hashlib
+import threading
+import time
+
+from collections import namedtuple
+
+from flask import Flask
+
+from ..checksums import ALGORITHMS, Hasher
+from ..index import key_index
+from ..metrics import instrumented
+from .service import Bucket, Cubby, KeyInfo, Service
+
+
+# Everything stored for one key. Objects are replaced, never changed, so a reader
+# holding one never sees a half-finished write.
+StoredObject = namedtuple('StoredObject', ['data', 'content_type', 'content_encoding', 'metadata', 'acl',
+                                           'etag', 'mtime'])
+
+CHUNK_SIZE = 1024 * 1024
+
+# every memory:// bucket in this process, as (objects, lock) by (location, name). A deleted
+# bucket's entry is kept, emptied, so handles made before and after its deletion share it.
+_buckets = {}
+_existing = set()
+_buckets_lock = threading.Lock()
+
+
+class MemoryService(Service):
+    """
+    Keeps buckets in this process's memory, for tests, benchmarks and scratch data.
+
+    WAREHOUSE_MEMORY_LATENCY (seconds per request) and WAREHOUSE_MEMORY_BANDWIDTH
+    (bytes per second) make it behave like a remote store when measuring.
+    """
+
+    requires_location = False
+
+    def __init__(self, app: Flask, default_location=None):
+        super().__init__('memory', default_location=default_location,
+                         index=key_index(app.config.get('WAREHOUSE_INDEX_PATH')),
+                         app=app)
+
+        self.latency = app.config.get('WAREHOUSE_MEMORY_LATENCY', 0)
+        self.bandwidth = app.config.get('WAREHOUSE_MEMORY_BANDWIDTH')
+
+    def bucket_exists(self, name, location=None):
+        with _buckets_lock:
+            return (location or self.default_location, name) in _existing
+
+    def request(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def transmit(self, size):
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+
+class MemoryBucket(Bucket):
+    def __init__(self, service: MemoryService, name: str, location: str):
+        super().__init__(service, name, location)
+
+        with _buckets_lock:
+            self.objects, self.lock = _buckets.setdefault((location, name), ({}, threading.Lock()))
+            _existing.add((location, name))
+
+    def __str__(self):
+        return "{}{}/{}".format(self.service, self.location or '', self.name)
+
+    def cubby(self, name, content_type=None, acl='public-read'):
+        return MemoryCubby(self, name, content_type=content_type, acl=acl)
+
+    def delete(self):
+        self.service.request()
+
+        with _buckets_lock:
+            _existing.discard((self.location, self.name))
+
+        with self.lock:
+            self.objects.clear()
+
+        self.deleted = True
+
+        if self.service.index is not None:
+            self.service.index.clear(self)
+
+    @instrumented('list', 'LIST')
+    def list(self, prefix=None, max_keys=None, **kwargs):
+        keys = self._indexed_keys(prefix, max_keys)
+
+        if keys is None:
+            keys = [info.key for _, info in zip(range(max_keys or len(self.objects)), self.scan(prefix))]
+
+        return [MemoryCubby(self, key) for key in keys]
+
+    def scan(self, prefix=None):
+        self.service.request()
+
+        prefix = prefix or ''
+        items = sorted((key, stored) for key, stored in list(self.objects.items()) if key.startswith(prefix))
+
+        for key, stored in items:
+            yield KeyInfo(key, len(stored.data), stored.etag, stored.mtime, stored.content_type)
+
+
+class MemoryCubby(Cubby):
+    __slots__ = ('content_type', 'acl')
+
+    def __init__(self, bucket: MemoryBucket, name, content_type=None, acl=None):
+        super().__init__(bucket, name)
+
+        self.content_type = content_type
+        self.acl = acl
+
+    def _stored(self):
+        self.service.request()
+
+        stored = self.bucket.objects.get(self.key)
+        if stored is None:
+            raise FileNotFoundError("{} does not exist.".format(self))
+
+        return stored
+
+    def _put(self, stored: StoredObject):
+        """Replaces the stored object; called holding the bucket's lock."""
+        self.bucket.objects[self.key] = stored
+        self._indexed_store()
+
+    @instrumented('store', 'PUT')
+    def store_filelike(self, filelike, content_type=None, content_encoding=None, metadata=None):
+        data = filelike.read()
+        self.service.request()
+        self.service.transmit(len(data))
+
+        if self.service.checksums:
+            hasher = Hasher(self.service.checksums)
+            hasher.update(data)
+            metadata = dict(metadata or {}, **hasher.hexdigests())
+
+        # under the lock, so a concurrent update_headers() can't put back what this replaces
+        with self.bucket.lock:
+            # like S3Cubby, keep the headers already stored unless new ones are given
+            previous = self.bucket.objects.get(self.key)
+            content_type = content_type or self.content_type or (previous.content_type if previous else None)
+            content_encoding = content_encoding or (previous.content_encoding if previous else None)
+
+            if content_encoding == 'gzip':
+                data = gzip.compress(data)
+
+            self._put(StoredObject(bytes(data), content_type, content_encoding, dict(metadata or {}), self.acl,
+                                   hashlib.md5(data).hexdigest(), time.time()))
+
+        return self.url()
+
+    @instrumented('retrieve', 'GET')
+    def retrieve_filelike(self, filelike):
+        stored = self._stored()
+        data = gzip.decompress(stored.data) if stored.content_encoding == 'gzip' else stored.data
+
+        view = memoryview(data)
+        for offset in range(0, len(view), CHUNK_SIZE):
+            chunk = view[offset:offset + CHUNK_SIZE]
+            self.service.transmit(len(chunk))
+            filelike.write(chunk)
+
+    def url(self, expiration=Cubby.DefaultUrlExpiration):
+        return str(self)
+
+    def upload_url(self, expiration=Cubby.DefaultUploadExpiration, content_type=None, max_size=None):
+        raise Exception("memory:// cubbies can't be uploaded to over HTTP.")
+
+    @instrumented('delete', 'DELETE')
+    def delete(self):
+        self.service.request()
+        self.bucket.objects.pop(self.key, None)
+        self._indexed_delete()
+        return not self.exists()
+
+    @instrumented('exists', 'HEAD')
+    def exists(self):
+        self.service.request()
+        return self.key in self.bucket.objects
+
+    def filesize(self, reload=True):
+        return len(self._stored().data)
+
+    def stored_size(self):
+        return self.filesize() if self.exists() else None
+
+    def is_encoded(self):
+        return bool(self._stored().content_encoding)
+
+    def same_contents(self, md5):
+        return self.stored_md5() == md5
+
+    def stored_md5(self):
+        stored = self._stored()
+        return stored.metadata.get('md5', None if stored.content_encoding else stored.etag)
+
+    @instrumented('metadata', 'HEAD')
+    def metadata(self, reload=True):
+        return dict(self._stored().metadata)
+
+    @instrumented('mimetype', 'HEAD')
+    def mimetype(self, reload=True):
+        return self._stored().content_type
+
+    def content_encoding(self, reload=True):
+        return self._stored().content_encoding
+
+    @instrumented('headers', 'HEAD')
+    def headers(self):
+        stored = self._stored()
+        return dict(content_type=stored.content_type, content_encoding=stored.content_encoding,
+                    metadata=dict(stored.metadata))
+
+    def set_mimetype(self, mimetype):
+        self.update_headers(content_type=mimetype)
+        return mimetype
+
+    def set_content_encoding(self, content_encoding):
+        self.update_headers(content_encoding=content_encoding)
+        return content_encoding
+
+    def set_metadata(self, metadata: dict = {}):
+        self.update_headers(metadata=metadata)
+        return metadata
+
+    @instrumented('update_headers', 'COPY')
+    def update_headers(self, content_type=None, content_encoding=None, metadata=None, acl=None):
+        with self.bucket.lock:
+            stored = self._stored()
+
+            if metadata is not None:
+                # as on S3, the checksums of the unchanged contents survive new metadata
+                checksums = {name: value for name, value in stored.metadata.items() if name in ALGORITHMS}
+                metadata = dict(checksums, **metadata)
+
+            self._put(stored._replace(content_type=content_type or stored.content_type,
+                                      content_encoding=content_encoding or stored.content_encoding,
+                                      metadata=stored.metadata if metadata is None else metadata,
+                                      acl=acl or self.acl or stored.acl))
+
+    @instrumented('info', 'HEAD')
+    def info(self):
+        stored = self._stored()
+        return KeyInfo(self.key, len(stored.data), stored.etag, stored.mtime, stored.content_type)
+
+    @instrumented('copy', 'COPY')
+    def copy_to_native_cubby(self, cubby=None):
+        stored = self._stored()
+
+        with cubby.bucket.lock:
+            cubby._put(stored._replace(mtime=time.time()))
+
+
+MemoryService.__bucket_class__ = MemoryBucket
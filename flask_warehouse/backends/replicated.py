@@ -0,0 +1,403 @@
+import collections
+import contextvars
+import heapq
+import io
+import os
+import queue
+import threading
+import time
+
+from flask import Flask, current_app, has_app_context
+
+from ..metrics import logger
+from ..transfer import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_CHUNKS, Pipe
+from .service import Bucket, Cubby, Service
+
+
+class QuorumError(Exception):
+    pass
+
+
+def replica_failed(error):
+    """
+    Whether an error counts against a replica's health: transport and server errors do, but
+    a missing key (normal until a repair) or a request the backend refused does not.
+    """
+    if isinstance(error, FileNotFoundError):
+        return False
+
+    # botocore's ClientError, without importing it for replicas that aren't on S3
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        code = response.get('Error', {}).get('Code')
+        return status >= 500 or status == 429 or code in ('SlowDown', 'Throttling', 'RequestTimeout')
+
+    return True
+
+
+def _md5(info):
+    """The md5 of a listed key's contents if its ETag is one (not a multipart upload's), else None."""
+    return info.etag if info.etag and '-' not in info.etag else None
+
+
+class ReplicaHealth:
+    """
+    Tracks each replica bucket's recent read latency (as a moving average) and failures.
+
+    A replica that failed within the last 'penalty' seconds is tried after the others.
+    Only the 'max_buckets' most recently used buckets are tracked.
+    """
+
+    def __init__(self, penalty=30, smoothing=0.2, max_buckets=1024):
+        self.penalty = penalty
+        self.smoothing = smoothing
+        self.max_buckets = max_buckets
+
+        self._latency = collections.OrderedDict()
+        self._failed = {}
+        self._lock = threading.Lock()
+
+    def record(self, replica, duration):
+        bucket = str(replica.bucket)
+
+        with self._lock:
+            previous = self._latency.pop(bucket, None)
+            self._latency[bucket] = duration if previous is None else \
+                previous + self.smoothing * (duration - previous)
+            self._failed.pop(bucket, None)
+
+            while len(self._latency) > self.max_buckets:
+                self._failed.pop(self._latency.popitem(last=False)[0], None)
+
+    def fail(self, replica):
+        with self._lock:
+            self._failed[str(replica.bucket)] = time.monotonic()
+
+            # failures expire, so only those still penalized are worth keeping
+            if len(self._failed) > self.max_buckets:
+                now = time.monotonic()
+                self._failed = {bucket: failed for bucket, failed in self._failed.items()
+                                if now - failed < self.penalty}
+
+    def healthy(self, replica):
+        failed = self._failed.get(str(replica.bucket))
+        return failed is None or time.monotonic() - failed >= self.penalty
+
+    def ranked(self, replicas):
+        """Orders replicas healthy first, then fastest first; ones never read from count as fastest."""
+        return sorted(replicas, key=lambda replica: (not self.healthy(replica),
+                                                     self._latency.get(str(replica.bucket), 0)))
+
+
+class RepairQueue:
+    """
+    Copies keys to the replicas that missed them, on a background thread.
+
+    Failed repairs are logged; the last 'max_failures' are kept in 'failures'.
+    """
+
+    def __init__(self, max_failures=100):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        self.failures = collections.deque(maxlen=max_failures)
+
+    def submit(self, src, dst):
+        app = current_app._get_current_object() if has_app_context() else None
+
+        with self._lock:
+            # threads do not survive a fork, so each process starts its own
+            if self._thread is None or self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._work, name='warehouse-repair', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+        self._queue.put((src, dst, app))
+
+    def flush(self):
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            src, dst, app = self._queue.get()
+
+            try:
+                if app is None:
+                    src.copy_to(cubby=dst)
+                else:
+                    with app.app_context():
+                        src.copy_to(cubby=dst)
+            except Exception as e:
+                logger.exception("Repairing %s from %s failed", dst, src)
+                self.failures.append((src, dst, e))
+            finally:
+                self._queue.task_done()
+
+
+class ReplicatedService(Service):
+    """
+    Writes every key to several buckets at once, reading it back from the fastest that has it.
+
+    WAREHOUSE_REPLICATED_TARGETS lists where replicas live as 'service://location'
+    prefixes (e.g. ['s3://us-west-1', 's3://eu-west-1', 'file://']); a replicated bucket
+    is the bucket of the same name under each. A store succeeds once
+    WAREHOUSE_REPLICATED_WRITE_QUORUM replicas (by default a majority) have it; the
+    rest are repaired in the background.
+    """
+
+    requires_location = False
+
+    def __init__(self, app: Flask, default_location=None):
+        super().__init__('replicated', default_location=default_location, app=app)
+
+        self.targets = app.config.get('WAREHOUSE_REPLICATED_TARGETS')
+        if not self.targets:
+            raise Exception("'WAREHOUSE_REPLICATED_TARGETS' is not set!")
+
+        self.write_quorum = app.config.get('WAREHOUSE_REPLICATED_WRITE_QUORUM', len(self.targets) // 2 + 1)
+        if not 0 < self.write_quorum <= len(self.targets):
+            raise Exception("'WAREHOUSE_REPLICATED_WRITE_QUORUM' must be between 1 and {}.".format(len(self.targets)))
+
+        self.warehouse = app.extensions['warehouse']
+
+        # per app, as their replicas and repairs have nothing to do with another app's
+        self.health = ReplicaHealth()
+        self.repairs = RepairQueue()
+
+    def flush_repairs(self):
+        """Blocks until every queued repair has been attempted."""
+        self.repairs.flush()
+
+
+class ReplicatedBucket(Bucket):
+    def __init__(self, service: ReplicatedService, name: str, location: str):
+        super().__init__(service, name, location)
+
+        self.replicas = [service.warehouse('{}/{}'.format(target, name)) for target in service.targets]
+
+    def cubby(self, name, **kwargs):
+        return ReplicatedCubby(self, name)
+
+    def delete(self):
+        for replica in self.replicas:
+            for cubby in replica.list():
+                cubby.delete()
+
+            replica.delete()
+
+        self.deleted = True
+
+    def list(self, prefix=None, max_keys=None):
+        return [ReplicatedCubby(self, info.key) for _, info in zip(range(max_keys or 2 ** 63), self.scan(prefix))]
+
+    def scan(self, prefix=None):
+        """Every key any replica has, in key order."""
+        previous = None
+
+        for info in heapq.merge(*[replica.scan(prefix) for replica in self.replicas], key=lambda info: info.key):
+            if info.key != previous:
+                yield info
+
+            previous = info.key
+
+    def repair(self, prefix=None):
+        """
+        Copies each key under prefix to the replicas missing it or holding different contents.
+
+        Contents differ when their sizes do, or their ETags where both replicas list an md5.
+        The copy comes from the replica with the newest version. Returns the repaired cubbies.
+        """
+        repaired = []
+        scans = [replica.scan(prefix) for replica in self.replicas]
+        current = [next(scan, None) for scan in scans]
+
+        while any(info is not None for info in current):
+            key = min(info.key for info in current if info is not None)
+            holding = {i: info for i, info in enumerate(current) if info is not None and info.key == key}
+
+            newest = max(holding, key=lambda i: holding[i].mtime)
+            for i, replica in enumerate(self.replicas):
+                if i not in holding or self._differ(holding[i], holding[newest]):
+                    repaired.append(self.replicas[newest].cubby(key).copy_to(cubby=replica.cubby(key)))
+
+            for i in holding:
+                current[i] = next(scans[i], None)
+
+        return repaired
+
+    @staticmethod
+    def _differ(info, newest):
+        if info.size != newest.size:
+            return True
+
+        md5, newest_md5 = _md5(info), _md5(newest)
+        return md5 is not None and newest_md5 is not None and md5 != newest_md5
+
+
+class ReplicatedCubby(Cubby):
+    __slots__ = ('replicas',)
+
+    def __init__(self, bucket: ReplicatedBucket, name):
+        super().__init__(bucket, name)
+
+        self.replicas = [replica.cubby(name) for replica in bucket.replicas]
+
+    def store_filelike(self, filelike, content_type=None, content_encoding=None, metadata=None):
+        """
+        Reads filelike once, streaming it to every replica at the same time through bounded pipes.
+
+        Returns once the source is read and a write quorum of replicas has the contents;
+        replicas that failed are queued for repair from one that succeeded.
+        """
+        headers = dict(content_type=content_type, content_encoding=content_encoding, metadata=metadata)
+        headers = {name: value for name, value in headers.items() if value is not None}
+
+        pipes = [Pipe(max_chunks=DEFAULT_MAX_CHUNKS) for _ in self.replicas]
+        results = [None] * len(self.replicas)
+        finished = threading.Condition()
+
+        def store(i):
+            try:
+                self.replicas[i].store_filelike(io.BufferedReader(pipes[i].reader, DEFAULT_CHUNK_SIZE), **headers)
+                outcome = True
+            except BaseException as e:
+                outcome = e
+            finally:
+                pipes[i].abort()  # so the source is never left waiting on this replica
+
+            with finished:
+                results[i] = outcome
+                finished.notify_all()
+
+        for i in range(len(self.replicas)):
+            threading.Thread(target=contextvars.copy_context().run, args=(store, i),
+                             name='warehouse-replicate-{}'.format(i), daemon=True).start()
+
+        open_pipes = list(pipes)
+        error = None
+
+        try:
+            for chunk in iter(lambda: filelike.read(DEFAULT_CHUNK_SIZE), b''):
+                for pipe in list(open_pipes):
+                    try:
+                        pipe.put(chunk)
+                    except BrokenPipeError:
+                        open_pipes.remove(pipe)  # that replica failed; the others carry on
+
+                if not open_pipes:
+                    break
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            for pipe in open_pipes:
+                try:
+                    pipe.close(error=error)
+                except BrokenPipeError:
+                    pass
+
+        quorum = self.service.write_quorum
+
+        with finished:
+            finished.wait_for(lambda: sum(result is True for result in results) >= quorum
+                              or all(result is not None for result in results))
+
+            succeeded = [i for i, result in enumerate(results) if result is True]
+
+        if len(succeeded) < quorum:
+            errors = [result for result in results if isinstance(result, BaseException)]
+            raise QuorumError("Only {} of {} replicas stored {} (needed {}): {}".format(
+                len(succeeded), len(self.replicas), self, quorum, errors))
+
+        def repair_stragglers():
+            with finished:
+                finished.wait_for(lambda: all(result is not None for result in results))
+
+            for i, result in enumerate(results):
+                if result is not True:
+                    if replica_failed(result):
+                        self.service.health.fail(self.replicas[i])
+
+                    self.service.repairs.submit(self.replicas[succeeded[0]], self.replicas[i])
+
+        if all(result is not None for result in results):
+            repair_stragglers()
+        else:
+            threading.Thread(target=contextvars.copy_context().run, args=(repair_stragglers,),
+                             name='warehouse-replicate-wait', daemon=True).start()
+
+    def _ranked(self):
+        return self.service.health.ranked(self.replicas)
+
+    def retrieve_filelike(self, filelike):
+        start_position = filelike.tell() if filelike.seekable() else None
+        error = None
+
+        for replica in self._ranked():
+            start = time.perf_counter()
+
+            try:
+                replica.retrieve_filelike(filelike)
+            except Exception as e:
+                if replica_failed(e):
+                    self.service.health.fail(replica)
+
+                error = e
+
+                if start_position is None:
+                    raise  # can't take back what was already written
+
+                filelike.seek(start_position)
+                filelike.truncate()
+                continue
+
+            self.service.health.record(replica, time.perf_counter() - start)
+            return
+
+        raise error
+
+    def _first(self, method, *args):
+        """Calls method on the best replica that answers."""
+        error = None
+
+        for replica in self._ranked():
+            try:
+                return getattr(replica, method)(*args)
+            except Exception as e:
+                if replica_failed(e):
+                    self.service.health.fail(replica)
+
+                error = e
+
+        raise error
+
+    def headers(self):
+        return self._first('headers')
+
+    def info(self):
+        return self._first('info')
+
+    def filesize(self):
+        return self._first('filesize')
+
+    def url(self, expiration=Cubby.DefaultUrlExpiration):
+        return self._first('url', expiration)
+
+    def exists(self):
+        return any(replica.exists() for replica in self.replicas)
+
+    def delete(self):
+        for replica in self.replicas:
+            replica.delete()
+
+        return not self.exists()
+
+    def copy_to_native_cubby(self, cubby=None):
+        for src, dst in zip(self.replicas, cubby.replicas):
+            src.copy_to(cubby=dst)
+
+
+ReplicatedService.__bucket_class__ = ReplicatedBucket
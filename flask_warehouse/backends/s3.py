@@ -1,51 +1,217 @@
 import gzip
+import os
+import threading
 
+from contextlib import closing
 from tempfile import SpooledTemporaryFile
 
 from flask import Flask
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
-from .service import Bucket, Cubby, Service
+from ..checksums import ALGORITHMS, THREADED_HASHING_SIZE, HashingWriter, available, spool_checksums, verify
+from ..index import key_index
+from ..metrics import CountingReader, backend_request, connected, instrumented
+from .hedging import hedging_policy
+from .service import Bucket, Cubby, KeyInfo, Service
+
+
+# how the backend_request signal names each S3 operation
+S3_REQUESTS = {
+    'HeadObject': 'HEAD',
+    'HeadBucket': 'HEAD',
+    'GetObject': 'GET',
+    'PutObject': 'PUT',
+    'CreateMultipartUpload': 'PUT',
+    'UploadPart': 'PUT',
+    'CompleteMultipartUpload': 'PUT',
+    'ListObjects': 'LIST',
+    'ListObjectsV2': 'LIST',
+    'ListBuckets': 'LIST',
+    'CopyObject': 'COPY',
+    'UploadPartCopy': 'COPY',
+    'DeleteObject': 'DELETE',
+    'DeleteObjects': 'DELETE',
+}
+
+# the credentials verify_connection() has already checked in this process
+_verified = set()
+
+
+def client_settings(config):
+    """Returns the botocore Config options for S3 clients from the app's WAREHOUSE_S3_* settings."""
+    return dict(max_pool_connections=config.get('WAREHOUSE_S3_MAX_POOL_CONNECTIONS', 64),
+                connect_timeout=config.get('WAREHOUSE_S3_CONNECT_TIMEOUT', 10),
+                read_timeout=config.get('WAREHOUSE_S3_READ_TIMEOUT', 60),
+                retries={'mode': config.get('WAREHOUSE_S3_RETRY_MODE', 'standard'),
+                         'max_attempts': config.get('WAREHOUSE_S3_MAX_ATTEMPTS', 3)},
+                tcp_keepalive=config.get('WAREHOUSE_S3_TCP_KEEPALIVE', True))
+
+
+class S3Connection:
+    """
+    One session and client per process for a set of credentials, region and Config.
+
+    The client (and its connection pool) is thread-safe and shared by every thread;
+    resources aren't, so each thread gets its own, built on the same session.
+    """
+
+    def __init__(self, aws_access_key_id, aws_secret_access_key, region_name, config: Config):
+        self.config = config
+        self.region_name = region_name
+
+        self.session = boto3.Session(aws_access_key_id=aws_access_key_id,
+                                     aws_secret_access_key=aws_secret_access_key,
+                                     region_name=region_name)
+
+        # boto3 sessions aren't safe to create clients from concurrently
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self.client = self._instrument(self.session.client('s3', config=config))
+
+    def resource(self):
+        resource = getattr(self._local, 'resource', None)
+
+        if resource is None:
+            with self._lock:
+                resource = self.session.resource('s3', config=self.config)
+
+            self._instrument(resource.meta.client)
+            self._local.resource = resource
+
+        return resource
+
+    def _instrument(self, client):
+        client.meta.events.register('provide-client-params.s3.*', self._note_bucket)
+        client.meta.events.register('before-call.s3.*', self._count_request)
+        return client
+
+    @staticmethod
+    def _note_bucket(params, context, **kwargs):
+        context['warehouse_bucket'] = params.get('Bucket')
+
+    def _count_request(self, model, context, **kwargs):
+        if connected(backend_request):
+            bucket = context.get('warehouse_bucket')
+            backend_request.send(self, service='s3', request=S3_REQUESTS.get(model.name, model.name),
+                                 bucket='s3://{}/{}'.format(self.region_name, bucket) if bucket else '')
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def s3_connection(aws_access_key_id, aws_secret_access_key, region_name, settings):
+    """Returns this process's S3Connection for the given credentials, region and client_settings()."""
+    # forked workers must not share their parent's sockets, so the process is part of the key
+    key = (os.getpid(), aws_access_key_id, aws_secret_access_key, region_name, repr(sorted(settings.items())))
+
+    with _connections_lock:
+        if key not in _connections:
+            _connections[key] = S3Connection(aws_access_key_id, aws_secret_access_key, region_name,
+                                             Config(**settings))
+
+        return _connections[key]
 
 
 class S3Service(Service):
     def __init__(self, app: Flask, aws_access_key_id=None, aws_secret_access_key=None, default_location=None):
-        super().__init__('s3', default_location=default_location)
+        super().__init__('s3', default_location=default_location,
+                         index=key_index(app.config.get('WAREHOUSE_INDEX_PATH')),
+                         app=app)
 
-        self.session = boto3.Session(aws_access_key_id=aws_access_key_id,
-                                     aws_secret_access_key=aws_secret_access_key,
-                                     region_name=default_location)
+        self.connection = s3_connection(aws_access_key_id, aws_secret_access_key, default_location,
+                                        client_settings(app.config))
+
+        self.session = self.connection.session
+        self.client = self.connection.client
+
+        self.multipart_copy_threshold = app.config.get('WAREHOUSE_S3_MULTIPART_COPY_THRESHOLD', 512 * 1024 ** 2)
+        self.multipart_copy_chunksize = app.config.get('WAREHOUSE_S3_MULTIPART_COPY_CHUNKSIZE', 64 * 1024 ** 2)
+
+        # hedged, retried reads for objects up to hedge_max_size; None unless WAREHOUSE_S3_HEDGING is set
+        self.hedging = hedging_policy(app.config)
+        self.hedge_max_size = app.config.get('WAREHOUSE_S3_HEDGE_MAX_SIZE', 8 * 1024 ** 2)
 
-        self.s3 = boto3.resource('s3')
-        self.client = boto3.client('s3')
+        if app.config.get('WAREHOUSE_S3_VERIFY_CONNECTION', False):
+            self.verify_connection()
+
+    @property
+    def s3(self):
+        """This thread's S3 resource."""
+        return self.connection.resource()
+
+    def bucket_exists(self, name, location=None):
+        try:
+            self.client.head_bucket(Bucket=name)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchBucket'):
+                return False
+            raise
+
+        return True
+
+    def verify_connection(self):
+        """Checks the credentials with a ListBuckets call, once per process for each set of them."""
+        credentials = self.session.get_credentials()
+        identity = (credentials.access_key if credentials else None, self.default_location)
+
+        if identity in _verified:
+            return
 
         try:
             self.client.list_buckets()
         except Exception:
             raise Exception("Failed to connect to S3 - ensure that AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY are both set.")
 
+        _verified.add(identity)
+
 
 class S3Bucket(Bucket):
     def __init__(self, service: S3Service, name: str, location: str):
         super().__init__(service, name, location)
 
-        self._bucket: boto3.s3.bucket.Bucket = self.service.s3.Bucket(name)
+        self._local = threading.local()
+        self.create()
 
+    def create(self):
+        """Creates the bucket, unless it already exists."""
         try:
-            bucket_configuration = {'LocationConstraint': location}
+            bucket_configuration = {'LocationConstraint': self.location}
             self._bucket.create(CreateBucketConfiguration=bucket_configuration)
         except ClientError:
             pass
 
+    @property
+    def _bucket(self) -> 'boto3.s3.bucket.Bucket':
+        """This thread's boto3 Bucket, as handles are cached and may be shared between threads."""
+        bucket = getattr(self._local, 'bucket', None)
+
+        if bucket is None:
+            bucket = self._local.bucket = self.service.s3.Bucket(self.name)
+
+        return bucket
+
     def cubby(self, name, content_type=None, acl='public-read'):
         return S3Cubby(self, name, content_type=content_type, acl=acl)
 
     def delete(self):
         self._bucket.delete()
+        self.deleted = True
 
+        if self.service.index is not None:
+            self.service.index.clear(self)
+
+    @instrumented('list')
     def list(self, prefix=None, max_keys=None, **kwargs):
+        keys = self._indexed_keys(prefix, max_keys)
+        if keys is not None:
+            return [S3Cubby(self, key) for key in keys]
+
         if prefix is not None:
             kwargs['Prefix'] = prefix
         if max_keys is not None:
@@ -55,6 +221,11 @@ class S3Bucket(Bucket):
 
         return [S3Cubby(self, key.key) for key in keys]
 
+    def scan(self, prefix=None):
+        for summary in self._bucket.objects.filter(Prefix=prefix or ''):
+            yield KeyInfo(summary.key, summary.size, summary.e_tag.strip('"'),
+                          summary.last_modified.timestamp(), None)
+
     def __eq__(self, other):
         if not isinstance(other, S3Bucket):
             return False
@@ -69,20 +240,58 @@ class S3Bucket(Bucket):
 
         self._bucket.copy({"Bucket":src_bucket_name, "Key": src_key}, dst_key)
 
+    def presigned_post(self, key, expiration=Cubby.DefaultUploadExpiration, content_type=None, max_size=None,
+                       acl=None):
+        fields = {}
+        conditions = []
+
+        if content_type:
+            fields['Content-Type'] = content_type
+            conditions.append({'Content-Type': content_type})
+
+        if acl:
+            fields['acl'] = acl
+            conditions.append({'acl': acl})
+
+        if max_size is not None:
+            conditions.append(['content-length-range', 0, max_size])
+
+        return self.service.client.generate_presigned_post(self.name, key,
+                                                           Fields=fields,
+                                                           Conditions=conditions,
+                                                           ExpiresIn=int(expiration.total_seconds()))
+
 
 class S3Cubby(Cubby):
+    __slots__ = ('content_type', 'acl', '_object')
+
     def __init__(self, bucket: S3Bucket, name, content_type=None, acl=None, key=None):
-        super().__init__(bucket, name)
+        super().__init__(bucket, name if key is None else key.key)
 
         self.content_type = content_type
+        self.acl = acl
 
-        if key is None:
-            self._key = self.bucket._bucket.Object(name)
-        else:
-            self._key = key
-            self.key = self._key.nameG
+        self._object = key
 
-        self.acl = acl
+    @property
+    def _key(self):
+        """
+        This thread's boto3 Object, created on first use.
+
+        Cubbies are handed between threads (transfers, replication, the CLI), so an Object
+        made on another thread's resource is made again on this one's, keeping the headers
+        already loaded.
+        """
+        bucket = self.bucket._bucket
+        key = self._object
+
+        if key is None or key.meta.client is not bucket.meta.client:
+            loaded = key.meta.data if key is not None else None
+            key = bucket.Object(self.key)
+            key.meta.data = loaded
+            self._object = key
+
+        return key
 
     @staticmethod
     def apply_func_filelike(filelike, fn):
@@ -102,48 +311,109 @@ class S3Cubby(Cubby):
         # seek back to the start so the filelike object is usable
         filelike.seek(0)
 
-    def store_filelike(self, filelike, tempcopy=False):
-        if tempcopy:
+    @instrumented('store')
+    def store_filelike(self, filelike, tempcopy=False, content_type=None, content_encoding=None, metadata=None):
+        if self.service.checksums:
+            # S3 needs the metadata before the upload starts, so hash while spooling
+            filelike, checksums = spool_checksums(filelike, self.service.checksums)
+            metadata = dict(metadata or {}, **checksums)
+        elif tempcopy:
             copy = SpooledTemporaryFile()  # boto3 now closes the file.
             copy.write(filelike.read())
             copy.seek(0)
 
             filelike = copy
 
+        # only fall back to the stored headers when the caller didn't give them ('' for none)
+        if (content_type is None and self.content_type is None) or content_encoding is None:
+            if self._reload_if_exists():
+                content_type = content_type or self.content_type or self._key.content_type
+                content_encoding = content_encoding or self._key.content_encoding
+
+        content_type = content_type or self.content_type
+
         ExtraArgs = {}
 
         if self.acl:
             ExtraArgs['ACL'] = self.acl
 
-        new_content_type = self.content_type
-        existing_content_type = (self.exists() and self.mimetype()) or None
-        if new_content_type or existing_content_type:
-            ExtraArgs['ContentType'] = new_content_type or existing_content_type
+        if content_type:
+            ExtraArgs['ContentType'] = content_type
+
+        if content_encoding:
+            ExtraArgs['ContentEncoding'] = content_encoding
+
+        if content_encoding == "gzip":
+            if not filelike.seekable():
+                copy = SpooledTemporaryFile()
+                copy.write(filelike.read())
+                copy.seek(0)
+
+                filelike = copy
 
-        if self.exists() and self.content_encoding() == "gzip":
             self.apply_func_filelike(filelike, fn=gzip.compress)
-            ExtraArgs['ContentEncoding'] = self.content_encoding(reload=False)
 
-        self._key.upload_fileobj(filelike, ExtraArgs=ExtraArgs)
+        if metadata is not None:
+            ExtraArgs['Metadata'] = metadata
+
+        position = filelike.tell() if filelike.seekable() else None
+
+        try:
+            # boto3 closes what it uploads, so it gets a pass-through wrapper and filelike stays open to retry
+            self._key.upload_fileobj(CountingReader(filelike), ExtraArgs=ExtraArgs)
+        except ClientError as e:
+            # the bucket was deleted since this (cached) handle created it, so create it again
+            if e.response['Error']['Code'] != 'NoSuchBucket' or position is None:
+                raise
+
+            self.bucket.create()
+            filelike.seek(position)
+            self._key.upload_fileobj(filelike, ExtraArgs=ExtraArgs)
+
+        self._indexed_store()
 
         return self.url()
 
+    @instrumented('retrieve')
     def retrieve_filelike(self, filelike):
         if filelike.closed:
             raise Exception("File provided was already closed.")
 
-        self._key.download_fileobj(filelike)
+        content_encoding = self.content_encoding()
+
+        stored = {name: value for name, value in (self._key.metadata or {}).items() if name in ALGORITHMS}
+        algorithms = available(stored)
+
+        target = filelike
+        if algorithms:
+            target = HashingWriter(filelike, algorithms,
+                                   threaded=self._key.content_length >= THREADED_HASHING_SIZE)
+
+        try:
+            if content_encoding == "gzip":
+                compressed = SpooledTemporaryFile()
+                self._download(compressed)
+
+                compressed.seek(0)
+                target.write(gzip.decompress(compressed.read()))
+            else:
+                self._download(target)
+        finally:
+            if target is not filelike:
+                target.close()  # stops its hashing thread, even if the download failed
+
+        if algorithms:
+            verify(self, stored, target.hasher.hexdigests(), policy=self.service.checksum_mismatch)
 
         # when ContentEncoding is set, 'download_fileobj' seems to read the filelike
         # object, so that's why the next line is needed, there's an open issue on moto for that
         # ref: https://github.com/spulec/moto/issues/2926
-        filelike.seek(0)
-
-        if self.content_encoding() == "gzip":
-            self.apply_func_filelike(filelike, fn=gzip.decompress)
+        if filelike.seekable():
+            filelike.seek(0)
 
         return
 
+    @instrumented('url')
     def url(self, expiration=Cubby.DefaultUrlExpiration):
         service: S3Service = self.bucket.service
         result = service.client.generate_presigned_url('get_object',
@@ -159,55 +429,110 @@ class S3Cubby(Cubby):
 
         return result
 
+    def upload_url(self, expiration=Cubby.DefaultUploadExpiration, content_type=None, max_size=None):
+        if max_size is not None:
+            raise Exception("S3 cannot limit the size of a PUT upload - use S3Bucket.presigned_post() instead.")
+
+        params = {"Bucket": self.bucket.name, "Key": self.key}
+
+        content_type = content_type or self.content_type
+        if content_type:
+            params['ContentType'] = content_type
+
+        if self.acl:
+            params['ACL'] = self.acl
+
+        service: S3Service = self.bucket.service
+        return service.client.generate_presigned_url('put_object',
+                                                     Params=params,
+                                                     ExpiresIn=int(expiration.total_seconds()))
+
+    @instrumented('delete')
     def delete(self):
         self._key.delete()
+        self._indexed_delete()
         return not self.exists()
 
     def filesize(self, reload=True):
         if reload:
-            self._key.reload()
+            self._reload()
 
         return self._key.content_length
 
+    def stored_size(self):
+        return self._key.content_length if self._reload_if_exists() else None
+
+    def is_encoded(self):
+        return bool(self._key.content_encoding)
+
+    def _changed_contents(self, filelike, headers):
+        contents = super()._changed_contents(filelike, headers)
+
+        # store_filelike() keeps the stored headers the caller didn't give; hand it those the
+        # HEAD above found ('' for none, or no object), so it needn't make a second HEAD
+        if contents is not None:
+            exists = self._key.meta.data is not None
+            headers.setdefault('content_type', (self._key.content_type if exists else None) or '')
+            headers.setdefault('content_encoding', (self._key.content_encoding if exists else None) or '')
+
+        return contents
+
+    def same_contents(self, md5):
+        return self._loaded_md5() == md5
+
+    @instrumented('checksum', 'HEAD')
+    def stored_md5(self):
+        self._reload()
+        return self._loaded_md5()
+
+    def _loaded_md5(self):
+        stored_md5 = (self._key.metadata or {}).get('md5')
+        if stored_md5:
+            return stored_md5
+
+        # a plain upload's ETag is its MD5; multipart ETags have a '-' and aren't
+        etag = self._key.e_tag.strip('"')
+        return etag if '-' not in etag and not self._key.content_encoding else None
+
+    @instrumented('exists')
     def exists(self):
         matches = list(self.bucket._bucket.objects.filter(Prefix=self.key))
         return len(matches) > 0 and matches[0].key == self.key
 
+    @instrumented('metadata')
     def metadata(self, reload=True):
         if reload:
-            self._key.reload()
+            self._reload()
 
         return self._key.metadata
 
+    @instrumented('mimetype')
     def mimetype(self, reload=True):
         if reload:
-            self._key.reload()
+            self._reload()
 
         return self._key.content_type
 
+    @instrumented('headers')
+    def headers(self):
+        self._reload()
+
+        return dict(content_type=self._key.content_type,
+                    content_encoding=self._key.content_encoding,
+                    metadata=self._key.metadata)
+
     def set_mimetype(self, mimetype):
         if not self.acl:
             raise Exception(
                 "S3Cubby's acl must be set or it will be removed by set_mimetype()!"
             )
 
-        args = dict(
-            CopySource={"Bucket": self.bucket.name, "Key": self.key},
-            MetadataDirective="REPLACE",
-            ACL=self.acl,
-            ContentType=mimetype,
-        )
-
-        if self.content_encoding():
-            args["ContentEncoding"] = self.content_encoding(reload=False)
-
-        self._key.copy_from(**args)
-
-        return self.mimetype()
+        self.update_headers(content_type=mimetype)
+        return self.mimetype(reload=False)
 
     def content_encoding(self, reload=True):
         if reload:
-            self._key.reload()
+            self._reload()
 
         return self._key.content_encoding
 
@@ -217,34 +542,120 @@ class S3Cubby(Cubby):
                 "S3Cubby's acl must be set or it will be removed by set_content_encoding()!"
             )
 
-        args = dict(
-            CopySource={"Bucket": self.bucket.name, "Key": self.key},
-            MetadataDirective="REPLACE",
-            ACL=self.acl,
-            ContentEncoding=content_encoding,
-        )
-
-        if self.mimetype():
-            args["ContentType"] = self.mimetype(reload=False)
-
-        self._key.copy_from(**args)
-        return self.content_encoding()
+        self.update_headers(content_encoding=content_encoding)
+        return self.content_encoding(reload=False)
 
     def set_metadata(self, metadata: dict = {}):
-        self._key.copy_from(CopySource={'Bucket': self.bucket.name, 'Key': self.key},
-                            MetadataDirective="REPLACE",
-                            Metadata=metadata)
-        self._key.reload()
+        self.update_headers(metadata=metadata)
         return metadata
 
+    @instrumented('update_headers')
+    def update_headers(self, content_type=None, content_encoding=None, metadata=None, acl=None):
+        """
+        Rewrites any of the object's headers with a single server-side copy.
+
+        Headers that aren't given keep their current values. Objects larger than the
+        service's multipart_copy_threshold are copied in parallel parts.
+        """
+        self._reload()
+
+        if metadata is None:
+            metadata = self._key.metadata or {}
+        else:
+            # new metadata replaces the old, except for the checksums of the unchanged contents
+            checksums = {name: value for name, value in (self._key.metadata or {}).items() if name in ALGORITHMS}
+            metadata = dict(checksums, **metadata)
+
+        args = dict(MetadataDirective="REPLACE", Metadata=metadata)
+
+        content_type = content_type or self._key.content_type
+        if content_type:
+            args["ContentType"] = content_type
+
+        content_encoding = content_encoding or self._key.content_encoding
+        if content_encoding:
+            args["ContentEncoding"] = content_encoding
+
+        acl = acl or self.acl
+        if acl:
+            args["ACL"] = acl
+
+        data = dict(self._key.meta.data)
+        copy_source = {"Bucket": self.bucket.name, "Key": self.key}
+        service: S3Service = self.bucket.service
+
+        if self._key.content_length > service.multipart_copy_threshold:
+            config = TransferConfig(multipart_threshold=service.multipart_copy_threshold,
+                                    multipart_chunksize=service.multipart_copy_chunksize)
+            self._key.copy(copy_source, ExtraArgs=args, Config=config)
+        else:
+            self._key.copy_from(CopySource=copy_source, **args)
+
+        # we know everything a reload would tell us, so skip the extra HEAD
+        data.update(ContentType=content_type, ContentEncoding=content_encoding, Metadata=args["Metadata"])
+        self._key.meta.data = data
+
+        self._indexed_store()
+
+    def _reload(self):
+        """Fetches the object's headers with a HEAD, hedged when the service has a hedging policy."""
+        service: S3Service = self.bucket.service
+
+        if service.hedging is None:
+            return self._key.reload()
+
+        response = service.hedging.call(str(self.bucket), 'HEAD', lambda: service.client.head_object(
+            Bucket=self.bucket.name, Key=self.key))
+
+        response.pop('ResponseMetadata', None)
+        self._key.meta.data = response
+
+    def _download(self, filelike):
+        """
+        Downloads the contents into filelike; small objects are fetched whole, with hedging, if enabled.
+
+        Only the wait for the response is hedged - for small objects that is most of the time -
+        so the losing response's body can be closed unread.
+        """
+        service: S3Service = self.bucket.service
+
+        if service.hedging is None or self._key.content_length > service.hedge_max_size:
+            return self._key.download_fileobj(filelike)
+
+        response = service.hedging.call(str(self.bucket), 'GET', lambda: service.client.get_object(
+            Bucket=self.bucket.name, Key=self.key), close=lambda response: response['Body'].close())
+
+        with closing(response['Body']) as body:
+            filelike.write(body.read())
+
+    def _reload_if_exists(self):
+        try:
+            self._reload()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NoSuchBucket'):
+                self._key.meta.data = None  # forget what was loaded before it was deleted
+                return False
+            raise
+
+        return True
+
     def __eq__(self, other):
         if not isinstance(other, S3Cubby):
             return False
         
         return self.bucket == other.bucket and self.key == other.key
 
+    @instrumented('info')
+    def info(self):
+        self._reload()
+
+        return KeyInfo(self.key, self._key.content_length, self._key.e_tag.strip('"'),
+                       self._key.last_modified.timestamp(), self._key.content_type)
+
+    @instrumented('copy')
     def copy_to_native_cubby(self, cubby=None):
         cubby.bucket.copy_key(cubby.key, self.key, src_bucket_name=self.bucket.name)
+        cubby._indexed_store()
 
 
 S3Service.__bucket_class__ = S3Bucket
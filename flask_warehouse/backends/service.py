@@ -1,5 +1,18 @@
+import datetime
 import io
 import os
+import shutil
+
+from collections import namedtuple
+
+from ..background import pending_store, upload_queue
+from ..checksums import source_size, spool
+from ..metrics import cache_hit, logger
+from ..transfer import transfer, transfer_many
+
+
+# What a listing knows about a key without fetching it; etag and content_type may be None.
+KeyInfo = namedtuple('KeyInfo', ['key', 'size', 'etag', 'mtime', 'content_type'])
 
 
 class Service:
@@ -7,10 +20,15 @@ class Service:
 
     requires_location = True
 
-    def __init__(self, id, default_location=None):
+    def __init__(self, id, default_location=None, index=None, app=None):
         self.id = id
         self.default_location = default_location
-        print(f"Service: Set default location {default_location}")
+        self.index = index
+
+        config = app.config if app is not None else {}
+        self.checksums = tuple(config.get('WAREHOUSE_CHECKSUMS', ()))
+        self.checksum_mismatch = config.get('WAREHOUSE_CHECKSUM_MISMATCH', 'raise')
+        logger.debug("%s service created with default location %s", id, default_location)
 
     def __str__(self):
         return "{}://".format(self.id)
@@ -24,6 +42,10 @@ class Service:
 
         return self.__bucket_class__(self, name, location or self.default_location)
 
+    def bucket_exists(self, name, location=None):
+        """Whether the bucket exists, checked without creating it as bucket() may."""
+        return True
+
     def __eq__(self, other):
         if not isinstance(other, Service):
             return False
@@ -32,6 +54,9 @@ class Service:
 
 
 class Bucket:
+    # set by delete(), so cached handles of a deleted bucket aren't handed out again
+    deleted = False
+
     def __init__(self, service: Service, name: str, location: str):
         self.service = service
         self.name = name
@@ -52,8 +77,105 @@ class Bucket:
     def list(self, prefix=None, max_keys=None):
         raise NotImplementedError()
 
+    def scan(self, prefix=None):
+        """Lazily yields a KeyInfo for every key under prefix, in key order."""
+        raise NotImplementedError()
+
+    def count(self, prefix=None):
+        if self.service.index is not None:
+            return self.service.index.count(self, prefix)
+
+        return sum(1 for info in self.scan(prefix))
+
+    def total_size(self, prefix=None):
+        if self.service.index is not None:
+            return self.service.index.total_size(self, prefix)
+
+        return sum(info.size for info in self.scan(prefix))
+
+    def modified_since(self, mtime, prefix=None):
+        """Yields a KeyInfo for every key under prefix modified at or after the mtime timestamp."""
+        if self.service.index is not None:
+            return self.service.index.scan(self, prefix, modified_since=mtime)
+
+        return (info for info in self.scan(prefix) if info.mtime >= mtime)
+
+    def rebuild_index(self):
+        """Re-records this bucket in the service's key index from a full listing."""
+        if self.service.index is None:
+            raise Exception("'WAREHOUSE_INDEX_PATH' is not set!")
+
+        self.service.index.rebuild(self)
+
+    def content_addressed(self, refs_path):
+        """
+        Returns a view of this bucket that stores each distinct content only once.
+
+        refs_path is the SQLite database mapping keys to content digests; gc() deletes
+        blobs while holding its lock, so it must not also be WAREHOUSE_INDEX_PATH.
+        """
+        from .dedupe import ContentAddressedBucket
+
+        return ContentAddressedBucket(self, refs_path)
+
+    def _indexed_keys(self, prefix=None, max_keys=None):
+        """Returns the indexed keys under prefix, or None when the service keeps no index."""
+        if self.service.index is None:
+            return None
+
+        cache_hit.send(self, cache='index', bucket=str(self))
+        return [info.key for info in self.service.index.scan(self, prefix, max_keys=max_keys)]
+
+    def copy_prefix(self, prefix, bucket=None, dst_prefix=None, max_workers=8):
+        """
+        Copies every cubby under prefix into bucket (or this bucket), in parallel.
+
+        Keys keep their names unless dst_prefix is given, which replaces prefix.
+        """
+        return transfer_many(self._prefix_pairs(prefix, bucket, dst_prefix), max_workers=max_workers)
+
+    def move_prefix(self, prefix, bucket=None, dst_prefix=None, max_workers=8):
+        return transfer_many(self._prefix_pairs(prefix, bucket, dst_prefix), max_workers=max_workers, move=True)
+
+    def archive(self, prefix=None, format='zip', prefetch=4):
+        """
+        Yields a zip or tar.gz of every cubby under prefix as it is produced, without temp files.
+
+        e.g. Response(bucket.archive('reports/'), mimetype='application/zip')
+        """
+        from ..archive import archive
+
+        return archive(self, prefix, format=format, prefetch=prefetch)
+
+    def extract(self, stream, prefix=None, format='zip', max_workers=8):
+        """Stores each file of a zip or tar.gz stream under prefix, returning the cubbies."""
+        from ..archive import extract
+
+        return extract(self, stream, prefix, format=format, max_workers=max_workers)
+
+    def _prefix_pairs(self, prefix, bucket, dst_prefix):
+        bucket = bucket or self
+
+        if bucket == self and dst_prefix in (None, prefix):
+            raise Exception("Copying {} onto itself.".format(self))
+
+        pairs = []
+        for cubby in self.list(prefix=prefix):
+            key = cubby.key if dst_prefix is None else dst_prefix + cubby.key[len(prefix):]
+            pairs.append((cubby, bucket.cubby(key)))
+
+        return pairs
+
+    def presigned_post(self, key, expiration=None, content_type=None, max_size=None):
+        """Returns a {'url': ..., 'fields': {...}} form a client can POST a 'file' to directly."""
+        raise NotImplementedError()
+
 
 class Cubby:
+    # Cubbies are handles, often held by the hundred thousand, so each subclass
+    # declares its own __slots__ and builds any backend objects only when first used.
+    __slots__ = ('bucket', 'key')
+
     def __init__(self, bucket, key):
         self.bucket = bucket
         self.key = key
@@ -65,6 +187,15 @@ class Cubby:
         return "{}/{}".format(self.bucket, self.key)
 
     def retrieve(self, filepath=None, file=None):
+        pending = pending_store(self)
+        if pending is not None:
+            cache_hit.send(self, cache='staging', bucket=str(self.bucket))
+
+            try:
+                return self._retrieve_staged(pending, filepath=filepath, file=file)
+            except FileNotFoundError:
+                pass  # the upload finished while we were reading
+
         if filepath is not None:
             if os.path.isdir(filepath):
                 filepath = os.path.join(filepath, self.key)
@@ -79,32 +210,129 @@ class Cubby:
             buffer.seek(0)
             return buffer.read()
 
+    def _retrieve_staged(self, pending, filepath=None, file=None):
+        with open(pending.staging_path, 'rb') as staging:
+            if filepath is not None:
+                if os.path.isdir(filepath):
+                    filepath = os.path.join(filepath, self.key)
+
+                with open(filepath, 'wb') as file:
+                    shutil.copyfileobj(staging, file)
+            elif file is not None:
+                shutil.copyfileobj(staging, file)
+            else:
+                return staging.read()
+
     def retrieve_filelike(self, file):
         raise NotImplementedError()
 
-    def store(self, filepath=None, file=None, string=None, bytes=None, encoding='utf-8'):
+    def store(self, filepath=None, file=None, string=None, bytes=None, encoding='utf-8', background=False,
+              content_type=None, content_encoding=None, metadata=None, if_changed=False):
+        """
+        Stores contents from one of the given sources.
+
+        content_type, content_encoding and metadata are written along with the contents
+        on backends that keep headers. With background=True, the contents are staged
+        locally and uploaded by a worker thread; a PendingStore handle is returned
+        instead of the cubby. With if_changed=True, nothing is written when the stored
+        contents already match, and None is returned instead.
+        """
+        headers = dict(content_type=content_type, content_encoding=content_encoding, metadata=metadata)
+        headers = {name: value for name, value in headers.items() if value is not None}
+
         if filepath is not None:
             with open(filepath, 'rb') as file:
-                return self.store_filelike(file)
+                return self._store_from(file, background, headers, if_changed)
         elif file is not None:
-            self.store_filelike(file)
+            return self._store_from(file, background, headers, if_changed)
         elif string is not None:
-            self.store_filelike(io.BytesIO(string.encode(encoding)))
+            return self._store_from(io.BytesIO(string.encode(encoding)), background, headers, if_changed)
         elif bytes is not None:
-            self.store_filelike(io.BytesIO(bytes))
+            return self._store_from(io.BytesIO(bytes), background, headers, if_changed)
         else:
             raise Exception("One of [filepath, file, string, bytes] must be specified.")
 
+    def _store_from(self, filelike, background, headers, if_changed=False):
+        if if_changed:
+            filelike = self._changed_contents(filelike, headers)
+
+            if filelike is None:
+                return None
+
+        if background:
+            return upload_queue().submit(self, filelike, headers=headers)
+
+        self.store_filelike(filelike, **headers)
         return self
 
-    def store_filelike(self, filelike):
+    def _changed_contents(self, filelike, headers):
+        """Returns what to store from filelike, or None when this cubby already holds it."""
+        stored_size = self.stored_size()
+        size = source_size(filelike)
+
+        # a missing key or a different size needs no hashing to know it changed
+        if stored_size is None or (size is not None and size != stored_size and not self.is_encoded()):
+            return filelike
+
+        contents, md5 = spool(filelike)
+
+        if self.same_contents(md5):
+            contents.close()
+            return None
+
+        headers['metadata'] = dict(headers.get('metadata') or {}, md5=md5)
+        return contents
+
+    def stored_size(self):
+        """Returns the stored size in bytes, or None if nothing is stored."""
+        return None
+
+    def is_encoded(self):
+        """Whether the stored contents are encoded (e.g. gzipped), so stored_size() can't be compared."""
+        return False
+
+    def same_contents(self, md5):
+        """Whether the stored contents have the given MD5 hex digest."""
+        return False
+
+    def stored_md5(self):
+        """Returns the MD5 hex digest the backend keeps for the stored contents, or None if it keeps none."""
+        return None
+
+    def store_filelike(self, filelike, content_type=None, content_encoding=None, metadata=None):
+        raise NotImplementedError()
+
+    def headers(self):
+        """Returns the stored headers, as keyword arguments for store_filelike()."""
+        return {}
+
+    def update_headers(self, content_type=None, content_encoding=None, metadata=None, acl=None):
+        """Changes any of the stored headers at once, leaving the ones not given alone."""
+        raise NotImplementedError()
+
+    def info(self):
+        """Returns this cubby's KeyInfo, fetched from the backend."""
         raise NotImplementedError()
 
+    def _indexed_store(self):
+        if self.service.index is not None:
+            self.service.index.record(self.bucket, self.info())
+
+    def _indexed_delete(self):
+        if self.service.index is not None:
+            self.service.index.remove(self.bucket, self.key)
+
     DefaultUrlExpiration = None
 
     def url(self, expiration=DefaultUrlExpiration):
         raise NotImplementedError()
 
+    DefaultUploadExpiration = datetime.timedelta(hours=1)
+
+    def upload_url(self, expiration=DefaultUploadExpiration, content_type=None, max_size=None):
+        """Returns a URL a client can PUT this cubby's contents to without going through the app."""
+        raise NotImplementedError()
+
     def filesize(self):
         raise NotImplementedError()
 
@@ -126,8 +354,7 @@ class Cubby:
             self.copy_to_native_cubby(cubby)
             return cubby
 
-        cubby.store_filelike(self.retrieve_filelike())
-        return cubby
+        return transfer(self, cubby)
 
     def move_to(self, key=None, cubby=None):
         copy = self.copy_to(key=key, cubby=cubby)
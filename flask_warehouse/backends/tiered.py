@@ -0,0 +1,484 @@
+import contextvars
+import heapq
+import json
+import os
+import shutil
+import threading
+import time
+
+from collections import namedtuple
+
+from flask import Flask, current_app, has_app_context
+
+from ..background import upload_queue
+from ..index import LocalDatabase, local_database, prefix_range
+from ..metrics import logger
+from .file import FileService
+from .service import Bucket, Cubby, KeyInfo, Service
+
+
+# the fast tier keeps each tiered bucket in this folder of the app's static folder
+LOCAL_PREFIX = '.tiered/'
+
+Placement = namedtuple('Placement', ['bucket', 'name', 'key', 'size', 'generation', 'local', 'remote', 'accessed',
+                                     'content_type', 'content_encoding', 'metadata'])
+
+
+class PlacementIndex(LocalDatabase):
+    """
+    Records where each tiered key's contents are: the local tier, the capacity tier, or both.
+
+    Each local write bumps the key's generation, so a promotion that finishes after a
+    newer write can't mark the newer contents as safely in the capacity tier. Triggers
+    keep the total size of the local copies, so checking the budget is a single lookup.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS placements (
+        bucket TEXT NOT NULL,
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        generation INTEGER NOT NULL,
+        local INTEGER NOT NULL,
+        remote INTEGER NOT NULL,
+        accessed REAL NOT NULL,
+        content_type TEXT,
+        content_encoding TEXT,
+        metadata TEXT,
+        PRIMARY KEY (bucket, key)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS placements_local ON placements (local, accessed);
+
+    CREATE TABLE IF NOT EXISTS local_size (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        total INTEGER NOT NULL
+    );
+
+    INSERT OR IGNORE INTO local_size VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM placements WHERE local = 1));
+
+    CREATE TRIGGER IF NOT EXISTS placements_inserted AFTER INSERT ON placements BEGIN
+        UPDATE local_size SET total = total + NEW.local * NEW.size;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS placements_updated AFTER UPDATE OF local, size ON placements BEGIN
+        UPDATE local_size SET total = total - OLD.local * OLD.size + NEW.local * NEW.size;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS placements_deleted AFTER DELETE ON placements BEGIN
+        UPDATE local_size SET total = total - OLD.local * OLD.size;
+    END;
+    """
+
+    def lookup(self, bucket, key):
+        row = self._connection().execute('SELECT * FROM placements WHERE bucket = ? AND key = ?',
+                                         (str(bucket), key)).fetchone()
+
+        return Placement(*row) if row is not None else None
+
+    def record_local(self, bucket, key, size, headers, remote=False):
+        """Records a new local copy of key, returning its generation."""
+        with self.transaction() as connection:
+            row = connection.execute('SELECT generation FROM placements WHERE bucket = ? AND key = ?',
+                                     (str(bucket), key)).fetchone()
+            generation = row[0] + 1 if row is not None else 1
+
+            # not INSERT OR REPLACE, whose implicit delete wouldn't fire the triggers
+            if row is not None:
+                connection.execute('DELETE FROM placements WHERE bucket = ? AND key = ?', (str(bucket), key))
+
+            connection.execute('INSERT INTO placements VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?, ?)',
+                               (str(bucket), bucket.name, key, size, generation, int(remote), time.time(),
+                                headers.get('content_type'), headers.get('content_encoding'),
+                                json.dumps(headers.get('metadata') or {})))
+
+        return generation
+
+    def mark_remote(self, bucket, key, generation):
+        self._connection().execute('UPDATE placements SET remote = 1 WHERE bucket = ? AND key = ? AND generation = ?',
+                                   (str(bucket), key, generation))
+
+    def mark_evicted(self, bucket, key, generation):
+        """Marks a key's local copy as gone, returning False if it was rewritten since 'generation'."""
+        cursor = self._connection().execute('UPDATE placements SET local = 0 '
+                                            'WHERE bucket = ? AND key = ? AND generation = ?',
+                                            (str(bucket), key, generation))
+        return cursor.rowcount > 0
+
+    def touch(self, bucket, key):
+        self._connection().execute('UPDATE placements SET accessed = ? WHERE bucket = ? AND key = ?',
+                                   (time.time(), str(bucket), key))
+
+    def remove(self, bucket, key):
+        self._connection().execute('DELETE FROM placements WHERE bucket = ? AND key = ?', (str(bucket), key))
+
+    def clear(self, bucket):
+        self._connection().execute('DELETE FROM placements WHERE bucket = ?', (str(bucket),))
+
+    def local_size(self):
+        return self._connection().execute('SELECT total FROM local_size').fetchone()[0]
+
+    def unpromoted(self, bucket, prefix=None):
+        """Yields a KeyInfo for each key under prefix only in the local tier so far, in key order."""
+        query = 'SELECT key, size, accessed, content_type FROM placements WHERE bucket = ? AND remote = 0'
+        params = [str(bucket)]
+
+        low, high = prefix_range(prefix)
+        if low:
+            query += ' AND key >= ?'
+            params.append(low)
+        if high is not None:
+            query += ' AND key < ?'
+            params.append(high)
+
+        for key, size, accessed, content_type in self._connection().execute(query + ' ORDER BY key', params):
+            yield KeyInfo(key, size, None, accessed, content_type)
+
+    def evictable(self, limit=100):
+        """Returns promoted local copies, least recently used first."""
+        rows = self._connection().execute('SELECT * FROM placements WHERE local = 1 AND remote = 1 '
+                                          'ORDER BY accessed LIMIT ?', (limit,))
+        return [Placement(*row) for row in rows]
+
+
+# the tiered buckets whose unpromoted keys this process has queued, by (pid, placements path, bucket)
+_requeued = set()
+_requeued_lock = threading.Lock()
+
+
+class TieredService(Service):
+    """
+    A fast local tier in front of a durable capacity tier (S3 by default).
+
+    Writes land in the local tier and are promoted to the capacity tier by the
+    background UploadQueue, each retried WAREHOUSE_TIERED_PROMOTION_RETRIES times;
+    keys left unpromoted (e.g. by a restart) are queued again when a process first
+    uses their bucket. Reads are served locally when possible, else fetched
+    and kept locally again. Local copies already promoted are evicted in the background,
+    least recently used first, to keep the local tier within WAREHOUSE_TIERED_DISK_BUDGET
+    bytes, and once unread for WAREHOUSE_TIERED_MAX_AGE seconds.
+    """
+
+    requires_location = False
+
+    def __init__(self, app: Flask, default_location=None):
+        super().__init__('tiered', default_location=default_location, app=app)
+
+        config = app.config
+
+        if not config.get('WAREHOUSE_TIERED_INDEX_PATH'):
+            raise Exception("'WAREHOUSE_TIERED_INDEX_PATH' is not set!")
+
+        self.placements = local_database(PlacementIndex, config['WAREHOUSE_TIERED_INDEX_PATH'])
+        self.disk_budget = config.get('WAREHOUSE_TIERED_DISK_BUDGET', 1024 ** 3)
+        self.max_age = config.get('WAREHOUSE_TIERED_MAX_AGE')
+        self.promotion_retries = config.get('WAREHOUSE_TIERED_PROMOTION_RETRIES', 3)
+        self.promotion_backoff = config.get('WAREHOUSE_TIERED_PROMOTION_BACKOFF', 1.0)
+
+        warehouse = app.extensions.get('warehouse')
+        if warehouse is None:
+            raise Exception("tiered:// buckets need a Warehouse initialized on the app.")
+
+        capacity_service = warehouse.service_class(config.get('WAREHOUSE_TIERED_CAPACITY_SERVICE', 's3'))
+
+        self.local = FileService(app)
+        self.remote = capacity_service(app, default_location=config.get('WAREHOUSE_TIERED_CAPACITY_LOCATION',
+                                                                         default_location))
+
+        # the process evicting for this service (None when none is), and whether to go again
+        self._evicting = None
+        self._eviction_requested = False
+        self._eviction_finished = threading.Condition()
+
+    def requeue(self, bucket):
+        """Queues promotions, on a background thread, of the bucket's keys not yet in the capacity tier."""
+        key = (os.getpid(), self.placements.path, str(bucket))
+
+        with _requeued_lock:
+            if key in _requeued:
+                return
+
+            _requeued.add(key)
+
+        def promote_all():
+            for info in list(self.placements.unpromoted(bucket)):
+                cubby = bucket.cubby(info.key)
+                placement = cubby.placement()
+
+                try:
+                    if placement is not None and not placement.remote:
+                        cubby._promote(placement.generation, cubby.headers())
+                except FileNotFoundError:
+                    pass  # deleted meanwhile
+                except Exception:
+                    logger.exception("Queueing the promotion of %s failed", cubby)
+
+        threading.Thread(target=contextvars.copy_context().run, args=(promote_all,),
+                         name='warehouse-tiered-requeue', daemon=True).start()
+
+    def schedule_eviction(self):
+        """Runs evict() on a background thread, once for however many calls arrive while it runs."""
+        with self._eviction_finished:
+            self._eviction_requested = True
+
+            # threads do not survive a fork, so a parent's eviction doesn't count
+            if self._evicting == os.getpid():
+                return
+
+            self._evicting = os.getpid()
+
+        threading.Thread(target=self._evict_requested, name='warehouse-tiered-evict', daemon=True).start()
+
+    def _evict_requested(self):
+        while True:
+            with self._eviction_finished:
+                if not self._eviction_requested:
+                    self._evicting = None
+                    self._eviction_finished.notify_all()
+                    return
+
+                self._eviction_requested = False
+
+            try:
+                self.evict()
+            except Exception:
+                logger.exception("Evicting from the local tier failed")
+
+    def flush_evictions(self):
+        """Blocks until every scheduled eviction has run."""
+        with self._eviction_finished:
+            self._eviction_finished.wait_for(lambda: self._evicting != os.getpid())
+
+    def evict(self):
+        """Drops promoted local copies that are too old, or until within budget; returns how many were dropped."""
+        expired_before = time.time() - self.max_age if self.max_age is not None else None
+        dropped = set()
+
+        while True:
+            over_budget = self.placements.local_size() > self.disk_budget
+            candidates = [placement for placement in self.placements.evictable()
+                          if (placement.bucket, placement.key) not in dropped]
+
+            if not over_budget:
+                # least recently used come first, so expired copies are at the front
+                candidates = [placement for placement in candidates
+                              if expired_before is not None and placement.accessed < expired_before]
+
+            if not candidates:
+                return len(dropped)
+
+            for placement in candidates:
+                local = self.local.bucket(LOCAL_PREFIX + placement.name).cubby(placement.key)
+                dropped.add((placement.bucket, placement.key))
+
+                # writers record a new generation under the same lock, so a newer copy is never dropped
+                with local.lock():
+                    if self.placements.mark_evicted(placement.bucket, placement.key, placement.generation):
+                        local.delete()
+
+                if over_budget and self.placements.local_size() <= self.disk_budget:
+                    break
+
+
+class TieredBucket(Bucket):
+    def __init__(self, service: TieredService, name: str, location: str):
+        super().__init__(service, name, location)
+
+        self.local = service.local.bucket(LOCAL_PREFIX + name)
+        self.remote = service.remote.bucket(name, location)
+
+        service.requeue(self)
+
+    def cubby(self, name, **kwargs):
+        return TieredCubby(self, name)
+
+    def delete(self):
+        for info in list(self.scan()):
+            self.cubby(info.key).delete()
+
+        self.local.delete()
+        self.remote.delete()
+        self.service.placements.clear(self)
+        self.deleted = True
+
+    def list(self, prefix=None, max_keys=None):
+        return [TieredCubby(self, info.key) for _, info in zip(range(max_keys or 2 ** 63), self.scan(prefix))]
+
+    def scan(self, prefix=None):
+        """The capacity tier's keys, merged with keys not yet promoted to it."""
+        previous = None
+
+        for info in heapq.merge(self.service.placements.unpromoted(self, prefix), self.remote.scan(prefix),
+                                key=lambda info: info.key):
+            if info.key != previous:
+                yield info
+
+            previous = info.key
+
+
+class Promotion:
+    """
+    Copies a tiered cubby's local contents to the capacity tier, run by the UploadQueue.
+
+    A failed attempt is submitted again after a backoff, rather than holding up the queue's worker.
+    """
+
+    def __init__(self, cubby, generation, attempt=0):
+        self.cubby = cubby
+        self.generation = generation
+        self.attempt = attempt
+
+    def __str__(self):
+        return str(self.cubby.remote)
+
+    def store_filelike(self, filelike, **headers):
+        service = self.cubby.service
+        placement = service.placements.lookup(self.cubby.bucket, self.cubby.key)
+
+        if placement is None or placement.generation != self.generation:
+            return  # deleted or rewritten since; a newer promotion is queued if needed
+
+        try:
+            self.cubby.remote.store_filelike(filelike, **headers)
+        except Exception:
+            if self.attempt == service.promotion_retries:
+                logger.exception("Promoting %s failed; it stays in the local tier until requeued", self)
+                raise
+
+            logger.warning("Promoting %s failed, retrying", self, exc_info=True)
+            self._retry(headers, service.promotion_backoff * 2 ** self.attempt)
+            return
+
+        service.placements.mark_remote(self.cubby.bucket, self.cubby.key, self.generation)
+        service.schedule_eviction()
+
+    def _retry(self, headers, delay):
+        app = current_app._get_current_object() if has_app_context() else None
+
+        def resubmit():
+            try:
+                if app is None:
+                    self.cubby._promote(self.generation, headers, attempt=self.attempt + 1)
+                else:
+                    with app.app_context():
+                        self.cubby._promote(self.generation, headers, attempt=self.attempt + 1)
+            except FileNotFoundError:
+                pass  # deleted meanwhile
+            except Exception:
+                logger.exception("Queueing the promotion of %s again failed", self)
+
+        timer = threading.Timer(delay, resubmit)
+        timer.daemon = True
+        timer.start()
+
+
+class TieredCubby(Cubby):
+    __slots__ = ('local', 'remote')
+
+    def __init__(self, bucket: TieredBucket, name):
+        super().__init__(bucket, name)
+
+        self.local = bucket.local.cubby(name)
+        self.remote = bucket.remote.cubby(name)
+
+    def placement(self):
+        return self.service.placements.lookup(self.bucket, self.key)
+
+    def store_filelike(self, filelike, content_type=None, content_encoding=None, metadata=None):
+        headers = dict(content_type=content_type, content_encoding=content_encoding, metadata=metadata)
+        headers = {name: value for name, value in headers.items() if value is not None}
+
+        # the lock keeps an eviction of the previous generation from dropping these contents
+        with self.local.lock():
+            self.local.store_filelike(filelike)
+            generation = self.service.placements.record_local(self.bucket, self.key, self.local.filesize(),
+                                                              headers)
+
+        self._promote(generation, headers)
+
+    def _promote(self, generation, headers, attempt=0):
+        with open(self.local.filepath(), 'rb') as contents:
+            upload_queue().submit(Promotion(self, generation, attempt), contents, headers=headers)
+
+    def retrieve_filelike(self, filelike):
+        placement = self.placement()
+
+        if placement is not None and placement.local:
+            try:
+                with open(self.local.filepath(), 'rb') as contents:
+                    shutil.copyfileobj(contents, filelike)
+
+                self.service.placements.touch(self.bucket, self.key)
+                return
+            except FileNotFoundError:
+                pass  # evicted while we looked
+
+        self._warm()
+
+        with open(self.local.filepath(), 'rb') as contents:
+            shutil.copyfileobj(contents, filelike)
+
+    def _warm(self):
+        """Fetches the contents from the capacity tier back into the local tier."""
+        headers = self.remote.headers()
+        temporary = os.path.join(self.local.dirpath(), '.' + os.path.basename(self.key) + '.warming')
+        self.local.makedirs()
+
+        try:
+            with open(temporary, 'wb') as file:
+                self.remote.retrieve_filelike(file)
+
+            with self.local.lock():
+                os.replace(temporary, self.local.filepath())
+                self.service.placements.record_local(self.bucket, self.key, self.local.filesize(), headers,
+                                                     remote=True)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+        self.service.schedule_eviction()
+
+    def headers(self):
+        placement = self.placement()
+
+        if placement is None:
+            return self.remote.headers()
+
+        headers = dict(content_type=placement.content_type, content_encoding=placement.content_encoding,
+                       metadata=json.loads(placement.metadata or '{}'))
+        return {name: value for name, value in headers.items() if value}
+
+    def info(self):
+        placement = self.placement()
+
+        if placement is None:
+            return self.remote.info()
+
+        return KeyInfo(self.key, placement.size, None, placement.accessed, placement.content_type)
+
+    def url(self, expiration=Cubby.DefaultUrlExpiration):
+        placement = self.placement()
+
+        if placement is not None and not placement.remote:
+            return self.local.url(expiration)
+
+        return self.remote.url(expiration)
+
+    def filesize(self):
+        return self.info().size
+
+    def exists(self):
+        return self.placement() is not None or self.remote.exists()
+
+    def delete(self):
+        self.service.placements.remove(self.bucket, self.key)
+        self.local.delete()
+
+        if self.remote.exists():
+            self.remote.delete()
+
+        return not self.exists()
+
+
+TieredService.__bucket_class__ = TieredBucket
@@ -0,0 +1,206 @@
+import atexit
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+from flask import current_app, g, has_app_context
+
+
+class PendingStore:
+    """Status handle for a store running on the UploadQueue."""
+
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    SUPERSEDED = 'superseded'  # a newer store of the cubby was submitted first, so this one was skipped
+
+    def __init__(self, cubby, staging_path, headers=None, app=None):
+        self.cubby = cubby
+        self.staging_path = staging_path
+        self.headers = headers or {}
+        self.app = app
+
+        self.status = PendingStore.PENDING
+        self.exception = None
+
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Waits for the upload, returning the cubby or raising the upload's exception."""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Background store of {} did not finish in time.".format(self.cubby))
+
+        if self.exception is not None:
+            raise self.exception
+
+        return self.cubby
+
+    def __repr__(self):
+        return '<PendingStore {} {}>'.format(self.cubby, self.status)
+
+
+class UploadQueue:
+    """
+    Write-behind queue: stores are staged to a local file and uploaded by worker threads.
+
+    The queue is bounded, so submit() blocks once 'max_depth' uploads are waiting.
+    Until an upload finishes, Cubby.retrieve() in this process reads the staged copy.
+    Uploads of one cubby never overlap, and only its newest is made, so stores land in order.
+    """
+
+    def __init__(self, max_depth=64, workers=2, staging_dir=None):
+        self.staging_dir = staging_dir
+        self.workers = workers
+
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+        # the cubbies being uploaded, and a condition signalled as each finishes
+        self._uploading = set()
+        self._finished = threading.Condition(self._lock)
+
+    def submit(self, cubby, filelike, headers=None, timeout=None):
+        fd, staging_path = tempfile.mkstemp(prefix='warehouse-', dir=self.staging_dir)
+
+        with os.fdopen(fd, 'wb') as staging:
+            shutil.copyfileobj(filelike, staging)
+
+        app = current_app._get_current_object() if has_app_context() else None
+        handle = PendingStore(cubby, staging_path, headers=headers, app=app)
+
+        self._start()
+
+        with self._lock:
+            previous = self._pending.get(str(cubby))
+            self._pending[str(cubby)] = handle
+
+        try:
+            self._queue.put(handle, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                if self._pending.get(str(cubby)) is handle:
+                    self._pending[str(cubby)] = previous
+
+            os.remove(staging_path)
+            raise
+
+        if has_app_context():
+            g.setdefault('_warehouse_pending_stores', []).append(handle)
+
+        return handle
+
+    def pending(self, cubby):
+        """Returns the newest unfinished PendingStore for a cubby, if any."""
+        with self._lock:
+            return self._pending.get(str(cubby))
+
+    def flush(self):
+        """Blocks until every queued upload has finished."""
+        self._queue.join()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name='warehouse-upload-{}'.format(i), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            handle = self._queue.get()
+            key = str(handle.cubby)
+
+            with self._finished:
+                self._finished.wait_for(lambda: key not in self._uploading)
+
+                # an older store is skipped rather than landing over a newer one
+                superseded = self._pending.get(key) is not handle
+
+                if not superseded:
+                    self._uploading.add(key)
+
+            try:
+                if superseded:
+                    handle.status = PendingStore.SUPERSEDED
+                else:
+                    self._upload(handle)
+                    handle.status = PendingStore.DONE
+            except Exception as e:
+                handle.exception = e
+                handle.status = PendingStore.FAILED
+            finally:
+                with self._finished:
+                    if not superseded:
+                        self._uploading.discard(key)
+                        self._finished.notify_all()
+
+                    if self._pending.get(key) is handle:
+                        del self._pending[key]
+
+                os.remove(handle.staging_path)
+                handle._done.set()
+                self._queue.task_done()
+
+    def _upload(self, handle):
+        with open(handle.staging_path, 'rb') as staging:
+            if handle.app is None:
+                return handle.cubby.store_filelike(staging, **handle.headers)
+
+            with handle.app.app_context():
+                return handle.cubby.store_filelike(staging, **handle.headers)
+
+
+_upload_queue = None
+_upload_queue_pid = None
+_upload_queue_lock = threading.Lock()
+
+
+def upload_queue():
+    """Returns this process's UploadQueue, creating it from the current app's config."""
+    global _upload_queue, _upload_queue_pid
+
+    with _upload_queue_lock:
+        # worker threads do not survive a fork, so each process gets its own queue
+        if _upload_queue is None or _upload_queue_pid != os.getpid():
+            config = current_app.config if has_app_context() else {}
+
+            _upload_queue = UploadQueue(max_depth=config.get('WAREHOUSE_BACKGROUND_QUEUE_DEPTH', 64),
+                                        workers=config.get('WAREHOUSE_BACKGROUND_WORKERS', 2),
+                                        staging_dir=config.get('WAREHOUSE_STAGING_DIR'))
+            _upload_queue_pid = os.getpid()
+
+        return _upload_queue
+
+
+def pending_store(cubby):
+    if _upload_queue is None or _upload_queue_pid != os.getpid():
+        return None
+
+    return _upload_queue.pending(cubby)
+
+
+def flush():
+    if _upload_queue is not None and _upload_queue_pid == os.getpid():
+        _upload_queue.flush()
+
+
+def flush_context():
+    """Blocks until the stores queued in the current app context have finished, unlike flush()."""
+    if not has_app_context():
+        return
+
+    for handle in g.pop('_warehouse_pending_stores', []):
+        handle._done.wait()
+
+
+atexit.register(flush)
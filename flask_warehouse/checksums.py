@@ -0,0 +1,228 @@
+import hashlib
+import io
+import os
+import queue
+import shutil
+import threading
+import warnings
+
+from tempfile import SpooledTemporaryFile
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+
+SPOOL_SIZE = 8 * 1024 ** 2
+
+# contents at least this large are hashed on a separate thread, alongside the I/O
+THREADED_HASHING_SIZE = 8 * 1024 ** 2
+
+ALGORITHMS = ('md5', 'sha256', 'crc32c')
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class CRC32C:
+    """hashlib-style wrapper around the optional 'crc32c' package."""
+
+    def __init__(self):
+        if crc32c is None:
+            raise Exception("The 'crc32c' checksum requires the 'crc32c' package to be installed.")
+
+        self.value = 0
+
+    def update(self, data):
+        self.value = crc32c.crc32c(data, self.value)
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.value)
+
+
+def available(algorithms):
+    """Filters algorithms down to those this process can compute."""
+    return [algorithm for algorithm in algorithms
+            if algorithm in ALGORITHMS and (algorithm != 'crc32c' or crc32c is not None)]
+
+
+def new_hash(algorithm):
+    if algorithm not in ALGORITHMS:
+        raise Exception("Unknown checksum algorithm '{}', expected one of {}.".format(algorithm, ALGORITHMS))
+
+    return CRC32C() if algorithm == 'crc32c' else hashlib.new(algorithm)
+
+
+class Hasher:
+    """
+    Computes several checksums over a stream of chunks.
+
+    With threaded=True, chunks are hashed on a separate thread so hashing overlaps the
+    transfer (hashlib releases the GIL on large buffers); hexdigests() waits for it, and
+    close() (or leaving a with block) stops it should the transfer fail first.
+    """
+
+    def __init__(self, algorithms=('md5',), threaded=False):
+        self.hashes = {algorithm: new_hash(algorithm) for algorithm in algorithms}
+        self.size = 0
+
+        self._queue = None
+        self._thread = None
+
+        if threaded and self.hashes:
+            self._queue = queue.Queue(maxsize=32)
+            self._thread = threading.Thread(target=self._work, name='warehouse-hasher', daemon=True)
+            self._thread.start()
+
+    def _work(self):
+        for chunk in iter(self._queue.get, None):
+            self._update(chunk)
+
+    def _update(self, chunk):
+        for hash in self.hashes.values():
+            hash.update(chunk)
+
+    def update(self, chunk):
+        self.size += len(chunk)
+
+        if self._queue is not None:
+            self._queue.put(bytes(chunk))
+        else:
+            self._update(chunk)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def hexdigests(self):
+        self.close()
+
+        return {algorithm: hash.hexdigest() for algorithm, hash in self.hashes.items()}
+
+    def hexdigest(self, algorithm='md5'):
+        return self.hexdigests()[algorithm]
+
+
+class HashingReader(io.RawIOBase):
+    """Wraps a readable, hashing everything read through it."""
+
+    def __init__(self, filelike, algorithms=('md5',), threaded=False):
+        self.filelike = filelike
+        self.hasher = Hasher(algorithms, threaded=threaded)
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.hasher.close()
+        super().close()
+
+    def readinto(self, b):
+        data = self.filelike.read(len(b))
+
+        n = len(data)
+        b[:n] = data
+
+        self.hasher.update(data)
+
+        return n
+
+    def hexdigest(self, algorithm='md5'):
+        return self.hasher.hexdigest(algorithm)
+
+
+class HashingWriter(io.RawIOBase):
+    """Wraps a writable, hashing everything written through it."""
+
+    def __init__(self, filelike, algorithms=('md5',), threaded=False):
+        self.filelike = filelike
+        self.hasher = Hasher(algorithms, threaded=threaded)
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        self.hasher.close()
+        super().close()
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.filelike.write(data)
+
+
+def spool(filelike, algorithm='md5'):
+    """Copies filelike into a rewound temporary file in one pass, returning it and the contents' hash."""
+    copy, checksums = spool_checksums(filelike, (algorithm,))
+    return copy, checksums[algorithm]
+
+
+def spool_checksums(filelike, algorithms):
+    """Like spool(), but returns {algorithm: hexdigest} for each of algorithms."""
+    size = source_size(filelike)
+    copy = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+    with HashingReader(filelike, algorithms, threaded=size is None or size >= THREADED_HASHING_SIZE) as reader:
+        shutil.copyfileobj(reader, copy)
+
+    copy.seek(0)
+
+    return copy, reader.hasher.hexdigests()
+
+
+def verify(subject, expected: dict, actual: dict, policy='raise'):
+    """Compares the checksums both dicts have, handling a mismatch according to policy."""
+    mismatched = [algorithm for algorithm in expected
+                  if algorithm in actual and expected[algorithm] != actual[algorithm]]
+
+    if not mismatched or policy == 'ignore':
+        return not mismatched
+
+    message = "{} failed its {} checksum.".format(subject, ', '.join(mismatched))
+
+    if policy == 'warn':
+        warnings.warn(message)
+        return False
+
+    raise ChecksumMismatch(message)
+
+
+def hash_file(path, algorithm='md5'):
+    hash = hashlib.new(algorithm)
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hash.update(chunk)
+
+    return hash.hexdigest()
+
+
+def source_size(filelike):
+    """Returns how many bytes are left to read from filelike, or None if that can't be told cheaply."""
+    try:
+        return os.fstat(filelike.fileno()).st_size - filelike.tell()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+
+    try:
+        if filelike.seekable():
+            position = filelike.tell()
+            end = filelike.seek(0, io.SEEK_END)
+            filelike.seek(position)
+            return end - position
+    except (AttributeError, OSError):
+        pass
+
+    return None
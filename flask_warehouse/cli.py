@@ -0,0 +1,388 @@
+import contextvars
+import datetime
+import json
+import os
+import posixpath
+import sys
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import click
+
+from flask import current_app
+from flask.cli import AppGroup
+
+from .backends import Bucket
+
+
+warehouse_cli = AppGroup('warehouse', help="""Manage the app's storage.
+
+URIs are like s3://us-west-1/bucket/key. A bucket URI, or one ending in '/',
+stands for every key under that prefix.""")
+
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(size) < 1024 or unit == 'TB':
+            return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{} B'.format(size)
+
+        size /= 1024
+
+
+def _resolve(uri, create=False):
+    """
+    Returns (bucket, key, is_prefix) for a bucket or cubby URI.
+
+    Unless create is set, the bucket must exist already, so a mistyped source isn't created.
+    """
+    from .flask_warehouse import parse_uri
+
+    warehouse = current_app.extensions['warehouse']
+
+    try:
+        if not create:
+            service, location, name, _ = parse_uri(uri)
+
+            exists = warehouse._create_service(service=service, location=location).bucket_exists(name, location)
+
+            if not exists:
+                raise Exception("The bucket '{}' does not exist.".format(name))
+
+        handle = warehouse(uri)
+    except Exception as e:
+        raise click.BadParameter(str(e))
+
+    if isinstance(handle, Bucket):
+        return handle, '', True
+
+    return handle.bucket, handle.key, handle.key.endswith('/')
+
+
+class Manifest:
+    """
+    Remembers which transfers finished, one JSON line each, so an interrupted command can resume.
+
+    A transfer is skipped when one of the same source version (its ETag or modification
+    time) to the same destination is recorded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.finished = set()
+
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # cut short by the interruption
+
+                    self.finished.add((entry['src'], entry['dst'], entry['size'], entry.get('version')))
+
+        self._file = open(path, 'a') if path is not None else None
+
+    def done(self, src, dst, size, version):
+        return (src, dst, size, version) in self.finished
+
+    def record(self, src, dst, size, version):
+        if self._file is not None:
+            self._file.write(json.dumps(dict(src=src, dst=dst, size=size, version=version)) + '\n')
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class Progress:
+    """Counts finished transfers, redrawing a status line on a terminal at most every 'interval' seconds."""
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.display = sys.stderr.isatty()
+
+        self.files = self.bytes = self.skipped = self.failed = 0
+        self.start = time.perf_counter()
+
+        self._drawn = 0
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    @property
+    def rate(self):
+        return self.bytes / self.elapsed if self.elapsed else 0
+
+    def update(self, size):
+        self.files += 1
+        self.bytes += size or 0
+
+        if self.display and time.perf_counter() - self._drawn >= self.interval:
+            click.echo('\r{} files, {} ({}/s)\033[K'.format(self.files, format_size(self.bytes),
+                                                            format_size(self.rate)), nl=False, err=True)
+            self._drawn = time.perf_counter()
+
+    def summary(self, verb):
+        if self.display and self._drawn:
+            click.echo('\r\033[K', nl=False, err=True)
+
+        return '{} {} files ({}) in {:.1f}s, {}/s; {} skipped, {} failed'.format(
+            verb, self.files, format_size(self.bytes), self.elapsed, format_size(self.rate), self.skipped,
+            self.failed)
+
+
+def run_transfers(tasks, verb, jobs=8, manifest=None):
+    """
+    Runs (src, dst, size, version, fn) tasks on 'jobs' threads, reporting progress, then a summary line.
+
+    Tasks are consumed as they finish, so only a few per thread are ever queued - a listing
+    of millions of keys is never held in memory. Failures, including one that cuts the
+    listing short, are reported after the rest finish.
+    """
+    manifest = Manifest(manifest)
+    progress = Progress()
+    errors = []
+    pending = {}
+
+    def fail(src, dst, error):
+        progress.failed += 1
+        errors.append('{} -> {}: {}'.format(src, dst, error))
+
+    def finish(futures):
+        for future in futures:
+            src, dst, size, version = pending.pop(future)
+
+            if future.exception() is not None:
+                fail(src, dst, future.exception())
+                continue
+
+            manifest.record(src, dst, size, version)
+            progress.update(size)
+
+    tasks = iter(tasks)
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='warehouse-cli') as executor:
+            while True:
+                try:
+                    src, dst, size, version, fn = next(tasks)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    fail('(listing)', '(the rest)', e)  # the tasks already started still finish
+                    break
+
+                if manifest.done(src, dst, size, version):
+                    progress.skipped += 1
+                    continue
+
+                pending[executor.submit(contextvars.copy_context().run, fn)] = (src, dst, size, version)
+
+                if len(pending) >= jobs * 4:
+                    finish(wait(pending, return_when=FIRST_COMPLETED).done)
+
+            finish(wait(pending).done)
+    finally:
+        manifest.close()
+
+    click.echo(progress.summary(verb))
+
+    for error in errors:
+        click.echo(error, err=True)
+
+    if errors:
+        raise click.ClickException('{} transfers failed.'.format(len(errors)))
+
+
+def _local_path(root, relpath):
+    """Joins a key's relative path onto root, refusing any that would land outside of it."""
+    path = os.path.normpath(os.path.join(root, *relpath.split('/')))
+
+    if os.path.commonpath([os.path.abspath(root), os.path.abspath(path)]) != os.path.abspath(root):
+        raise click.ClickException("Refusing to write '{}' outside of {}.".format(relpath, root))
+
+    return path
+
+
+def _version(info):
+    """What tells one version of a source from another: its ETag, else its modification time."""
+    return info.etag or info.mtime
+
+
+def _info(bucket, key):
+    cubby = bucket.cubby(key)
+
+    if not cubby.exists():
+        raise click.ClickException("{} does not exist.".format(cubby))
+
+    return cubby.info()
+
+
+def _pairs(src_bucket, src_key, src_prefix, dst_key, dst_prefix):
+    """Yields (source KeyInfo, destination key) for every source key, streaming the listing."""
+    if not src_prefix:
+        info = _info(src_bucket, src_key)
+        yield info, dst_key + posixpath.basename(src_key) if dst_prefix else dst_key
+        return
+
+    for info in src_bucket.scan(src_key):
+        yield info, dst_key + info.key[len(src_key):]
+
+
+job_options = [
+    click.option('--jobs', '-j', default=8, show_default=True, help="How many transfers to run at once."),
+    click.option('--manifest', type=click.Path(dir_okay=False),
+                 help="Record finished transfers here, and skip those already recorded."),
+]
+
+
+def with_job_options(command):
+    for option in reversed(job_options):
+        command = option(command)
+
+    return command
+
+
+@warehouse_cli.command('upload')
+@click.argument('src', type=click.Path(exists=True))
+@click.argument('dst')
+@with_job_options
+def upload(src, dst, jobs, manifest):
+    """Uploads a local file, or a folder's files, to DST."""
+    bucket, key, is_prefix = _resolve(dst, create=True)
+
+    def tasks():
+        if os.path.isfile(src):
+            files = [(src, key + os.path.basename(src) if is_prefix else key)]
+        else:
+            prefix = key if is_prefix or not key else key + '/'
+            files = ((os.path.join(folder, name),
+                      prefix + os.path.relpath(os.path.join(folder, name), src).replace(os.sep, '/'))
+                     for folder, _, names in os.walk(src) for name in sorted(names))
+
+        for path, dst_key in files:
+            cubby = bucket.cubby(dst_key)
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None  # gone since it was listed; the store reports it
+
+            yield (path, str(cubby), stat and stat.st_size, stat and stat.st_mtime,
+                   lambda path=path, cubby=cubby: cubby.store(filepath=path))
+
+    run_transfers(tasks(), 'Uploaded', jobs=jobs, manifest=manifest)
+
+
+@warehouse_cli.command('download')
+@click.argument('src')
+@click.argument('dst', type=click.Path(file_okay=False))
+@with_job_options
+def download(src, dst, jobs, manifest):
+    """Downloads SRC (a key, or every key under a prefix) into the local folder DST."""
+    bucket, key, is_prefix = _resolve(src)
+
+    def fetch(cubby, relpath):
+        path = _local_path(dst, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cubby.retrieve(filepath=path)
+
+    def tasks():
+        for info, relpath in _pairs(bucket, key, is_prefix, '', True):
+            cubby = bucket.cubby(info.key)
+            yield (str(cubby), os.path.join(dst, *relpath.split('/')), info.size, _version(info),
+                   lambda cubby=cubby, relpath=relpath: fetch(cubby, relpath))
+
+    run_transfers(tasks(), 'Downloaded', jobs=jobs, manifest=manifest)
+
+
+@warehouse_cli.command('cp')
+@click.argument('src')
+@click.argument('dst')
+@with_job_options
+def cp(src, dst, jobs, manifest):
+    """Copies SRC (a key, or every key under a prefix) to DST, across any two services."""
+    src_bucket, src_key, src_prefix = _resolve(src)
+    dst_bucket, dst_key, dst_prefix = _resolve(dst, create=True)
+
+    if src_prefix and dst_key and not dst_prefix:
+        dst_key += '/'
+
+    def tasks():
+        for info, key in _pairs(src_bucket, src_key, src_prefix, dst_key, dst_prefix):
+            src_cubby, dst_cubby = src_bucket.cubby(info.key), dst_bucket.cubby(key)
+            yield (str(src_cubby), str(dst_cubby), info.size, _version(info),
+                   lambda src_cubby=src_cubby, dst_cubby=dst_cubby: src_cubby.copy_to(cubby=dst_cubby))
+
+    run_transfers(tasks(), 'Copied', jobs=jobs, manifest=manifest)
+
+
+@warehouse_cli.command('rm')
+@click.argument('uri')
+@click.option('--yes', is_flag=True, help="Don't ask before deleting a whole prefix.")
+@click.option('--jobs', '-j', default=8, show_default=True, help="How many deletes to run at once.")
+def rm(uri, yes, jobs):
+    """Deletes a key, or every key under a prefix."""
+    bucket, key, is_prefix = _resolve(uri)
+
+    if is_prefix and not yes:
+        click.confirm("Delete every key under {}?".format(uri), abort=True)
+
+    def tasks():
+        for info in bucket.scan(key) if is_prefix else [_info(bucket, key)]:
+            cubby = bucket.cubby(info.key)
+            yield str(cubby), str(cubby), info.size, _version(info), cubby.delete
+
+    run_transfers(tasks(), 'Deleted', jobs=jobs)
+
+
+@warehouse_cli.command('ls')
+@click.argument('uri')
+@click.option('--long', '-l', 'long_format', is_flag=True, help="Show each key's size and modification time.")
+def ls(uri, long_format):
+    """Lists the keys starting with URI's key, as the listing arrives."""
+    bucket, key, _ = _resolve(uri)
+
+    for info in bucket.scan(key):
+        if long_format:
+            modified = datetime.datetime.fromtimestamp(info.mtime).isoformat(' ', 'seconds') if info.mtime else '-'
+            click.echo('{:>12} {} {}'.format(info.size, modified, info.key))
+        else:
+            click.echo(info.key)
+
+
+@warehouse_cli.command('du')
+@click.argument('uri')
+@click.option('--bytes', '-b', 'in_bytes', is_flag=True, help="Show the total in bytes.")
+def du(uri, in_bytes):
+    """Totals the number and size of the keys starting with URI's key."""
+    bucket, key, _ = _resolve(uri)
+    count = size = 0
+
+    for info in bucket.scan(key):
+        count += 1
+        size += info.size
+
+    click.echo('{} files, {}'.format(count, size if in_bytes else format_size(size)))
+
+
+@warehouse_cli.command('gc')
+@click.argument('buckets', nargs=-1)
+@click.option('--dry-run', is_flag=True, help="Only report what would be deleted.")
+def gc(buckets, dry_run):
+    """Applies the lifecycle rules of file buckets now (by default, every bucket in WAREHOUSE_FILE_LIFECYCLE)."""
+    warehouse = current_app.extensions['warehouse']
+    lifecycle = current_app.config.get('WAREHOUSE_FILE_LIFECYCLE') or {}
+
+    for name in buckets or lifecycle:
+        if name not in lifecycle:
+            raise click.ClickException("No lifecycle rules are set for '{}'.".format(name))
+
+        result = warehouse('file:///{}'.format(name)).sweep(dry_run=dry_run)
+
+        click.echo('{}: scanned {} files, expired {}, evicted {}, {} {}'.format(
+            name, result.scanned, result.expired, result.evicted, 'would free' if dry_run else 'freed',
+            format_size(result.freed)))
@@ -1,13 +1,56 @@
+import collections
+import functools
+import importlib
 import re
+import threading
+import weakref
 
-from flask import current_app
+from flask import current_app, has_app_context
 
-from .backends import Service, FileService, S3Service
+from . import background
+from .backends import Service
+from .cli import warehouse_cli
+from .metrics import Metrics, StatsdExporter
+from .sync import sync
+from .uploads import uploads
 
 
-# A regex for bucket strings like s3://us-west-1/bucket
+# A regex for bucket strings like s3://us-west-1/bucket, for any registered service
 WAREHOUSE_BUCKET_REGEX = \
-    re.compile(r"(?P<service>(s3|file)):\/\/(?P<location>[^\/]+)?\/(?P<bucket>[^\/]+)")
+    re.compile(r"(?P<service>[a-z][a-z0-9+.-]*):\/\/(?P<location>[^\/]+)?\/(?P<bucket>[^\/]+)")
+
+
+# Where each built-in service is defined; modules are only imported when a service is first used
+SERVICES = {
+    's3': 'flask_warehouse.backends.s3:S3Service',
+    'file': 'flask_warehouse.backends.file:FileService',
+    'memory': 'flask_warehouse.backends.memory:MemoryService',
+    'tiered': 'flask_warehouse.backends.tiered:TieredService',
+    'replicated': 'flask_warehouse.backends.replicated:ReplicatedService',
+}
+
+# Other packages can register services under this entry point group, e.g. 'gcs = mypackage:GCSService'
+SERVICES_ENTRY_POINT_GROUP = 'flask_warehouse.services'
+
+
+def load_service_class(path):
+    """Imports a service class given as 'package.module:ClassName'."""
+    module, _, name = path.partition(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def service_entry_points():
+    """Returns {name: entry point} for every service installed under SERVICES_ENTRY_POINT_GROUP."""
+    from importlib import metadata
+
+    entry_points = metadata.entry_points()
+
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=SERVICES_ENTRY_POINT_GROUP)
+    else:
+        entry_points = entry_points.get(SERVICES_ENTRY_POINT_GROUP, [])
+
+    return {entry_point.name: entry_point for entry_point in entry_points}
 
 
 # A regex for cubby strings like s3://us-west-1/bucket/key
@@ -15,37 +58,109 @@ WAREHOUSE_CUBBY_REGEX = \
     re.compile(r"{}\/(?P<key>.+)".format(WAREHOUSE_BUCKET_REGEX.pattern))
 
 
+@functools.lru_cache(maxsize=65536)
+def parse_uri(uri):
+    """Returns (service, location, bucket, key) for a bucket or cubby str; key is None for buckets."""
+    match = WAREHOUSE_CUBBY_REGEX.match(uri) or WAREHOUSE_BUCKET_REGEX.match(uri)
+
+    if match is None:
+        raise Exception("Could not parse '{}' as a Bucket or Cubby str".format(uri))
+
+    groups = match.groupdict()
+    return groups['service'], groups['location'], groups['bucket'], groups.get('key')
+
+
+def _settings(app):
+    """What a bucket handle is built from besides its URI, so changing any of it builds new handles."""
+    return app.static_folder, repr([(name, value) for name, value in app.config.items()
+                                    if name.startswith('WAREHOUSE_')])
+
+
 class Warehouse(Service):
     """
     Clean abstraction over several file storage backends (S3, Alicloud, local).
     """
 
     def __init__(self, app=None):
-        self.services = {
-            's3': S3Service,
-            'file': FileService,
-        }
+        # service classes, or 'module:Class' strings imported on first use
+        self.services = dict(SERVICES)
 
+        self.app = None
         self.service: Service = None
         self.default_bucket = None
+        self.metrics = None
+        self.statsd = None
+
+        # the most recently used bucket handles, by (app, settings, service, location, bucket); the
+        # settings are fingerprinted once per app, until init_app() or clear_cache()
+        self._buckets = collections.OrderedDict()
+        self._buckets_lock = threading.Lock()
+        self._settings = weakref.WeakKeyDictionary()
+        self.bucket_cache_size = 0
 
         if app is not None:
             self.init_app(app)
 
     def init_app(self, app):
+        self.disconnect()
+        self.clear_cache()
+        self.metrics = self.statsd = None
         self.app = app
 
         app.config.setdefault('WAREHOUSE_DEFAULT_SERVICE', 'file')
+        app.config.setdefault('WAREHOUSE_UPLOAD_URL_PREFIX', '/_warehouse/uploads')
+        app.config.setdefault('WAREHOUSE_BACKGROUND_FLUSH_ON_TEARDOWN', False)
+        app.config.setdefault('WAREHOUSE_METRICS', False)
+        app.config.setdefault('WAREHOUSE_STATSD_HOST', None)
+        app.config.setdefault('WAREHOUSE_PROFILE_REQUESTS', False)
+        app.config.setdefault('WAREHOUSE_BUCKET_CACHE_SIZE', 1024)
 
         default_service_key = app.config['WAREHOUSE_DEFAULT_SERVICE']
 
         self.default_location = app.config.get('WAREHOUSE_DEFAULT_LOCATION')
         self.default_bucket = app.config.get('WAREHOUSE_DEFAULT_BUCKET')
+        self.bucket_cache_size = app.config['WAREHOUSE_BUCKET_CACHE_SIZE']
 
         self.service = self._create_service(service=default_service_key,
                                             location=self.default_location,
                                             app=app)
 
+        app.extensions['warehouse'] = self
+
+        if uploads.name not in app.blueprints:
+            app.register_blueprint(uploads, url_prefix=app.config['WAREHOUSE_UPLOAD_URL_PREFIX'])
+
+        if warehouse_cli.name not in app.cli.commands:
+            app.cli.add_command(warehouse_cli)
+
+        if app.config['WAREHOUSE_BACKGROUND_FLUSH_ON_TEARDOWN']:
+            app.teardown_appcontext(lambda exception: background.flush_context())
+
+        if app.config['WAREHOUSE_METRICS']:
+            self.metrics = Metrics(app).connect()
+
+        if app.config['WAREHOUSE_STATSD_HOST']:
+            self.statsd = StatsdExporter(app.config['WAREHOUSE_STATSD_HOST'],
+                                         app.config.get('WAREHOUSE_STATSD_PORT', 8125),
+                                         app.config.get('WAREHOUSE_STATSD_PREFIX', 'warehouse'),
+                                         app=app).connect()
+
+        if app.config['WAREHOUSE_PROFILE_REQUESTS']:
+            from .profiler import StorageProfiler
+
+            StorageProfiler(app)
+
+        if app.config.get('WAREHOUSE_FILE_LIFECYCLE'):
+            from .lifecycle import start_sweeper
+
+            start_sweeper(app)
+
+    def disconnect(self):
+        """Stops this extension's Metrics and StatsdExporter from receiving any more signals."""
+        for receiver in [self.metrics, self.statsd]:
+            if receiver is not None:
+                receiver.disconnect()
+
     def bucket(self, name=None, location=None):
         if self.app is None:
             raise RuntimeError("Storage.init_app() was not called!")
@@ -55,31 +170,101 @@ class Warehouse(Service):
 
         return self.service.bucket(name or self.default_bucket, location or self.default_location)
 
+    def sync(self, src_uri, dst_uri, prefix=None, **kwargs):
+        """Mirrors the bucket at src_uri into the bucket at dst_uri; see flask_warehouse.sync.sync()."""
+        return sync(self(src_uri), self(dst_uri), prefix=prefix, **kwargs)
+
+    def flush(self):
+        """Blocks until every background store in this process has been uploaded."""
+        background.flush()
+
+    def service_class(self, service):
+        """Returns the class registered for a service name, importing it on first use."""
+        if service not in self.services:
+            entry_point = service_entry_points().get(service)
+
+            if entry_point is None:
+                raise Exception("No StorageService was registered named '{}'".format(service))
+
+            self.services[service] = entry_point.load()
+
+        if isinstance(self.services[service], str):
+            self.services[service] = load_service_class(self.services[service])
+
+        return self.services[service]
+
     def _create_service(self, service=None, location=None, app=None):
-        try:
-            service_constructor = self.services[service]
-        except KeyError:
-            raise Exception("No StorageService was registered named '{}'".format(service))
+        service_constructor = self.service_class(service)
+
+        if app is None:
+            app = current_app if has_app_context() else self.app
 
-        return service_constructor(app or current_app, default_location=location or self.default_location)
+        return service_constructor(app, default_location=location or self.default_location)
+
+    def _create_bucket(self, service=None, location=None, bucket=None):
+        """Returns a handle for the bucket, reusing a cached one unless it was deleted or the settings changed."""
+        app = current_app._get_current_object() if has_app_context() else self.app
+
+        if self.bucket_cache_size:
+            with self._buckets_lock:
+                settings = self._settings.get(app)
+                if settings is None:
+                    settings = self._settings[app] = _settings(app)
+
+                # a weak reference, so a cached handle never keeps an app alive
+                cache_key = (weakref.ref(app), settings, service, location or self.default_location, bucket)
+                handle = self._buckets.get(cache_key)
+
+                if handle is not None and not handle.deleted:
+                    self._buckets.move_to_end(cache_key)
+                    return handle
+
+        handle = self._create_service(service=service, location=location, app=app).bucket(bucket)
+
+        if self.bucket_cache_size:
+            with self._buckets_lock:
+                self._buckets[cache_key] = handle
+
+                while len(self._buckets) > self.bucket_cache_size:
+                    self._buckets.popitem(last=False)
+
+        return handle
 
     def _create_bucket_or_cubby(self, service=None, location=None, bucket=None, key=None, app=None):
-        service = self._create_service(service=service, location=location)
-        bucket = service.bucket(bucket)
+        bucket = self._create_bucket(service=service, location=location, bucket=bucket)
 
         if key is None:
             return bucket
 
         return bucket.cubby(key)
 
+    def clear_cache(self):
+        """Forgets every cached bucket handle, e.g. after changing buckets outside of the app or its settings."""
+        with self._buckets_lock:
+            self._buckets.clear()
+            self._settings.clear()
+
     def __call__(self, bucket_or_key_str):
-        match = (WAREHOUSE_CUBBY_REGEX.match(bucket_or_key_str)
-                 or WAREHOUSE_BUCKET_REGEX.match(bucket_or_key_str))
+        service, location, bucket, key = parse_uri(bucket_or_key_str)
+
+        return self._create_bucket_or_cubby(service=service, location=location, bucket=bucket, key=key)
+
+    def resolve_many(self, uris):
+        """
+        Returns the Bucket or Cubby for each of uris, in order.
+
+        Each distinct bucket's handle is built once, however many of its keys are given.
+        """
+        parsed = [parse_uri(uri) for uri in uris]
+        buckets = {}
 
-        if match:
-            return self._create_bucket_or_cubby(**match.groupdict())
+        for service, location, bucket, key in parsed:
+            if (service, location, bucket) not in buckets:
+                buckets[service, location, bucket] = self._create_bucket(service=service, location=location,
+                                                                          bucket=bucket)
 
-        raise Exception("Could not parse '{}' as a Bucket or Cubby str".format(bucket_or_key_str))
+        return [buckets[service, location, bucket] if key is None else buckets[service, location, bucket].cubby(key)
+                for service, location, bucket, key in parsed]
 
     def __repr__(self):
         return "<Warehouse service={} default_bucket={}>".format(self.service, self.default_bucket)
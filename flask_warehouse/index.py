@@ -0,0 +1,155 @@
+import contextlib
+import sqlite3
+import threading
+
+from .backends.service import KeyInfo
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    size INTEGER,
+    etag TEXT,
+    mtime REAL,
+    content_type TEXT,
+    PRIMARY KEY (bucket, key)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS keys_mtime ON keys (bucket, mtime);
+"""
+
+
+def prefix_range(prefix):
+    """Returns (low, high) such that low <= key < high exactly when key starts with prefix."""
+    if not prefix:
+        return '', None
+
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class LocalDatabase:
+    """A SQLite database with one connection per thread, in WAL mode so readers don't wait on writers."""
+
+    schema = ''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        self._connection().executescript(self.schema)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+
+        return connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        connection.execute('COMMIT')
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.path)
+
+
+class KeyIndex(LocalDatabase):
+    """A local SQLite record of each bucket's keys, answering listings and counts without the backend."""
+
+    schema = SCHEMA
+
+    def record(self, bucket, info: KeyInfo):
+        self._connection().execute('INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?, ?)',
+                                   (str(bucket),) + tuple(info))
+
+    def remove(self, bucket, key):
+        self._connection().execute('DELETE FROM keys WHERE bucket = ? AND key = ?', (str(bucket), key))
+
+    def clear(self, bucket):
+        self._connection().execute('DELETE FROM keys WHERE bucket = ?', (str(bucket),))
+
+    def rebuild(self, bucket, batch_size=10000):
+        """Replaces everything recorded for bucket with a fresh full listing of it."""
+        infos = bucket.scan()
+
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM keys WHERE bucket = ?', (str(bucket),))
+
+            while True:
+                batch = [(str(bucket),) + tuple(info) for _, info in zip(range(batch_size), infos)]
+                if not batch:
+                    break
+
+                connection.executemany('INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?, ?)', batch)
+
+    def _where(self, bucket, prefix=None, modified_since=None):
+        clauses, params = ['bucket = ?'], [str(bucket)]
+
+        low, high = prefix_range(prefix)
+        if low:
+            clauses.append('key >= ?')
+            params.append(low)
+        if high is not None:
+            clauses.append('key < ?')
+            params.append(high)
+
+        if modified_since is not None:
+            clauses.append('mtime >= ?')
+            params.append(modified_since)
+
+        return ' AND '.join(clauses), params
+
+    def scan(self, bucket, prefix=None, max_keys=None, modified_since=None):
+        where, params = self._where(bucket, prefix, modified_since)
+        query = 'SELECT key, size, etag, mtime, content_type FROM keys WHERE {} ORDER BY key'.format(where)
+
+        if max_keys is not None:
+            query += ' LIMIT ?'
+            params.append(max_keys)
+
+        for row in self._connection().execute(query, params):
+            yield KeyInfo(*row)
+
+    def count(self, bucket, prefix=None):
+        where, params = self._where(bucket, prefix)
+        return self._connection().execute('SELECT COUNT(*) FROM keys WHERE ' + where, params).fetchone()[0]
+
+    def total_size(self, bucket, prefix=None):
+        where, params = self._where(bucket, prefix)
+        query = 'SELECT COALESCE(SUM(size), 0) FROM keys WHERE ' + where
+        return self._connection().execute(query, params).fetchone()[0]
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def local_database(cls, path):
+    """Returns the process-wide instance of a LocalDatabase subclass for a path."""
+    with _databases_lock:
+        if (cls, path) not in _databases:
+            _databases[cls, path] = cls(path)
+
+        return _databases[cls, path]
+
+
+def key_index(path):
+    """Returns the process-wide KeyIndex for a database path, or None if path is None."""
+    if path is None:
+        return None
+
+    return local_database(KeyIndex, path)
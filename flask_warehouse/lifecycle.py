@@ -0,0 +1,264 @@
+import hashlib
+import heapq
+import os
+import posixpath
+import threading
+import time
+
+from collections import namedtuple
+
+from .backends.file import internal
+from .metrics import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows; every process then sweeps
+    fcntl = None
+
+
+# One lifecycle rule for the keys under prefix ('' for all of them): files last written more
+# than expire_days ago are deleted, and the least recently used are evicted while the
+# prefix holds more than max_size bytes. Either may be None.
+LifecycleRule = namedtuple('LifecycleRule', ['prefix', 'expire_days', 'max_size'], defaults=['', None, None])
+
+SweepResult = namedtuple('SweepResult', ['scanned', 'expired', 'evicted', 'freed'])
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_PAUSE = 0.01
+
+
+def lifecycle_rules(setting):
+    """
+    Returns {bucket name: [LifecycleRule]} from a WAREHOUSE_FILE_LIFECYCLE setting.
+
+    e.g. {'exports': [{'prefix': 'tmp/', 'expire_days': 7}, {'max_size': 10 * 1024 ** 3}]}
+    """
+    rules = {}
+
+    for name, bucket_rules in (setting or {}).items():
+        try:
+            rules[name] = [LifecycleRule(**rule) for rule in bucket_rules]
+        except TypeError:
+            raise Exception("Lifecycle rules for '{}' may only set prefix, expire_days and max_size.".format(name))
+
+    return rules
+
+
+def _files(bucket, prefix):
+    """
+    Yields (key, stat) for every file under prefix, in no particular order.
+
+    Only the directories still to visit are held in memory, never a whole directory's listing.
+    """
+    directories = [posixpath.dirname(prefix)]
+
+    while directories:
+        relpath = directories.pop()
+
+        try:
+            entries = os.scandir(os.path.join(bucket.abspath, relpath))
+        except FileNotFoundError:
+            continue
+
+        with entries:
+            for entry in entries:
+                key = posixpath.join(relpath, entry.name)
+
+                try:
+                    if internal(entry.name, entry.is_dir(follow_symlinks=False)):
+                        continue
+
+                    if entry.is_dir(follow_symlinks=False):
+                        if key.startswith(prefix[:len(key)]):
+                            directories.append(key)
+                    elif key.startswith(prefix):
+                        yield key, entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    pass  # deleted while we looked
+
+
+class Sweep:
+    """Applies a FolderBucket's lifecycle rules in batches, pausing between them so requests aren't starved."""
+
+    def __init__(self, bucket, rules, batch_size=DEFAULT_BATCH_SIZE, pause=DEFAULT_PAUSE, dry_run=False):
+        self.bucket = bucket
+        self.rules = rules
+        self.batch_size = batch_size
+        self.pause = pause
+        self.dry_run = dry_run
+
+        self.scanned = self.expired = self.evicted = self.freed = 0
+
+    def run(self, now=None):
+        now = time.time() if now is None else now
+
+        for rule in self.rules:
+            total = self._expire(rule, now)
+
+            if rule.max_size is not None and total > rule.max_size:
+                self._evict(rule, total - rule.max_size)
+
+        return SweepResult(self.scanned, self.expired, self.evicted, self.freed)
+
+    def _batched(self, prefix):
+        for i, (key, stat) in enumerate(_files(self.bucket, prefix), 1):
+            yield key, stat
+
+            if i % self.batch_size == 0 and self.pause:
+                time.sleep(self.pause)
+
+    def _expire(self, rule, now):
+        """Deletes expired files under the rule's prefix, returning the size of those left."""
+        expired_before = now - rule.expire_days * 86400 if rule.expire_days is not None else None
+        total = 0
+
+        for key, stat in self._batched(rule.prefix):
+            self.scanned += 1
+
+            if expired_before is not None and stat.st_mtime < expired_before and self._remove(key, stat):
+                self.expired += 1
+            else:
+                total += stat.st_size
+
+        return total
+
+    def _evict(self, rule, excess):
+        """Deletes the least recently used files under the rule's prefix until 'excess' bytes are freed."""
+        # a max-heap (by last use) of the oldest files known that free at least 'excess' bytes
+        oldest = []
+        size = 0
+
+        for key, stat in self._batched(rule.prefix):
+            heapq.heappush(oldest, (-max(stat.st_atime, stat.st_mtime), key, stat))
+            size += stat.st_size
+
+            while size - oldest[0][2].st_size >= excess:
+                size -= heapq.heappop(oldest)[2].st_size
+
+        for _, key, stat in sorted(oldest, key=lambda item: item[:2], reverse=True):
+            if self._remove(key, stat):
+                self.evicted += 1
+
+    def _remove(self, key, stat):
+        """Deletes key unless it changed since it was scanned (as stat), returning whether it did."""
+        if self.dry_run:
+            self.freed += stat.st_size
+            return True
+
+        cubby = self.bucket.cubby(key)
+
+        # under the key's lock, so a write landing meanwhile is either seen here or made after
+        with cubby.lock():
+            try:
+                current = os.stat(cubby.filepath(), follow_symlinks=False)
+            except FileNotFoundError:
+                return False
+
+            if current.st_size != stat.st_size or current.st_mtime_ns != stat.st_mtime_ns:
+                return False  # written since the scan, so no longer expired or least recently used
+
+            cubby.delete()
+
+        self.freed += stat.st_size
+
+        # prune the folders emptied along the way, up to the bucket's
+        directory = os.path.dirname(os.path.join(self.bucket.abspath, key))
+
+        while directory != self.bucket.abspath:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+
+            directory = os.path.dirname(directory)
+
+        return True
+
+
+def sweep(bucket, rules, batch_size=DEFAULT_BATCH_SIZE, pause=DEFAULT_PAUSE, dry_run=False, now=None):
+    """Applies lifecycle rules to a FolderBucket, returning a SweepResult."""
+    return Sweep(bucket, rules, batch_size=batch_size, pause=pause, dry_run=dry_run).run(now=now)
+
+
+class LifecycleSweeper:
+    """
+    Sweeps every bucket with lifecycle rules every 'interval' seconds, on a background thread.
+
+    Each process of the app runs one, but only one process sweeps at a time: the others
+    skip their turn while it holds the app's sweep lock.
+    """
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+
+        from .backends.file import DEFAULT_LOCK_FOLDER
+
+        root = hashlib.sha1(os.path.abspath(app.static_folder).encode('utf-8')).hexdigest()[:16]
+        self.lock_path = os.path.join(app.config.get('WAREHOUSE_FILE_LOCK_FOLDER', DEFAULT_LOCK_FOLDER),
+                                      'lifecycle-{}.lock'.format(root))
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='warehouse-lifecycle', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def sweep_all(self):
+        warehouse = self.app.extensions['warehouse']
+
+        with self.app.app_context():
+            return {name: warehouse('file:///{}'.format(name)).sweep()
+                    for name in self.app.config.get('WAREHOUSE_FILE_LIFECYCLE') or {}}
+
+    def sweep_once(self):
+        """Sweeps every bucket unless another process is sweeping, returning {name: SweepResult} or None."""
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return None
+
+            return self.sweep_all()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                results = self.sweep_once()
+            except Exception:
+                logger.exception("Lifecycle sweep failed")
+                continue
+
+            for name, result in (results or {}).items():
+                logger.info("Lifecycle sweep of %s: %s", name, result)
+
+
+_sweepers = {}
+_sweepers_lock = threading.Lock()
+
+
+def start_sweeper(app):
+    """
+    Starts this process's LifecycleSweeper for the app, unless WAREHOUSE_FILE_LIFECYCLE_INTERVAL
+    is unset or one is already running; called by Warehouse.init_app().
+    """
+    interval = app.config.get('WAREHOUSE_FILE_LIFECYCLE_INTERVAL', 3600)
+
+    if not interval:
+        return None
+
+    # threads do not survive a fork, so each process starts its own
+    key = (os.getpid(), app)
+
+    with _sweepers_lock:
+        if key not in _sweepers:
+            _sweepers[key] = LifecycleSweeper(app, interval).start()
+
+        return _sweepers[key]
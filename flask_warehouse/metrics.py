@@ -0,0 +1,359 @@
+import collections
+import contextvars
+import functools
+import io
+import logging
+import re
+import socket
+import threading
+import time
+
+from flask import current_app, has_app_context
+from flask.signals import Namespace
+
+
+logger = logging.getLogger('flask_warehouse')
+
+signals = Namespace()
+
+# sent by a Cubby or Bucket after each instrumented call, with operation=, bucket=, key=,
+# duration= (seconds), bytes= (or None) and error= (the exception raised, or None)
+operation_finished = signals.signal('warehouse-operation-finished')
+
+# sent for each round trip to a backend, with service=, request= ('HEAD', 'GET', 'PUT', 'LIST',
+# 'COPY', 'DELETE' or the backend's own name for it) and bucket=
+backend_request = signals.signal('warehouse-backend-request')
+
+# sent when an answer came from a local cache instead of the backend, with cache= and bucket=
+cache_hit = signals.signal('warehouse-cache-hit')
+
+# how many instrumented calls are running in this context, including the one being reported
+_depth = contextvars.ContextVar('warehouse_call_depth', default=0)
+
+
+def call_depth():
+    """How deeply the call an operation_finished receiver is told of was nested; 1 if nothing else made it."""
+    return _depth.get()
+
+
+def connected(*signals):
+    """
+    Whether anything is connected to any of the signals.
+
+    Without blinker installed, Flask's signals are stand-ins that can't be connected to.
+    """
+    return any(getattr(signal, 'receivers', None) for signal in signals)
+
+
+class CountingIO(io.RawIOBase):
+    """
+    Counts the bytes passed through it in one direction, passing everything else through.
+
+    Seeks, truncates and the other direction reach the wrapped file untouched, so a backend
+    can still rewrite its source in place (e.g. to gzip it). The count is of distinct bytes:
+    a backend that rewinds and reads again (to hash before uploading, or to retry) doesn't
+    count them twice.
+    """
+
+    def __init__(self, filelike):
+        self.filelike = filelike
+        self.count = 0
+
+        self._position = self._start = self._tell()
+
+    def _tell(self):
+        try:
+            return self.filelike.tell() if self.filelike.seekable() else 0
+        except (AttributeError, OSError):
+            return 0
+
+    def _advance(self, n):
+        self._position += n
+        self.count = max(self.count, self._position - self._start)
+
+    def seekable(self):
+        return self.filelike.seekable()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._position = self.filelike.seek(offset, whence)
+        return self._position
+
+    def tell(self):
+        return self.filelike.tell()
+
+    def truncate(self, size=None):
+        return self.filelike.truncate() if size is None else self.filelike.truncate(size)
+
+    def _read(self, b):
+        data = self.filelike.read(len(b))
+
+        n = len(data)
+        b[:n] = data
+        self._position += n
+
+        return n
+
+    def _write(self, data):
+        n = self.filelike.write(data)
+        n = len(data) if n is None else n
+        self._position += n
+
+        return n
+
+
+class CountingReader(CountingIO):
+    def readable(self):
+        return True
+
+    def writable(self):
+        return getattr(self.filelike, 'writable', lambda: False)()
+
+    def readinto(self, b):
+        n = self._read(b)
+        self._advance(0)
+        return n
+
+    def write(self, data):
+        return self._write(data)
+
+
+class CountingWriter(CountingIO):
+    def writable(self):
+        return True
+
+    def readable(self):
+        return getattr(self.filelike, 'readable', lambda: False)()
+
+    def write(self, data):
+        n = self._write(data)
+        self._advance(0)
+        return n
+
+    def readinto(self, b):
+        return self._read(b)
+
+
+def instrumented(operation, request=None):
+    """
+    Sends operation_finished around a Cubby or Bucket method, and backend_request if given one.
+
+    'store' and 'retrieve' methods also count the bytes through their first argument.
+    When nothing is connected to either signal the method is called untouched.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not connected(operation_finished, backend_request):
+                return method(self, *args, **kwargs)
+
+            bucket = getattr(self, 'bucket', self)
+
+            if request is not None:
+                backend_request.send(self, service=bucket.service.id, request=request, bucket=str(bucket))
+
+            counter = None
+            if args and operation == 'store':
+                counter = CountingReader(args[0])
+            elif args and operation == 'retrieve':
+                counter = CountingWriter(args[0])
+
+            if counter is not None:
+                args = (counter,) + args[1:]
+
+            error = None
+            depth = _depth.set(_depth.get() + 1)
+            start = time.perf_counter()
+
+            try:
+                return method(self, *args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                try:
+                    operation_finished.send(self, operation=operation, bucket=str(bucket),
+                                            key=getattr(self, 'key', None),
+                                            duration=time.perf_counter() - start,
+                                            bytes=counter.count if counter is not None else None,
+                                            error=error)
+                finally:
+                    _depth.reset(depth)
+
+        return wrapper
+
+    return decorator
+
+
+class Receiver:
+    """
+    Connects a subclass's on_* methods to the warehouse signals.
+
+    Given an app, only the signals sent while that app (or no app) is current are passed on,
+    so several apps in one process each see their own calls.
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+
+    def connect(self):
+        operation_finished.connect(self._operation_finished, weak=False)
+        backend_request.connect(self._backend_request, weak=False)
+        cache_hit.connect(self._cache_hit, weak=False)
+        return self
+
+    def disconnect(self):
+        operation_finished.disconnect(self._operation_finished)
+        backend_request.disconnect(self._backend_request)
+        cache_hit.disconnect(self._cache_hit)
+
+    def _receives(self):
+        return self.app is None or not has_app_context() or current_app._get_current_object() is self.app
+
+    def _operation_finished(self, sender, **kwargs):
+        if self._receives():
+            self.on_operation_finished(sender, **kwargs)
+
+    def _backend_request(self, sender, **kwargs):
+        if self._receives():
+            self.on_backend_request(sender, **kwargs)
+
+    def _cache_hit(self, sender, **kwargs):
+        if self._receives():
+            self.on_cache_hit(sender, **kwargs)
+
+
+class Metrics(Receiver):
+    """
+    Aggregates the warehouse signals into counters and latency histograms.
+
+    prometheus() renders them in the Prometheus text exposition format.
+    """
+
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, app=None):
+        super().__init__(app)
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = collections.Counter()
+            self.durations = collections.defaultdict(float)
+            self.histograms = collections.defaultdict(lambda: [0] * len(self.buckets))
+            self.bytes = collections.Counter()
+            self.errors = collections.Counter()
+            self.requests = collections.Counter()
+            self.cache_hits = collections.Counter()
+
+    def on_operation_finished(self, sender, operation, bucket, key, duration, bytes, error):
+        labels = (operation, bucket)
+
+        with self._lock:
+            self.calls[labels] += 1
+            self.durations[labels] += duration
+
+            histogram = self.histograms[labels]
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    histogram[i] += 1
+
+            if bytes is not None:
+                self.bytes[labels] += bytes
+
+            if error is not None:
+                self.errors[labels + (error.__class__.__name__,)] += 1
+
+    def on_backend_request(self, sender, service, request, bucket):
+        with self._lock:
+            self.requests[service, request, bucket] += 1
+
+    def on_cache_hit(self, sender, cache, bucket):
+        with self._lock:
+            self.cache_hits[cache, bucket] += 1
+
+    def prometheus(self):
+        lines = []
+
+        def labels(**values):
+            return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in values.items()) + '}'
+
+        with self._lock:
+            lines += ['# HELP warehouse_operation_seconds Time spent in each storage operation.',
+                      '# TYPE warehouse_operation_seconds histogram']
+            for (operation, bucket), histogram in sorted(self.histograms.items()):
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append('warehouse_operation_seconds_bucket{} {}'.format(
+                        labels(operation=operation, bucket=bucket, le=bound), count))
+                lines.append('warehouse_operation_seconds_bucket{} {}'.format(
+                    labels(operation=operation, bucket=bucket, le='+Inf'), self.calls[operation, bucket]))
+                lines.append('warehouse_operation_seconds_sum{} {}'.format(
+                    labels(operation=operation, bucket=bucket), self.durations[operation, bucket]))
+                lines.append('warehouse_operation_seconds_count{} {}'.format(
+                    labels(operation=operation, bucket=bucket), self.calls[operation, bucket]))
+
+            lines += ['# HELP warehouse_bytes_total Bytes stored and retrieved.',
+                      '# TYPE warehouse_bytes_total counter']
+            for (operation, bucket), count in sorted(self.bytes.items()):
+                lines.append('warehouse_bytes_total{} {}'.format(labels(operation=operation, bucket=bucket), count))
+
+            lines += ['# HELP warehouse_errors_total Storage operations that raised.',
+                      '# TYPE warehouse_errors_total counter']
+            for (operation, bucket, error), count in sorted(self.errors.items()):
+                lines.append('warehouse_errors_total{} {}'.format(
+                    labels(operation=operation, bucket=bucket, error=error), count))
+
+            lines += ['# HELP warehouse_backend_requests_total Round trips made to each backend.',
+                      '# TYPE warehouse_backend_requests_total counter']
+            for (service, request, bucket), count in sorted(self.requests.items()):
+                lines.append('warehouse_backend_requests_total{} {}'.format(
+                    labels(service=service, request=request, bucket=bucket), count))
+
+            lines += ['# HELP warehouse_cache_hits_total Answers served from a local cache.',
+                      '# TYPE warehouse_cache_hits_total counter']
+            for (cache, bucket), count in sorted(self.cache_hits.items()):
+                lines.append('warehouse_cache_hits_total{} {}'.format(labels(cache=cache, bucket=bucket), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class StatsdExporter(Receiver):
+    """Forwards the warehouse signals to a statsd daemon over UDP as they happen."""
+
+    def __init__(self, host='localhost', port=8125, prefix='warehouse', app=None):
+        super().__init__(app)
+
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, *lines):
+        try:
+            self.socket.sendto('\n'.join(lines).encode('utf-8'), self.address)
+        except OSError:
+            pass  # metrics must never break storage
+
+    def _name(self, *parts):
+        return '.'.join([self.prefix] + [re.sub(r'[^A-Za-z0-9_-]+', '_', part) for part in parts])
+
+    def on_operation_finished(self, sender, operation, bucket, key, duration, bytes, error):
+        lines = ['{}:{:.3f}|ms'.format(self._name(operation, 'duration'), duration * 1000)]
+
+        if bytes is not None:
+            lines.append('{}:{}|c'.format(self._name(operation, 'bytes'), bytes))
+
+        if error is not None:
+            lines.append('{}:1|c'.format(self._name(operation, 'errors', error.__class__.__name__)))
+
+        self._send(*lines)
+
+    def on_backend_request(self, sender, service, request, bucket):
+        self._send('{}:1|c'.format(self._name('requests', service, request)))
+
+    def on_cache_hit(self, sender, cache, bucket):
+        self._send('{}:1|c'.format(self._name('cache_hits', cache)))
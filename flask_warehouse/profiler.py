@@ -0,0 +1,159 @@
+import collections
+import logging
+import os
+import sysconfig
+import threading
+import traceback
+
+import flask
+import werkzeug
+
+from flask import g, has_request_context, request
+
+from .metrics import backend_request, call_depth, logger, operation_finished
+
+try:
+    import blinker
+except ImportError:  # Flask's signals can't be connected to; StorageProfiler says so
+    blinker = None
+
+
+# A storage call made while handling a request; origin is the 'file:line in function' that made it,
+# and nested whether another storage call made it (so its duration is already counted).
+Call = collections.namedtuple('Call', ['operation', 'bucket', 'key', 'duration', 'bytes', 'error', 'origin',
+                                       'nested'], defaults=[False])
+
+# frames from these packages, or the standard library, never count as where a call came from
+_LIBRARY_PATHS = tuple(os.path.dirname(os.path.abspath(module.__file__)) + os.sep
+                       for module in [flask, werkzeug, blinker] if module is not None) + \
+    (os.path.dirname(os.path.abspath(__file__)) + os.sep,)
+
+_STDLIB_PATH = sysconfig.get_paths()['stdlib'] + os.sep
+_SITE_PATH = sysconfig.get_paths()['purelib'] + os.sep
+
+
+def _ignored(filename):
+    if filename.startswith(_LIBRARY_PATHS):
+        return True
+
+    return filename.startswith(_STDLIB_PATH) and not filename.startswith(_SITE_PATH)
+
+
+def call_origin():
+    """Returns where in the application the current storage call was made."""
+    for frame in reversed(traceback.extract_stack()):
+        if not _ignored(frame.filename):
+            return '{}:{} in {}'.format(frame.filename, frame.lineno, frame.name)
+
+    return None
+
+
+class Profile:
+    def __init__(self):
+        self.calls = []
+        self.requests = collections.Counter()
+
+        self._lock = threading.Lock()
+
+    def record(self, call: Call):
+        with self._lock:
+            self.calls.append(call)
+
+    def count_request(self, request):
+        with self._lock:
+            self.requests[request] += 1
+
+    @property
+    def duration(self):
+        """Time spent in storage calls; calls made by other storage calls are already counted in theirs."""
+        return sum(call.duration for call in self.calls if not call.nested)
+
+    def duplicates(self):
+        """Returns {(operation, bucket, key): [calls]} for each call repeated on the same key."""
+        calls = collections.defaultdict(list)
+
+        for call in self.calls:
+            if call.key is not None:
+                calls[call.operation, call.bucket, call.key].append(call)
+
+        return {repeated: calls for repeated, calls in calls.items() if len(calls) > 1}
+
+    def summary(self):
+        requests = ', '.join('{} {}'.format(count, request) for request, count in sorted(self.requests.items()))
+
+        return '{} storage calls ({}) in {:.1f}ms, {} repeated'.format(
+            len(self.calls), requests or 'no round trips', self.duration * 1000, len(self.duplicates()))
+
+
+class StorageProfiler:
+    """
+    Records every storage call made while handling each request, for finding redundant round trips.
+
+    After each request, a summary is logged and added as X-Warehouse-* response headers;
+    calls repeated on the same key are logged with where each was made.
+    Intended for development - recording the origin of each call walks the stack.
+    """
+
+    def __init__(self, app=None, headers=True, level=logging.INFO):
+        self.headers = headers
+        self.level = level
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if blinker is None:
+            raise Exception("WAREHOUSE_PROFILE_REQUESTS needs blinker installed, for Flask's signals.")
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+        operation_finished.connect(self._on_operation_finished, weak=False)
+        backend_request.connect(self._on_backend_request, weak=False)
+
+    def current(self):
+        """Returns the Profile of the request being handled, or None."""
+        if not has_request_context() or g.get('_warehouse_profiler') is not self:
+            return None  # not profiled, or by another app's profiler
+
+        return g.get('_warehouse_profile')
+
+    def _start(self):
+        g._warehouse_profiler = self
+        g._warehouse_profile = Profile()
+
+    def _on_operation_finished(self, sender, operation, bucket, key, duration, bytes, error):
+        profile = self.current()
+
+        if profile is not None:
+            profile.record(Call(operation, bucket, key, duration, bytes, error, call_origin(),
+                                nested=call_depth() > 1))
+
+    def _on_backend_request(self, sender, service, request, bucket):
+        profile = self.current()
+
+        if profile is not None:
+            profile.count_request(request)
+
+    def _finish(self, response):
+        profile = self.current()
+        g.pop('_warehouse_profile', None)
+
+        if profile is None:
+            return response
+
+        duplicates = profile.duplicates()
+
+        if self.headers:
+            response.headers['X-Warehouse-Calls'] = str(len(profile.calls))
+            response.headers['X-Warehouse-Requests'] = str(sum(profile.requests.values()))
+            response.headers['X-Warehouse-Time'] = '{:.1f}ms'.format(profile.duration * 1000)
+            response.headers['X-Warehouse-Duplicates'] = str(len(duplicates))
+
+        logger.log(self.level, "%s %s: %s", request.method, request.path, profile.summary())
+
+        for (operation, bucket, key), calls in duplicates.items():
+            logger.warning("%s %s/%s was called %d times: %s", operation, bucket, key, len(calls),
+                           '; '.join(sorted(set(str(call.origin) for call in calls))))
+
+        return response
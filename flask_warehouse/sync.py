@@ -0,0 +1,148 @@
+import contextvars
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .backends import Bucket, KeyInfo
+
+
+class SyncResult:
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+
+        self.copied = []
+        self.deleted = []
+        self.skipped = 0
+
+    def __repr__(self):
+        return '<SyncResult copied={} deleted={} skipped={}{}>'.format(
+            len(self.copied), len(self.deleted), self.skipped, ' dry_run' if self.dry_run else '')
+
+
+def changed(src: KeyInfo, dst: KeyInfo):
+    """Whether src needs copying over dst, judged from listings alone."""
+    if dst is None or src.size != dst.size:
+        return True
+
+    # ETags are only comparable between two listings that both have them
+    if src.etag and dst.etag:
+        return src.etag != dst.etag
+
+    return src.mtime > dst.mtime
+
+
+def merge(src_infos, dst_infos):
+    """Joins two key-ordered listings, yielding (src, dst) pairs with None for a missing side."""
+    src_info, dst_info = next(src_infos, None), next(dst_infos, None)
+
+    while src_info is not None or dst_info is not None:
+        if dst_info is None or (src_info is not None and src_info.key < dst_info.key):
+            yield src_info, None
+            src_info = next(src_infos, None)
+        elif src_info is None or dst_info.key < src_info.key:
+            yield None, dst_info
+            dst_info = next(dst_infos, None)
+        else:
+            yield src_info, dst_info
+            src_info, dst_info = next(src_infos, None), next(dst_infos, None)
+
+
+class Checkpoint:
+    """Appends each finished key to a file, so an interrupted sync can skip them."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.done = set(line.rstrip('\n') for line in f)
+
+        self._file = open(path, 'a') if path is not None else None
+        self._lock = threading.Lock()
+
+    def record(self, key):
+        if self._file is None:
+            return
+
+        with self._lock:
+            self._file.write(key + '\n')
+            self._file.flush()
+
+    def finish(self):
+        if self._file is not None:
+            self._file.close()
+            os.remove(self.path)
+
+
+def sync(src: Bucket, dst: Bucket, prefix=None, delete=False, dry_run=False, checkpoint=None, max_workers=8):
+    """
+    Makes dst's keys under prefix match src's, copying only what changed.
+
+    Both buckets are listed lazily and merged in key order, so memory does not grow
+    with the number of keys. Keys are compared by size, then ETag where both sides
+    have one, else modification time. With delete=True, keys only in dst are removed.
+    With a checkpoint path, finished keys are recorded so a rerun after a failure
+    resumes where it stopped; the file is removed once the sync completes.
+    """
+    result = SyncResult(dry_run=dry_run)
+    checkpoint = Checkpoint(None if dry_run else checkpoint)
+
+    # bound the work in flight, rather than queueing a future per key up front
+    in_flight = threading.BoundedSemaphore(max_workers * 4)
+    lock = threading.Lock()
+
+    def copy(key):
+        try:
+            src.cubby(key).copy_to(cubby=dst.cubby(key))
+            checkpoint.record(key)
+
+            with lock:
+                result.copied.append(key)
+        finally:
+            in_flight.release()
+
+    def remove(key):
+        try:
+            dst.cubby(key).delete()
+            checkpoint.record(key)
+
+            with lock:
+                result.deleted.append(key)
+        finally:
+            in_flight.release()
+
+    futures = []
+    context = contextvars.copy_context()
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='warehouse-sync') as executor:
+        for src_info, dst_info in merge(src.scan(prefix), dst.scan(prefix)):
+            if src_info is not None:
+                key, work = src_info.key, copy if changed(src_info, dst_info) else None
+            else:
+                key, work = dst_info.key, remove if delete else None
+
+            if work is None or key in checkpoint.done:
+                result.skipped += 1
+                continue
+
+            if dry_run:
+                (result.copied if work is copy else result.deleted).append(key)
+                continue
+
+            in_flight.acquire()
+            futures.append(executor.submit(context.copy().run, work, key))
+
+            # surface failures early, and don't keep finished futures around
+            if len(futures) >= max_workers * 4:
+                for future in [future for future in futures if future.done()]:
+                    future.result()
+                    futures.remove(future)
+
+        for future in futures:
+            future.result()
+
+    checkpoint.finish()
+
+    return result
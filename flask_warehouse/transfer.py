@@ -0,0 +1,174 @@
+import contextvars
+import hashlib
+import io
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_MAX_CHUNKS = 16
+
+
+class TransferError(Exception):
+    pass
+
+
+class Pipe:
+    """
+    A bounded in-memory pipe between one writer thread and one reader thread.
+
+    At most max_chunks writes are buffered; the writer blocks until the reader catches up.
+    If either side fails, the other side gets the error instead of blocking forever.
+    """
+
+    def __init__(self, max_chunks=DEFAULT_MAX_CHUNKS):
+        self._chunks = queue.Queue(maxsize=max_chunks)
+        self._aborted = threading.Event()
+        self._error = None
+
+        self.reader = PipeReader(self)
+        self.writer = PipeWriter(self)
+
+    def put(self, chunk):
+        while True:
+            if self._aborted.is_set():
+                raise BrokenPipeError("The reading end of the pipe was closed.")
+
+            try:
+                self._chunks.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        chunk = self._chunks.get()
+
+        if chunk is None and self._error is not None:
+            raise self._error
+
+        return chunk
+
+    def close(self, error=None):
+        """Called by the writer when it is done, or failed with 'error'."""
+        self._error = error
+        self.put(None)
+
+    def abort(self):
+        """Called by the reader when it gives up, unblocking the writer."""
+        self._aborted.set()
+
+
+class PipeWriter(io.RawIOBase):
+    def __init__(self, pipe: Pipe):
+        self.pipe = pipe
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if data:
+            data = bytes(data)
+            self.md5.update(data)
+            self.size += len(data)
+            self.pipe.put(data)
+
+        return len(data)
+
+
+class PipeReader(io.RawIOBase):
+    def __init__(self, pipe: Pipe):
+        self.pipe = pipe
+
+        self._buffer = b''
+        self._eof = False
+
+    @property
+    def eof(self):
+        """Whether the writer's whole output has been read."""
+        return self._eof
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and not self._eof:
+            chunk = self.pipe.get()
+
+            if chunk is None:
+                self._eof = True
+            else:
+                self._buffer = chunk
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+
+        return n
+
+
+def transfer(src, dst, max_chunks=DEFAULT_MAX_CHUNKS, verify=True):
+    """
+    Streams src's contents into dst, across any two backends.
+
+    A thread reads from src into a bounded Pipe while this thread stores from it, so
+    neither side ever holds the whole object. Headers are carried over, and with
+    verify=True dst's stored size, and MD5 where its backend keeps one (e.g. a plain
+    S3 upload's ETag), are checked against the bytes read from src.
+    """
+    pipe = Pipe(max_chunks=max_chunks)
+    headers = src.headers()
+
+    def produce():
+        error = None
+
+        try:
+            src.retrieve_filelike(pipe.writer)
+        except BaseException as e:
+            error = e
+
+        try:
+            pipe.close(error=error)
+        except BrokenPipeError:
+            pass  # the store failed, and will raise its own error
+
+    producer = threading.Thread(target=contextvars.copy_context().run, args=(produce,),
+                                name='warehouse-transfer', daemon=True)
+    producer.start()
+
+    try:
+        dst.store_filelike(io.BufferedReader(pipe.reader, DEFAULT_CHUNK_SIZE), **headers)
+        drained = pipe.reader.eof
+    finally:
+        pipe.abort()  # so the producer never waits on a store that stopped reading
+        producer.join()
+
+    if not drained:
+        raise TransferError("{} stopped reading before the end of {}.".format(dst, src))
+
+    # encoded contents are stored as given, but a backend may report them decoded
+    if verify and not headers.get('content_encoding'):
+        size = dst.filesize()
+        if size != pipe.writer.size:
+            raise TransferError("{} is {} bytes after copying {} bytes from {}.".format(
+                dst, size, pipe.writer.size, src))
+
+        stored_md5 = dst.stored_md5()
+        if stored_md5 is not None and stored_md5 != pipe.writer.md5.hexdigest():
+            raise TransferError("{} holds different bytes than {} produced.".format(dst, src))
+
+    return dst
+
+
+def transfer_many(pairs, max_workers=8, move=False):
+    """Copies (or moves) each (src, dst) cubby pair in parallel, returning the destinations."""
+    def copy(pair):
+        src, dst = pair
+        return src.move_to(cubby=dst) if move else src.copy_to(cubby=dst)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='warehouse-copy') as executor:
+        context = contextvars.copy_context()
+        return list(executor.map(lambda pair: context.copy().run(copy, pair), pairs))
@@ -0,0 +1,72 @@
+from flask import Blueprint, abort, current_app, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+
+uploads = Blueprint('warehouse_uploads', __name__)
+
+
+def _serializer():
+    if not current_app.secret_key:
+        raise RuntimeError("SECRET_KEY must be set to sign Warehouse upload tickets.")
+
+    return URLSafeTimedSerializer(current_app.secret_key, salt='flask-warehouse-upload')
+
+
+def sign_upload(bucket, key, expiration, content_type=None, max_size=None):
+    """Returns a signed, time-limited token allowing one key to be uploaded."""
+    ticket = {
+        'bucket': bucket,
+        'key': key,
+        'max_age': expiration.total_seconds(),
+        'content_type': content_type,
+        'max_size': max_size,
+    }
+
+    return _serializer().dumps(ticket)
+
+
+def load_upload(token):
+    serializer = _serializer()
+
+    try:
+        # each ticket says how long it lasts, so the signature is checked before its age is
+        ticket = serializer.loads(token)
+        serializer.loads(token, max_age=ticket['max_age'])
+    except (BadSignature, KeyError):
+        abort(403)
+
+    return ticket
+
+
+@uploads.route('/<token>', methods=['PUT', 'POST'])
+def upload(token):
+    ticket = load_upload(token)
+
+    if request.method == 'POST':
+        if 'file' not in request.files:
+            abort(400)
+
+        file = request.files['file']
+        stream, content_type = file.stream, file.mimetype
+
+        stream.seek(0, 2)
+        size = stream.tell()
+        stream.seek(0)
+    else:
+        stream, content_type = request.stream, request.mimetype
+        size = request.content_length
+
+        if size is None and ticket['max_size'] is not None:
+            abort(411)
+
+    if ticket['max_size'] is not None and size > ticket['max_size']:
+        abort(413)
+
+    if ticket['content_type'] and content_type != ticket['content_type']:
+        abort(415)
+
+    warehouse = current_app.extensions['warehouse']
+    cubby = warehouse('file:///{}/{}'.format(ticket['bucket'], ticket['key']))
+    cubby.store_filelike(stream)
+
+    return '', 204
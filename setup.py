@@ -33,6 +33,7 @@ setup(
                  'flask_warehouse'},
     include_package_data=True,
     install_requires=requirements,
+    python_requires='>=3.8',
     license="MIT license",
     zip_safe=False,
     keywords='flask_warehouse',
@@ -42,9 +43,10 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
     test_suite='tests',
     tests_require=test_requirements
@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import datetime
 import gzip
+import hashlib
+import io
+import os
+import threading
+import time
+import zipfile
 from flask import Flask
 
 """
@@ -21,14 +28,14 @@ from moto import mock_s3
 
 
 @pytest.fixture
-def app():
-    app = Flask(__name__)
+def app(tmp_path):
+    app = Flask(__name__, static_folder=str(tmp_path / 'static'))
     return app
 
 
 @pytest.fixture
-def s3_app():
-    app = Flask(__name__)
+def s3_app(tmp_path):
+    app = Flask(__name__, static_folder=str(tmp_path / 'static'))
 
     app.config['WAREHOUSE_DEFAULT_SERVICE'] = 's3'
     app.config['WAREHOUSE_DEFAULT_LOCATION'] = 'us-west-1'
@@ -107,6 +114,7 @@ def test_s3_service(app):
 
         assert cubby.delete()
 
+
 @mock_s3
 def test_s3_service_gzipped_content(app):
     """Tests gzip support for cubby
@@ -248,4 +256,1316 @@ def test_change_acl(s3_app):
     example_source.set_mimetype("application/json")
 
     example_source._key.Acl().load()
-    assert example_source._key.Acl().grants == grants  # grants should be the same before/after
\ No newline at end of file
+    assert example_source._key.Acl().grants == grants  # grants should be the same before/after
+
+
+def test_file_upload_url(app):
+    app.config['SECRET_KEY'] = 'secret'
+    warehouse = Warehouse(app)
+
+    with app.test_request_context():
+        cubby = warehouse('file:///uploads/direct')
+        cubby.delete()
+
+        url = cubby.upload_url(content_type='text/plain', max_size=5)
+        expired_url = cubby.upload_url(datetime.timedelta(seconds=-1))
+        post = warehouse.bucket('uploads').presigned_post('posted')
+
+    client = app.test_client()
+
+    assert client.put(url, data=b'123456', content_type='text/plain').status_code == 413
+    assert client.put(url, data=b'12345', content_type='image/png').status_code == 415
+    assert client.put(expired_url, data=b'12345').status_code == 403
+    assert client.put(url + 'x', data=b'12345').status_code == 403
+
+    assert client.put(url, data=b'12345', content_type='text/plain').status_code == 204
+    assert cubby.retrieve() == b'12345'
+
+    data = dict(post['fields'], file=(io.BytesIO(b'posted'), 'posted.txt'))
+    assert client.post(post['url'], data=data).status_code == 204
+
+    with app.app_context():
+        assert warehouse('file:///uploads/posted').retrieve() == b'posted'
+        warehouse.bucket('uploads').delete()
+
+
+@mock_s3
+def test_s3_upload_url(s3_app):
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        cubby = warehouse('s3:///uploads/direct')
+
+        url = cubby.upload_url(content_type='text/plain')
+        assert '/uploads/direct?' in url or 'uploads.s3' in url
+        assert 'Signature' in url
+
+        with pytest.raises(Exception):
+            cubby.upload_url(max_size=5)
+
+        post = warehouse.bucket('uploads').presigned_post('posted', content_type='text/plain', max_size=10)
+        assert post['fields']['key'] == 'posted'
+        assert post['fields']['Content-Type'] == 'text/plain'
+        assert 'policy' in post['fields']
+
+
+def test_async_warehouse(app):
+    import asyncio
+
+    from flask_warehouse.aio import AsyncWarehouse
+
+    warehouse = AsyncWarehouse(app)
+
+    async def run():
+        bucket = await warehouse('file:///asyncbucket')
+        cubbies = [bucket.cubby('key{}'.format(i)) for i in range(5)]
+
+        await warehouse.store_many([(cubby, str(i).encode()) for i, cubby in enumerate(cubbies)])
+        assert await warehouse.retrieve_many(cubbies) == [b'0', b'1', b'2', b'3', b'4']
+
+        cubby = await warehouse('file:///asyncbucket/key0')
+        assert await cubby.exists()
+        assert await cubby.filesize() == 1
+
+        copy = await cubby.copy_to(cubby=bucket.cubby('copy'))
+        assert await copy.retrieve() == b'0'
+
+        keys = sorted([cubby.key async for cubby in bucket.list()])
+        assert keys == ['copy', 'key0', 'key1', 'key2', 'key3', 'key4']
+
+        await bucket.delete()
+
+    asyncio.run(run())
+    warehouse.close()
+
+
+def test_background_store(app, monkeypatch):
+    import threading
+
+    from flask_warehouse.backends.file import FileCubby
+
+    warehouse = Warehouse(app)
+    uploading, started = threading.Event(), threading.Event()
+
+    store_filelike = FileCubby.store_filelike
+
+    def slow_store_filelike(self, filelike):
+        started.set()
+        uploading.wait(5)
+        return store_filelike(self, filelike)
+
+    monkeypatch.setattr(FileCubby, 'store_filelike', slow_store_filelike)
+
+    with app.app_context():
+        cubby = warehouse('file:///background/artifact')
+        cubby.delete()
+
+        pending = cubby.store(bytes=b'12345', background=True)
+        assert pending.status == 'pending'
+        assert not cubby.exists()
+        assert cubby.retrieve() == b'12345'  # read-your-writes from the staged copy
+
+        uploading.set()
+        warehouse.flush()
+
+        assert pending.done()
+        assert pending.wait() == cubby
+        assert pending.status == 'done'
+        assert not os.path.exists(pending.staging_path)
+        assert cubby.retrieve() == b'12345'
+
+        # stores to one cubby land in order: the one queued behind the upload is superseded
+        uploading.clear()
+        started.clear()
+        stores = [cubby.store(bytes=b'1', background=True)]
+        started.wait(5)
+        stores += [cubby.store(bytes=contents, background=True) for contents in [b'22', b'333']]
+
+        uploading.set()
+        warehouse.flush()
+
+        assert [pending.status for pending in stores] == ['done', 'superseded', 'done']
+        assert cubby.retrieve() == b'333'
+
+        warehouse.bucket('background').delete()
+
+
+def test_background_flush_on_teardown(app, monkeypatch):
+    import threading
+
+    from flask_warehouse.backends.file import FileCubby
+
+    app.config['WAREHOUSE_BACKGROUND_FLUSH_ON_TEARDOWN'] = True
+    warehouse = Warehouse(app)
+    uploading = threading.Event()
+
+    store_filelike = FileCubby.store_filelike
+
+    def slow_store_filelike(self, filelike):
+        if self.key == 'slow':
+            uploading.wait(5)
+
+        return store_filelike(self, filelike)
+
+    monkeypatch.setattr(FileCubby, 'store_filelike', slow_store_filelike)
+
+    with app.app_context():
+        slow = warehouse('file:///torndown/slow').store(bytes=b'1', background=True)
+
+        # another context's teardown waits for its own stores, not this one's
+        with app.app_context():
+            fast = warehouse('file:///torndown/fast').store(bytes=b'2', background=True)
+
+        assert fast.done() and not slow.done()
+        uploading.set()
+
+    assert slow.done()
+
+    with app.app_context():
+        warehouse.bucket('torndown').delete()
+
+
+@mock_s3
+def test_s3_update_headers(s3_app):
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        cubby = warehouse.bucket('headers').cubby('example', acl='public-read')
+        cubby.store(bytes=b'12345', content_type='text/plain', metadata={'tag': 'value'})
+
+        assert cubby.mimetype() == 'text/plain'
+        assert cubby.metadata() == {'tag': 'value'}
+
+        calls = []
+        cubby._key.meta.client.meta.events.register('before-call.s3', lambda model, **kwargs: calls.append(model.name))
+
+        cubby.update_headers(content_type='application/json', content_encoding='identity',
+                             metadata={'tag': 'other'})
+        assert calls == ['HeadObject', 'CopyObject']
+
+        assert cubby.mimetype() == 'application/json'
+        assert cubby.content_encoding() == 'identity'
+        assert cubby.metadata() == {'tag': 'other'}
+
+        cubby.update_headers(content_type='text/csv')
+        assert cubby.metadata() == {'tag': 'other'}
+        assert cubby.retrieve() == b'12345'
+
+
+@mock_s3
+def test_s3_update_headers_multipart_copy(s3_app):
+    s3_app.config['WAREHOUSE_S3_MULTIPART_COPY_THRESHOLD'] = 5 * 1024 ** 2
+    s3_app.config['WAREHOUSE_S3_MULTIPART_COPY_CHUNKSIZE'] = 5 * 1024 ** 2
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        contents = b'x' * (6 * 1024 ** 2)
+        cubby = warehouse.bucket('headers').cubby('large').store(bytes=contents)
+
+        cubby.update_headers(content_type='application/octet-stream', metadata={'tag': 'value'})
+
+        assert cubby.mimetype() == 'application/octet-stream'
+        assert cubby.metadata() == {'tag': 'value'}
+        assert cubby.retrieve() == contents
+
+
+@mock_s3
+def test_cross_backend_copy(s3_app):
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        s3_cubby = warehouse('s3:///crossbackend/example.json')
+        s3_cubby.store(bytes=b'{"a": 1}' * 100000, content_type='application/json', metadata={'tag': 'value'})
+
+        file_cubby = s3_cubby.copy_to(cubby=warehouse('file:///crossbackend/example.json'))
+        assert file_cubby.retrieve() == s3_cubby.retrieve()
+
+        copy = file_cubby.copy_to(cubby=warehouse('s3:///crossbackend/copy.json'))
+        assert copy.retrieve() == s3_cubby.retrieve()
+        assert copy.mimetype() == 'application/json'
+
+        gzipped = warehouse('s3:///crossbackend/gzipped')
+        gzipped.store(bytes=b'12345', content_encoding='gzip')
+        gzipped.copy_to(cubby=warehouse('s3:///crossbackend/gzipped-copy'))  # native copy
+        copy = gzipped.copy_to(cubby=warehouse('file:///crossbackend/gzipped'))
+        assert copy.retrieve() == b'12345'
+
+        warehouse('file:///crossbackend').delete()
+
+
+@mock_s3
+def test_copy_move_prefix(s3_app):
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        source = warehouse.bucket('prefixes')
+        for key in ['a/1', 'a/2', 'a/b/3', 'a.txt', 'b/4']:
+            source.cubby(key).store(string=key)
+
+        local = warehouse('file:///prefixes')
+        copies = source.copy_prefix('a/', local)
+        assert [cubby.key for cubby in copies] == ['a/1', 'a/2', 'a/b/3']
+        assert [cubby.key for cubby in local.list(prefix='a')] == ['a/1', 'a/2', 'a/b/3']
+        assert local.cubby('a/b/3').retrieve() == b'a/b/3'
+
+        local.move_prefix('a/', dst_prefix='moved/')
+        assert [cubby.key for cubby in local.list()] == ['moved/1', 'moved/2', 'moved/b/3']
+
+        source.move_prefix('a/', dst_prefix='c/')
+        assert sorted(cubby.key for cubby in source.list()) == ['a.txt', 'b/4', 'c/1', 'c/2', 'c/b/3']
+
+        local.delete()
+
+
+@mock_s3
+def test_sync(s3_app, tmpdir):
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        source = warehouse.bucket('syncsource')
+        for key in ['a/1', 'a/2', 'a/b/3', 'b/4']:
+            source.cubby(key).store(string=key)
+
+        mirror = warehouse('file:///syncmirror')
+        mirror.cubby('a/extra').store(string='extra')
+
+        result = warehouse.sync('s3:///syncsource', 'file:///syncmirror', prefix='a/', delete=True, dry_run=True)
+        assert result.copied == ['a/1', 'a/2', 'a/b/3']
+        assert result.deleted == ['a/extra']
+        assert [cubby.key for cubby in mirror.list()] == ['a/extra']
+
+        result = warehouse.sync('s3:///syncsource', 'file:///syncmirror', prefix='a/', delete=True)
+        assert sorted(result.copied) == ['a/1', 'a/2', 'a/b/3']
+        assert result.deleted == ['a/extra']
+        assert mirror.cubby('a/b/3').retrieve() == b'a/b/3'
+
+        source.cubby('a/2').store(string='changed')
+        result = warehouse.sync('s3:///syncsource', 'file:///syncmirror', prefix='a/')
+        assert result.copied == ['a/2']
+        assert result.skipped == 2
+
+        # keys recorded in a checkpoint are skipped when resuming
+        checkpoint = str(tmpdir.join('checkpoint'))
+        with open(checkpoint, 'w') as f:
+            f.write('b/4\n')
+
+        result = warehouse.sync('s3:///syncsource', 'file:///syncmirror', checkpoint=checkpoint)
+        assert result.copied == []
+        assert not os.path.exists(checkpoint)
+
+        # hidden keys are keys too, so they are mirrored once rather than on every run
+        source.cubby('a/.hidden').store(string='hidden')
+        assert warehouse.sync('s3:///syncsource', 'file:///syncmirror', prefix='a/').copied == ['a/.hidden']
+        assert warehouse.sync('s3:///syncsource', 'file:///syncmirror', prefix='a/').copied == []
+        assert [key for key in mirror.keys('a/')] == ['a/.hidden', 'a/1', 'a/2', 'a/b/3']
+
+        mirror.delete()
+
+
+@mock_s3
+def test_key_index(s3_app, tmpdir):
+    s3_app.config['WAREHOUSE_INDEX_PATH'] = str(tmpdir.join('index.db'))
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        bucket = warehouse.bucket('indexed')
+        bucket.cubby('tenant/42/a').store(bytes=b'123')
+        bucket.cubby('tenant/42/b').store(bytes=b'12345')
+        bucket.cubby('tenant/43/c').store(bytes=b'1')
+
+        assert bucket.count('tenant/42/') == 2
+        assert bucket.total_size('tenant/42/') == 8
+        assert [cubby.key for cubby in bucket.list(prefix='tenant/4')] == ['tenant/42/a', 'tenant/42/b', 'tenant/43/c']
+
+        bucket.cubby('tenant/42/a').move_to(key='tenant/43/a')
+        assert bucket.count('tenant/42/') == 1
+        assert bucket.count('tenant/43/') == 2
+        assert [info.key for info in bucket.modified_since(0, prefix='tenant/43/')] == ['tenant/43/a', 'tenant/43/c']
+
+        # keys written behind the index's back show up after a rebuild
+        bucket._bucket.put_object(Key='tenant/44/d', Body=b'1234')
+        assert bucket.count('tenant/44/') == 0
+        bucket.rebuild_index()
+        assert bucket.count() == 4
+        assert bucket.total_size() == 13
+
+        local = warehouse('file:///indexed')
+        local.cubby('x/y').store(bytes=b'12')
+        assert local.count() == 1
+        assert warehouse.bucket('indexed').count() == 4
+        local.delete()
+        assert local.count() == 0
+
+
+@pytest.mark.parametrize('service', ['file', 's3'])
+@mock_s3
+def test_content_addressed(s3_app, tmpdir, service):
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.test_request_context():
+        bucket = warehouse('{}:///deduped'.format(service)).content_addressed(str(tmpdir.join('refs.db')))
+
+        first = bucket.cubby('first').store(bytes=b'12345')
+        assert first.uploaded
+
+        second = bucket.cubby('nested/second').store(bytes=b'12345')
+        assert not second.uploaded
+        assert second.retrieve() == b'12345'
+        assert first.digest() == second.digest()
+        assert second.url()
+
+        copy = first.copy_to(key='copy')
+        assert copy.retrieve() == b'12345'
+
+        blobs = [key for key in bucket.bucket.scan() if key.key.startswith('.blobs/')] if service == 's3' else \
+            os.listdir(os.path.join(bucket.bucket.abspath, '.blobs', first.digest()[:2]))
+        assert len(blobs) == 1
+
+        assert [cubby.key for cubby in bucket.list()] == ['copy', 'first', 'nested/second']
+
+        first.store(bytes=b'other')
+        assert first.retrieve() == b'other'
+        assert bucket.gc() == 0
+
+        second.delete()
+        copy.delete()
+        assert not copy.exists()
+        assert bucket.gc() == 1
+        assert bucket.count() == 1
+
+        if service == 'file':
+            assert open(os.path.join(bucket.bucket.abspath, 'first'), 'rb').read() == b'other'
+
+        bucket.delete()
+
+
+@pytest.mark.parametrize('service', ['file', 's3', 'memory'])
+@mock_s3
+def test_store_if_changed(s3_app, service, tmpdir, monkeypatch):
+    from flask_warehouse.backends import service as service_module
+    from flask_warehouse.backends.s3 import S3Cubby
+
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        cubby = warehouse('{}:///ifchanged/export.csv'.format(service))
+        cubby.delete()
+
+        assert cubby.store(bytes=b'12345', if_changed=True) is cubby
+        assert cubby.store(bytes=b'12345', if_changed=True) is None
+        assert cubby.store(bytes=b'54321', if_changed=True) is cubby  # same size, different contents
+        assert cubby.retrieve() == b'54321'
+        assert cubby.store(bytes=b'123', if_changed=True) is cubby
+        assert cubby.store(file=io.BytesIO(b'123'), if_changed=True) is None
+
+        if service == 's3':
+            cubby.set_content_encoding('gzip')
+            assert cubby.store(bytes=b'123', if_changed=True) is cubby
+            assert cubby.store(bytes=b'123', if_changed=True) is None
+            assert cubby.retrieve() == b'123'
+
+            # the HEAD that found it changed also tells the upload which headers to keep
+            reload = S3Cubby._reload
+            reloads = []
+            monkeypatch.setattr(S3Cubby, '_reload', lambda self: reloads.append(self) or reload(self))
+            assert cubby.store(bytes=b'4567', if_changed=True) is cubby
+            assert len(reloads) == 1
+            assert cubby.content_encoding() == 'gzip'
+
+        if service == 'file':
+            # a file of the same size and modification time is skipped without hashing it
+            source = tmpdir.join('export.csv')
+            source.write_binary(b'678')
+            assert cubby.store(filepath=str(source), if_changed=True) is cubby
+            assert os.stat(cubby.filepath()).st_mtime_ns == os.stat(str(source)).st_mtime_ns
+
+            monkeypatch.setattr(service_module, 'spool', None)
+            assert cubby.store(filepath=str(source), if_changed=True) is None
+
+        cubby.delete()
+
+
+@pytest.mark.parametrize('service', ['file', 's3'])
+@mock_s3
+def test_checksums(s3_app, service):
+    from flask_warehouse.checksums import ChecksumMismatch
+
+    s3_app.config['WAREHOUSE_CHECKSUMS'] = ('md5', 'sha256')
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        cubby = warehouse('{}:///checksummed/example'.format(service))
+        cubby.store(bytes=b'12345')
+        assert cubby.retrieve() == b'12345'
+
+        large = b'x' * (9 * 1024 ** 2)  # hashed on a separate thread
+        warehouse('{}:///checksummed/large'.format(service)).store(bytes=large)
+        assert warehouse('{}:///checksummed/large'.format(service)).retrieve() == large
+
+        if service == 's3':
+            assert cubby.metadata()['sha256'] == hashlib.sha256(b'12345').hexdigest()
+            cubby.set_metadata({'tag': 'value'})
+            assert cubby.metadata()['md5'] == hashlib.md5(b'12345').hexdigest()
+
+            cubby._key.put(Body=b'54321', Metadata=cubby.metadata())  # corrupt behind our back
+        else:
+            assert cubby.stored_checksums()['sha256'] == hashlib.sha256(b'12345').hexdigest()
+
+            with open(cubby.filepath(), 'wb') as f:
+                f.write(b'54321')
+
+        with pytest.raises(ChecksumMismatch):
+            cubby.retrieve()
+
+        s3_app.config['WAREHOUSE_CHECKSUM_MISMATCH'] = 'warn'
+        warehouse.clear_cache()
+        with pytest.warns(UserWarning):
+            assert warehouse('{}:///checksummed/example'.format(service)).retrieve() == b'54321'
+
+        class Failing(io.RawIOBase):
+            def readable(self):
+                return True
+
+            def readinto(self, b):
+                raise ConnectionError("lost")
+
+        # a store that fails part way still stops its hashing thread
+        with pytest.raises(ConnectionError):
+            warehouse('{}:///checksummed/failed'.format(service)).store(file=Failing())
+
+        assert not [thread for thread in threading.enumerate() if thread.name == 'warehouse-hasher']
+
+        for key in ['example', 'large']:
+            warehouse('{}:///checksummed/{}'.format(service, key)).delete()
+
+
+@pytest.mark.parametrize('format', ['zip', 'tar.gz'])
+@mock_s3
+def test_archive(s3_app, format):
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        src = warehouse('s3:///archived')
+        contents = {'reports/a.txt': b'a' * 10, 'reports/b/c.txt': b'c' * (3 * 1024 ** 2), 'other.txt': b'x'}
+        for key, data in contents.items():
+            src.cubby(key).store(bytes=data)
+
+        stream = io.BytesIO(b''.join(src.archive('reports/', format=format, prefetch=2)))
+
+        dst = warehouse('file:///extracted')
+        cubbies = dst.extract(stream, prefix='restored/', format=format)
+
+        assert sorted(cubby.key for cubby in cubbies) == ['restored/reports/a.txt', 'restored/reports/b/c.txt']
+        assert dst.cubby('restored/reports/b/c.txt').retrieve() == contents['reports/b/c.txt']
+
+        evil = io.BytesIO()
+        with zipfile.ZipFile(evil, 'w') as archive:
+            archive.writestr('../escaped.txt', b'x')
+
+        with pytest.raises(Exception):
+            dst.extract(evil, prefix='restored/')
+
+        for key in contents:
+            src.cubby(key).delete()
+        src.delete()
+        dst.delete()
+
+
+def test_archive_abandoned(app):
+    import threading
+    import time
+
+    warehouse = Warehouse(app)
+
+    def fetching():
+        return [thread for thread in threading.enumerate() if thread.name.startswith('warehouse-archive')]
+
+    with app.app_context():
+        bucket = warehouse('file:///abandoned')
+        bucket.cubby('large').store(bytes=os.urandom(12 * 1024 ** 2))  # more than a pipe holds
+
+        stream = bucket.archive(prefetch=1)
+        next(stream)
+        stream.close()  # as when the client disconnects
+
+        deadline = time.monotonic() + 5
+        while fetching() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        assert not fetching()  # the fetch of the member being written was aborted too
+        bucket.delete()
+
+
+@mock_s3
+def test_metrics(s3_app):
+    import socket
+
+    from flask_warehouse.metrics import operation_finished
+
+    statsd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    statsd.bind(('127.0.0.1', 0))
+    statsd.settimeout(5)
+
+    s3_app.config['WAREHOUSE_METRICS'] = True
+    s3_app.config['WAREHOUSE_STATSD_HOST'] = '127.0.0.1'
+    s3_app.config['WAREHOUSE_STATSD_PORT'] = statsd.getsockname()[1]
+    warehouse = Warehouse(s3_app)
+
+    # another app's metrics don't count this app's calls
+    other_app = Flask(__name__, static_folder=s3_app.static_folder)
+    other_app.config['WAREHOUSE_METRICS'] = True
+    other = Warehouse(other_app)
+
+    operations = []
+
+    def record(sender, **kwargs):
+        operations.append(kwargs)
+
+    operation_finished.connect(record)
+
+    with s3_app.app_context():
+        for service in ['file', 's3']:
+            cubby = warehouse('{}:///measured/example'.format(service))
+            cubby.store(bytes=b'12345')
+            assert cubby.retrieve() == b'12345'
+            assert cubby.exists()
+
+            with pytest.raises(Exception):
+                warehouse('{}:///measured/missing'.format(service)).retrieve()
+
+            cubby.delete()
+
+        # gzipping rewrites the source in place, through the counting wrapper
+        cubby = warehouse('s3:///measured/zipped')
+        cubby.store(bytes=b'hello', content_encoding='gzip')
+        assert cubby.retrieve() == b'hello'
+        cubby.delete()
+
+    assert statsd.recv(4096).decode('utf-8').startswith('warehouse.')
+
+    warehouse.disconnect()
+    other.disconnect()
+    operation_finished.disconnect(record)
+    statsd.close()
+
+    assert not other.metrics.calls
+
+    stores = [op for op in operations if op['operation'] == 'store']
+    assert [op['bytes'] for op in stores][:2] == [5, 5]
+    assert all(op['duration'] >= 0 for op in operations)
+
+    text = warehouse.metrics.prometheus()
+    assert 'warehouse_bytes_total{operation="retrieve",bucket="s3://us-west-1/measured"} 10' in text
+    assert 'warehouse_backend_requests_total{service="s3",request="PUT",bucket="s3://us-west-1/measured"}' in text
+    assert 'warehouse_backend_requests_total{service="file",request="HEAD"' in text
+    assert 'error="FileNotFoundError"} 1' in text
+
+
+def test_metrics_without_blinker(app, monkeypatch):
+    from flask.signals import Namespace
+
+    from flask_warehouse import metrics
+
+    # what Flask's signals are when blinker isn't installed
+    class FakeSignal:
+        send = connect = disconnect = lambda *args, **kwargs: None
+
+    monkeypatch.setattr(metrics, 'operation_finished', FakeSignal())
+    monkeypatch.setattr(metrics, 'backend_request', FakeSignal())
+    assert not metrics.connected(metrics.operation_finished, Namespace().signal('unused'))
+
+    warehouse = Warehouse(app)
+
+    with app.app_context():
+        cubby = warehouse('file:///unsignalled/example').store(bytes=b'12345')
+        assert cubby.exists() and cubby.retrieve() == b'12345'
+
+
+def test_storage_profiler(app, caplog):
+    app.config['WAREHOUSE_PROFILE_REQUESTS'] = True
+    warehouse = Warehouse(app)
+
+    @app.route('/avatar')
+    def avatar():
+        cubby = warehouse('file:///profiled/avatar.png')
+        cubby.store(bytes=b'png')
+
+        if cubby.exists() and cubby.exists():
+            return 'ok'
+
+    with caplog.at_level('INFO', logger='flask_warehouse'):
+        response = app.test_client().get('/avatar')
+
+    assert response.headers['X-Warehouse-Calls'] == '3'
+    assert response.headers['X-Warehouse-Duplicates'] == '1'
+    assert 'GET /avatar: 3 storage calls (2 HEAD, 1 PUT)' in caplog.text
+    assert 'exists' in caplog.text and 'test_flask_warehouse.py' in caplog.text
+
+    with app.app_context():
+        warehouse('file:///profiled').delete()
+
+    # calls made by other calls are reported as nested, and their time isn't counted twice
+    from flask_warehouse.metrics import call_depth, instrumented, operation_finished
+    from flask_warehouse.profiler import Call, Profile
+
+    class Nesting:
+        @instrumented('store')
+        def store(self):
+            return self.exists()
+
+        @instrumented('exists')
+        def exists(self):
+            return True
+
+    depths = []
+
+    def record(sender, operation, **kwargs):
+        depths.append((operation, call_depth()))
+
+    operation_finished.connect(record)
+    try:
+        Nesting().store()
+    finally:
+        operation_finished.disconnect(record)
+
+    assert depths == [('exists', 2), ('store', 1)]
+
+    profile = Profile()
+    profile.record(Call('store', 'b', 'k', 1.0, 3, None, None))
+    profile.record(Call('exists', 'b', 'k', 0.5, None, None, None, nested=True))
+    assert profile.duration == 1.0
+
+
+def test_memory_service(app):
+    from concurrent.futures import ThreadPoolExecutor
+
+    app.config['WAREHOUSE_MEMORY_LATENCY'] = 0.01
+    warehouse = Warehouse(app)
+
+    with app.app_context():
+        cubby = warehouse('memory:///scratch/example.txt')
+        assert cubby.store(string='12345', content_encoding='gzip', metadata={'tag': 'value'}) is cubby
+        assert warehouse('memory:///scratch/example.txt').retrieve() == b'12345'
+
+        cubby.set_mimetype('text/plain')
+        assert cubby.headers() == dict(content_type='text/plain', content_encoding='gzip', metadata={'tag': 'value'})
+        assert cubby.url() == 'memory:///scratch/example.txt'
+
+        bucket = warehouse('memory:///scratch')
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda i: bucket.cubby('many/{:02d}'.format(i)).store(bytes=b'x' * i), range(32)))
+
+        assert [cubby.key for cubby in bucket.list('many/', max_keys=3)] == ['many/00', 'many/01', 'many/02']
+        assert bucket.total_size('many/') == sum(range(32))
+
+        cubby.copy_to(key='copied.txt')
+        assert bucket.cubby('copied.txt').mimetype() == 'text/plain'
+
+        # stores wait for a read-modify-write holding the bucket's lock, rather than being lost to it
+        with bucket.lock:
+            storing = threading.Thread(target=bucket.cubby('copied.txt').store, kwargs=dict(bytes=b'new'))
+            storing.start()
+            storing.join(0.1)
+            assert storing.is_alive() and bucket.cubby('copied.txt').retrieve() == b'12345'
+
+        storing.join()
+        assert bucket.cubby('copied.txt').retrieve() == b'new'
+
+        bucket.delete()
+        assert not warehouse('memory:///scratch/copied.txt').exists()
+
+        # handles made before and after the deletion still share one bucket
+        bucket.cubby('after.txt').store(bytes=b'x')
+        assert warehouse('memory:///scratch/after.txt').exists()
+        warehouse('memory:///scratch').delete()
+        assert not bucket.cubby('after.txt').exists()
+
+    app.config['WAREHOUSE_MEMORY_LATENCY'] = 0
+    app.config['WAREHOUSE_MEMORY_BANDWIDTH'] = 10 * 1024 ** 2
+
+    with app.app_context():
+        start = datetime.datetime.now()
+        warehouse('memory:///throttled/example').store(bytes=b'x' * 1024 ** 2)
+        assert datetime.datetime.now() - start >= datetime.timedelta(seconds=0.1)
+
+
+def test_transfer_verify(app, monkeypatch):
+    from flask_warehouse.backends.memory import MemoryCubby
+    from flask_warehouse.transfer import TransferError, transfer
+
+    warehouse = Warehouse(app)
+
+    with app.app_context():
+        src = warehouse('file:///transferred/large').store(bytes=os.urandom(3 * 1024 ** 2))
+        dst = warehouse('memory:///transferred/large')
+
+        assert transfer(src, dst, max_chunks=1).retrieve() == src.retrieve()
+
+        # checked against what the destination says it holds, not the bytes passed along
+        monkeypatch.setattr(MemoryCubby, 'stored_md5', lambda self: 'd41d8cd98f00b204e9800998ecf8427e')
+        with pytest.raises(TransferError):
+            transfer(src, dst)
+
+        # a store that stops reading early fails rather than leaving the source blocked
+        monkeypatch.setattr(MemoryCubby, 'store_filelike', lambda self, filelike, **headers: filelike.read(1))
+        with pytest.raises(TransferError):
+            transfer(src, dst, max_chunks=1)
+
+        warehouse('file:///transferred').delete()
+
+
+def test_lazy_backends(app):
+    import subprocess
+    import sys
+
+    code = "import sys, flask_warehouse; print('boto3' in sys.modules)"
+    assert subprocess.check_output([sys.executable, '-c', code]).strip() == b'False'
+
+    warehouse = Warehouse(app)
+    assert isinstance(warehouse.services['s3'], str)
+
+    warehouse.services['scratch'] = 'flask_warehouse.backends.memory:MemoryService'
+
+    with app.app_context():
+        assert warehouse('scratch:///lazy/example').store(bytes=b'1').retrieve() == b'1'
+
+        with pytest.raises(Exception):
+            warehouse('missing:///lazy/example')
+
+
+@mock_s3
+def test_s3_connection_reuse(s3_app):
+    from concurrent.futures import ThreadPoolExecutor
+
+    s3_app.config['WAREHOUSE_S3_MAX_POOL_CONNECTIONS'] = 32
+    s3_app.config['WAREHOUSE_S3_READ_TIMEOUT'] = 5
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        service = warehouse('s3:///pooled').service
+        assert warehouse('s3:///pooled').service.client is service.client
+        assert service.client.meta.config.max_pool_connections == 32
+        assert service.client.meta.config.read_timeout == 5
+
+        def store(i):
+            cubby = warehouse('s3:///pooled/{}'.format(i)).store(bytes=b'x')
+            return cubby.service.s3
+
+        with ThreadPoolExecutor(4) as executor:
+            resources = list(executor.map(store, range(16)))
+
+        assert len(set(map(id, resources))) <= 4
+        assert warehouse('s3:///pooled').count() == 16
+
+        # a cubby used from another thread uses that thread's resource, keeping its loaded headers
+        cubby = warehouse('s3:///pooled/0')
+        assert cubby.filesize() == 1
+
+        with ThreadPoolExecutor(1) as executor:
+            client, loaded = executor.submit(lambda: (cubby._key.meta.client, cubby._key.meta.data)).result()
+
+        assert client is not service.s3.meta.client and loaded is not None
+
+        for i in range(16):
+            warehouse('s3:///pooled/{}'.format(i)).delete()
+
+    s3_app.config['WAREHOUSE_S3_MAX_POOL_CONNECTIONS'] = 8
+    warehouse.clear_cache()
+    with s3_app.app_context():
+        assert warehouse('s3:///pooled').service.client is not service.client
+
+
+def test_hedging_policy():
+    from botocore.exceptions import ClientError
+    from flask_warehouse.backends.hedging import CircuitOpenError, HedgingPolicy
+
+    policy = HedgingPolicy(initial_delay=0.05, circuit_failures=3, circuit_reset_timeout=60)
+    calls = []
+
+    def slow_first():
+        calls.append(None)
+        time.sleep(2 if len(calls) == 1 else 0)
+        return len(calls)
+
+    closed = []
+    start = time.time()
+    assert policy.call('bucket', 'GET', slow_first, close=closed.append) == 2
+    assert time.time() - start < 1 and policy.hedges == 1
+
+    # the slow duplicate is released once it answers
+    deadline = time.time() + 5
+    while not closed and time.time() < deadline:
+        time.sleep(0.01)
+    assert closed == [2]
+
+    def failing():
+        raise ClientError({'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'GetObject')
+
+    with pytest.raises(ClientError):
+        policy.call('bucket', 'GET', failing)
+
+    assert policy.retries == 2
+    assert policy.breaker('bucket').open
+
+    with pytest.raises(CircuitOpenError):
+        policy.call('bucket', 'GET', lambda: 'unreachable')
+
+    assert policy.call('other-bucket', 'GET', lambda: 'ok') == 'ok'
+
+
+@mock_s3
+def test_s3_hedged_reads(s3_app):
+    s3_app.config['WAREHOUSE_S3_HEDGING'] = True
+    s3_app.config['WAREHOUSE_S3_HEDGE_INITIAL_DELAY'] = 0.05
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        cubby = warehouse('s3:///hedged/example')
+        cubby.store(bytes=b'12345', metadata={'tag': 'value'})
+
+        hedging = cubby.service.hedging
+        hedges = hedging.hedges
+        delayed = []
+
+        def inject_latency(**kwargs):
+            if not delayed:
+                delayed.append(None)
+                time.sleep(2)
+
+        events = cubby.service.client.meta.events
+        events.register('before-call.s3.GetObject', inject_latency)
+
+        try:
+            start = time.time()
+            assert cubby.retrieve() == b'12345'
+            assert time.time() - start < 1
+        finally:
+            events.unregister('before-call.s3.GetObject', inject_latency)
+
+        assert hedging.hedges == hedges + 1
+        assert cubby.metadata() == {'tag': 'value'}
+        assert not warehouse('s3:///hedged/missing').exists()
+
+        cubby.delete()
+
+
+def test_tiered_service(app, tmpdir, monkeypatch):
+    import threading
+
+    from flask_warehouse.backends import tiered
+    from flask_warehouse.backends.memory import MemoryCubby
+
+    app.config['WAREHOUSE_TIERED_INDEX_PATH'] = str(tmpdir.join('tiers.db'))
+    app.config['WAREHOUSE_TIERED_CAPACITY_SERVICE'] = 'memory'
+    app.config['WAREHOUSE_TIERED_DISK_BUDGET'] = 25
+    app.config['WAREHOUSE_TIERED_PROMOTION_RETRIES'] = 1
+    app.config['WAREHOUSE_TIERED_PROMOTION_BACKOFF'] = 0
+    warehouse = Warehouse(app)
+
+    with app.app_context():
+        bucket = warehouse('tiered:///tiers')
+
+        for i in range(3):
+            bucket.cubby('hot/{}'.format(i)).store(bytes=b'x' * 10, content_type='text/plain')
+
+        # listed before promotion from the local tier, and after from the capacity tier
+        assert [info.key for info in bucket.scan('hot/')] == ['hot/0', 'hot/1', 'hot/2']
+
+        warehouse.flush()
+        bucket.service.flush_evictions()
+
+        remote = warehouse('memory:///tiers')
+        assert remote.count('hot/') == 3
+        assert remote.cubby('hot/0').mimetype() == 'text/plain'
+
+        # the least recently used copy was evicted from local disk to meet the budget
+        placements = {key: bucket.cubby(key).placement() for key in ['hot/0', 'hot/1', 'hot/2']}
+        assert [placements[key].local for key in sorted(placements)] == [0, 1, 1]
+
+        assert bucket.cubby('hot/0').retrieve() == b'x' * 10
+        bucket.service.flush_evictions()
+        assert bucket.cubby('hot/0').placement().local
+        assert bucket.cubby('hot/0').headers()['content_type'] == 'text/plain'
+        assert not bucket.cubby('hot/1').placement().local
+        assert bucket.service.placements.local_size() == 20
+
+        # an eviction planned before a newer write leaves the newer copy alone
+        stale = bucket.cubby('hot/2').placement()
+        monkeypatch.setattr(bucket.service.placements, 'evictable', lambda limit=100: [stale])
+        bucket.cubby('hot/2').store(bytes=b'z' * 10)
+        bucket.service.evict()
+        assert bucket.cubby('hot/2').placement().local
+        assert bucket.cubby('hot/2').local.retrieve() == b'z' * 10
+        warehouse.flush()
+        bucket.service.flush_evictions()
+
+        bucket.cubby('hot/2').delete()
+        assert not bucket.cubby('hot/2').exists()
+        assert [info.key for info in bucket.scan()] == ['hot/0', 'hot/1']
+        assert bucket.service.placements.local_size() == 10
+
+        # a promotion that keeps failing stays local, and is queued again by the next process
+        store = MemoryCubby.store_filelike
+        monkeypatch.setattr(MemoryCubby, 'store_filelike', lambda *args, **kwargs: 1 / 0)
+        bucket.cubby('cold').store(bytes=b'y')
+        warehouse.flush()
+        assert not bucket.cubby('cold').placement().remote
+
+        monkeypatch.setattr(MemoryCubby, 'store_filelike', store)
+        monkeypatch.setattr(tiered, '_requeued', set())
+        tiered.TieredBucket(bucket.service, 'tiers', None)
+
+        for thread in threading.enumerate():
+            if thread.name == 'warehouse-tiered-requeue':
+                thread.join()
+
+        warehouse.flush()
+        assert bucket.cubby('cold').placement().remote
+        assert remote.cubby('cold').retrieve() == b'y'
+
+        bucket.delete()
+
+
+def test_replicated_service(app, monkeypatch):
+    from flask_warehouse.backends.memory import MemoryCubby
+    from flask_warehouse.backends.replicated import QuorumError
+
+    app.config['WAREHOUSE_REPLICATED_TARGETS'] = ['memory://a', 'memory://b', 'memory://c']
+    warehouse = Warehouse(app)
+
+    store = MemoryCubby.store_filelike
+
+    def flaky_store(cubby, filelike, **kwargs):
+        if cubby.bucket.location in failing:
+            filelike.read(10)
+            raise ConnectionError("{} is down".format(cubby.bucket.location))
+
+        return store(cubby, filelike, **kwargs)
+
+    monkeypatch.setattr(MemoryCubby, 'store_filelike', flaky_store)
+
+    with app.app_context():
+        bucket = warehouse('replicated:///copies')
+        data = os.urandom(3 * 1024 * 1024 + 7)
+
+        # two of three is a quorum; the third replica is repaired in the background
+        failing = {'c'}
+        bucket.cubby('one').store(bytes=data, content_type='application/octet-stream')
+        assert warehouse('memory://c/copies').cubby('one').exists() is False
+
+        failing = set()
+        bucket.service.flush_repairs()
+
+        for location in 'abc':
+            assert warehouse('memory://{}/copies'.format(location)).cubby('one').retrieve() == data
+
+        # health is kept per replica bucket, so its other keys are read from it last too
+        assert not bucket.service.health.healthy(warehouse('memory://c/copies').cubby('other'))
+        assert bucket.service.health.healthy(warehouse('memory://a/copies').cubby('other'))
+
+        failing = {'b', 'c'}
+        with pytest.raises(QuorumError):
+            bucket.cubby('two').store(bytes=b'lost')
+
+        # reads fall back to a replica that has a key; repair copies it to the rest, even the
+        # replica that stored a write short of its quorum
+        failing = set()
+        warehouse('memory://b/copies').cubby('three').store(bytes=b'partial')
+        assert bucket.cubby('three').retrieve() == b'partial'
+        assert bucket.service.health.healthy(warehouse('memory://a/copies').cubby('three'))  # only missing it
+        assert [info.key for info in bucket.scan()] == ['one', 'three', 'two']
+
+        repaired = bucket.repair()
+        assert sorted(str(cubby) for cubby in repaired) == ['memory://a/copies/three', 'memory://b/copies/two',
+                                                            'memory://c/copies/three', 'memory://c/copies/two']
+        assert warehouse('memory://c/copies').cubby('two').retrieve() == b'lost'
+
+        # a copy of the same size but different contents is repaired from the newest too
+        warehouse('memory://c/copies').cubby('three').store(bytes=b'PARTIAL')
+        assert sorted(str(cubby) for cubby in bucket.repair()) == ['memory://a/copies/three',
+                                                                   'memory://b/copies/three']
+        assert warehouse('memory://a/copies').cubby('three').retrieve() == b'PARTIAL'
+
+        bucket.delete()
+
+
+def test_resolve_many(app):
+    from flask_warehouse.flask_warehouse import parse_uri
+
+    warehouse = Warehouse(app)
+
+    with app.app_context():
+        uris = ['memory:///batch/{}'.format(i) for i in range(100)] + ['memory://other/batch', 'memory:///batch']
+        handles = warehouse.resolve_many(uris)
+
+        assert [cubby.key for cubby in handles[:100]] == [str(i) for i in range(100)]
+        assert len({id(cubby.bucket) for cubby in handles[:100]}) == 1
+        assert handles[101] is handles[0].bucket
+        assert str(handles[100]) == 'memory://other/batch'
+
+        # handles are cached between calls, until their bucket is deleted
+        assert warehouse('memory:///batch/0').bucket is handles[101]
+        assert parse_uri('memory:///batch/0') == ('memory', None, 'batch', '0')
+
+        handles[101].delete()
+        assert warehouse('memory:///batch') is not handles[101]
+
+        # or the settings they were built with change, and the cache is cleared
+        bucket = warehouse('memory:///batch')
+        app.config['WAREHOUSE_MEMORY_LATENCY'] = 0
+        assert warehouse('memory:///batch') is bucket
+        warehouse.clear_cache()
+        assert warehouse('memory:///batch') is not bucket
+
+        with pytest.raises(Exception):
+            warehouse.resolve_many(['memory:/nope'])
+
+
+@mock_s3
+def test_s3_bucket_deleted_elsewhere(s3_app):
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        bucket = warehouse('s3:///recreated')
+        bucket.cubby('example').store(bytes=b'1').delete()
+        bucket.service.s3.Bucket('recreated').delete()  # not through the cached handle
+
+        # a store through the cached handle creates the bucket again
+        assert warehouse('s3:///recreated') is bucket
+        assert warehouse('s3:///recreated/example').store(bytes=b'2').retrieve() == b'2'
+
+        bucket.cubby('example').delete()
+        bucket.delete()
+
+
+@mock_s3
+def test_compact_cubby_handles(s3_app):
+    from flask_warehouse.backends.dedupe import ContentAddressedCubby
+    from flask_warehouse.backends.file import FileCubby
+    from flask_warehouse.backends.memory import MemoryCubby
+    from flask_warehouse.backends.replicated import ReplicatedCubby
+    from flask_warehouse.backends.s3 import S3Cubby
+    from flask_warehouse.backends.tiered import TieredCubby
+
+    for cls in [S3Cubby, FileCubby, MemoryCubby, TieredCubby, ReplicatedCubby, ContentAddressedCubby]:
+        assert cls.__dictoffset__ == 0, cls  # no per-instance __dict__
+
+    warehouse = Warehouse(s3_app)
+
+    with s3_app.app_context():
+        # no boto3 Object until the cubby is used
+        cubby = warehouse('s3:///compact/a/b.txt')
+        assert cubby._object is None
+
+        cubby.store(bytes=b'12345')
+        assert cubby._object is not None
+        assert warehouse('s3:///compact').list()[0].retrieve() == b'12345'
+        cubby.delete()
+
+        # no folders until the file is written
+        cubby = warehouse('file:///compact/deep/nested/c.txt')
+        assert not os.path.exists(cubby.dirpath())
+
+        cubby.store(bytes=b'12345')
+        assert cubby.retrieve() == b'12345'
+        warehouse('file:///compact').delete()
+
+
+def test_file_lifecycle(app):
+    app.config['WAREHOUSE_FILE_LIFECYCLE'] = {
+        'exports': [{'prefix': 'tmp/', 'expire_days': 7}, {'prefix': 'cache/', 'max_size': 25}],
+    }
+    app.config['WAREHOUSE_FILE_LIFECYCLE_INTERVAL'] = None
+    warehouse = Warehouse(app)
+
+    with app.app_context():
+        bucket = warehouse('file:///exports')
+        now = time.time()
+
+        for key, age in [('tmp/old/a.csv', 8), ('tmp/new.csv', 1), ('keep.csv', 30)]:
+            cubby = bucket.cubby(key).store(bytes=b'x' * 10)
+            os.utime(cubby.filepath(), (now - age * 86400, now - age * 86400))
+
+        for i in range(4):
+            cubby = bucket.cubby('cache/{}'.format(i)).store(bytes=b'x' * 10)
+            os.utime(cubby.filepath(), (now - 100 + i, now - 100 + i))
+
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(args=['warehouse', 'gc', '--dry-run'])
+    assert result.exit_code == 0, result.output
+    assert result.output == 'exports: scanned 6 files, expired 1, evicted 2, would free 30 B\n'
+
+    with app.app_context():
+        assert bucket.count() == 7
+
+    result = runner.invoke(args=['warehouse', 'gc', 'exports'])
+    assert result.output == 'exports: scanned 6 files, expired 1, evicted 2, freed 30 B\n'
+
+    with app.app_context():
+        # the least recently used were evicted, and the emptied folder pruned
+        assert list(bucket.keys()) == ['cache/2', 'cache/3', 'keep.csv', 'tmp/new.csv']
+        assert not os.path.exists(os.path.join(bucket.abspath, 'tmp', 'old'))
+
+    assert runner.invoke(args=['warehouse', 'gc', 'imports']).exit_code != 0
+
+    with app.app_context():
+        # a file rewritten since the sweep scanned it is left alone
+        from flask_warehouse.lifecycle import Sweep
+
+        cubby = bucket.cubby('keep.csv')
+        scanned = os.stat(cubby.filepath())
+        cubby.store(bytes=b'rewritten')
+        assert not Sweep(bucket, [])._remove('keep.csv', scanned)
+        assert cubby.retrieve() == b'rewritten'
+
+        bucket.delete()
+
+
+def test_lifecycle_sweeper(app):
+    import fcntl
+
+    from flask_warehouse import lifecycle
+
+    app.config['WAREHOUSE_FILE_LIFECYCLE'] = {'swept': [{'expire_days': 1}]}
+    Warehouse(app)
+    warehouse = Warehouse(app)  # initialized twice, but swept by one thread
+
+    sweepers = [sweeper for (pid, swept_app), sweeper in lifecycle._sweepers.items() if swept_app is app]
+    assert len(sweepers) == 1
+
+    sweeper = sweepers[0]
+    sweeper.stop()
+
+    with app.app_context():
+        warehouse('file:///swept/a').store(bytes=b'x')
+
+    # another process is sweeping
+    os.makedirs(os.path.dirname(sweeper.lock_path), exist_ok=True)
+    with open(sweeper.lock_path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        assert sweeper.sweep_once() is None
+
+    assert sweeper.sweep_once()['swept'].scanned == 1
+
+    with app.app_context():
+        warehouse('file:///swept').delete()
+
+
+def test_file_locking(app):
+    from concurrent.futures import ThreadPoolExecutor
+
+    app.config['WAREHOUSE_FILE_LOCK_STRIPES'] = 4
+    app.config['WAREHOUSE_CHECKSUMS'] = ('md5',)  # verified by reads racing the stores
+    warehouse = Warehouse(app)
+
+    with app.app_context():
+        bucket = warehouse('file:///locked')
+        cubby = bucket.cubby('counter')
+        cubby.store(bytes=b'0')
+
+        contents = [bytes([i]) * 1024 * 1024 for i in range(8)]
+
+        def write_and_read(i):
+            with app.app_context():
+                bucket.cubby('shared').store(bytes=contents[i])
+                assert bucket.cubby('shared').retrieve() in contents  # never a partial write
+
+                # a read-modify-write, with the store nested in the lock
+                with cubby.lock():
+                    cubby.store(bytes=str(int(cubby.retrieve()) + 1).encode())
+
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(write_and_read, list(range(8)) * 4))
+
+        assert cubby.retrieve() == b'32'
+
+        # lock files are striped, and kept out of the static folder
+        locks = os.path.dirname(bucket.lock_path('counter'))
+        assert len(os.listdir(locks)) <= 4
+        assert not locks.startswith(bucket.abspath)
+        assert list(bucket.keys()) == ['counter', 'shared']
+        assert sorted(os.listdir(bucket.abspath)) == ['.counter.checksums', '.shared.checksums', 'counter', 'shared']
+
+        # a store can't take the lock exclusively while it's held shared
+        with cubby.lock(shared=True):
+            with pytest.raises(Exception):
+                cubby.store(bytes=b'1')
+
+        assert cubby.retrieve() == b'32'
+
+        assert cubby.delete() and cubby.delete()
+        bucket.delete()
+
+
+def test_cli_bulk_transfers(app, tmpdir, capsys):
+    warehouse = Warehouse(app)
+    runner = app.test_cli_runner()
+
+    local = tmpdir.mkdir('local')
+    local.join('a.txt').write_binary(b'a' * 10)
+    local.mkdir('sub').join('b.txt').write_binary(b'b' * 20)
+    local.join('sub').join('c.txt').write_binary(b'c' * 30)
+    manifest = str(tmpdir.join('manifest.jsonl'))
+
+    result = runner.invoke(args=['warehouse', 'upload', str(local), 'memory:///bulk/in/', '--manifest', manifest])
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith('Uploaded 3 files (60 B) in ')
+
+    # resuming skips what the manifest records as done
+    result = runner.invoke(args=['warehouse', 'upload', str(local), 'memory:///bulk/in/', '--manifest', manifest])
+    assert '0 files' in result.output and '3 skipped' in result.output
+
+    # but a source changed since, even to the same size, is uploaded again
+    local.join('a.txt').write_binary(b'A' * 10)
+    os.utime(str(local.join('a.txt')), (1, 1))
+    result = runner.invoke(args=['warehouse', 'upload', str(local), 'memory:///bulk/in/', '--manifest', manifest])
+    assert result.output.startswith('Uploaded 1 file') and '2 skipped' in result.output
+
+    # reading from a mistyped bucket fails without creating it
+    result = runner.invoke(args=['warehouse', 'ls', 'file:///bulk-typo'])
+    assert result.exit_code != 0 and 'does not exist' in result.output
+    assert not os.path.exists(os.path.join(app.static_folder, 'bulk-typo'))
+
+    assert runner.invoke(args=['warehouse', 'ls', 'memory:///bulk/in/sub']).output == 'in/sub/b.txt\nin/sub/c.txt\n'
+    assert runner.invoke(args=['warehouse', 'ls', '-l', 'memory:///bulk']).output.splitlines()[0].split()[0] == '10'
+    assert runner.invoke(args=['warehouse', 'du', '-b', 'memory:///bulk/in/']).output == '3 files, 60\n'
+
+    result = runner.invoke(args=['warehouse', 'cp', 'memory:///bulk/in/', 'file:///bulk-copy/', '-j', '2'])
+    assert result.exit_code == 0, result.output
+
+    out = str(tmpdir.join('out'))
+    result = runner.invoke(args=['warehouse', 'download', 'file:///bulk-copy', out])
+    assert result.exit_code == 0, result.output
+
+    with open(os.path.join(out, 'sub', 'c.txt'), 'rb') as f:
+        assert f.read() == b'c' * 30
+
+    result = runner.invoke(args=['warehouse', 'download', 'memory:///bulk/missing.txt', out])
+    assert result.exit_code != 0 and 'does not exist' in result.output
+
+    assert runner.invoke(args=['warehouse', 'rm', 'memory:///bulk/in/'], input='n\n').exit_code != 0
+    assert runner.invoke(args=['warehouse', 'rm', 'memory:///bulk/in/a.txt']).exit_code == 0
+    assert runner.invoke(args=['warehouse', 'rm', '--yes', 'memory:///bulk/in/']).output.startswith('Deleted 2 files')
+    assert runner.invoke(args=['warehouse', 'du', 'memory:///bulk']).output == '0 files, 0 B\n'
+
+    with app.app_context():
+        warehouse('file:///bulk-copy').delete()
+
+    # a listing that fails part way counts as a failure, and what finished is still recorded
+    from click import ClickException
+
+    from flask_warehouse.cli import Manifest, run_transfers
+
+    def tasks():
+        yield 'a', 'b', 1, 'v1', lambda: None
+        raise IOError('listing failed')
+
+    with pytest.raises(ClickException, match='1 transfers failed'):
+        run_transfers(tasks(), 'Copied', manifest=manifest)
+
+    assert 'listing failed' in capsys.readouterr().err
+
+    recorded = Manifest(manifest)
+    assert recorded.done('a', 'b', 1, 'v1')
+    recorded.close()